@@ -0,0 +1,24 @@
+-- ============================================================================
+-- TRIGGER updated_at EN chat_sessions
+-- ============================================================================
+-- Mantiene chat_sessions.updated_at en la base de datos al hacer UPDATE
+-- (p. ej. al renombrar una sesión), así el backend no tiene que enviar
+-- "updated_at" en cada actualización.
+--
+-- Usa la función update_chat_sessions_updated_at() creada en
+-- create_chat_sessions_table.sql.
+-- ============================================================================
+
+CREATE OR REPLACE FUNCTION update_chat_sessions_updated_at()
+RETURNS TRIGGER AS $$
+BEGIN
+  NEW.updated_at = TIMEZONE('utc'::text, NOW());
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS chat_sessions_set_updated_at_trigger ON chat_sessions;
+CREATE TRIGGER chat_sessions_set_updated_at_trigger
+  BEFORE UPDATE ON chat_sessions
+  FOR EACH ROW
+  EXECUTE FUNCTION update_chat_sessions_updated_at();
@@ -10,6 +10,7 @@ Este archivo permite reutilizar el código base para diferentes proyectos:
 
 Simplemente modifica los valores según tu proyecto.
 """
+import os
 
 # ============================================================================
 # CONFIGURACIÓN DEL DOMINIO/TEMA
@@ -58,6 +59,30 @@ SIMILARITY_TOP_K = 8
 # Temperatura del modelo (creatividad: 0.0 = conservador, 1.0 = creativo)
 MODEL_TEMPERATURE = 0.7
 
+# Deduplicar consultas idénticas en curso (mismo modelo, prompt y parámetros):
+# la segunda request reutiliza el stream de la primera en lugar de llamar de nuevo
+# al proveedor. A cada usuario se le siguen descontando sus tokens por separado.
+LLM_INFLIGHT_DEDUP = os.getenv("LLM_INFLIGHT_DEDUP", "false").strip().lower() in ("1", "true", "yes")
+
+# Agrupar saludos simples que llegan a la vez (ventana de 50 ms, hasta 8) en una
+# sola llamada al modelo. Un saludo que llega solo se responde de forma normal.
+GREETING_BATCH_ENABLED = os.getenv("GREETING_BATCH_ENABLED", "false").strip().lower() in ("1", "true", "yes")
+
+# Enviar las consultas "Estudio Profundo" marcadas como background a la Batch API
+# del proveedor (50% más barata, entrega en hasta 24h). Solo modelos de OpenAI.
+LLM_BATCH_ENABLED = os.getenv("LLM_BATCH_ENABLED", "false").strip().lower() in ("1", "true", "yes")
+
+# Cada cuántos segundos se consulta el estado de los batches pendientes
+LLM_BATCH_POLL_SECONDS = 60
+
+# Control de admisión por modelo (0 = sin límite): streams simultáneos, tokens en
+# vuelo estimados (entrada + max_tokens) y requests por segundo con ráfaga.
+# Las requests que no caben se rechazan con 429 en lugar de encolarse.
+LLM_MAX_CONCURRENT_STREAMS = int(os.getenv("LLM_MAX_CONCURRENT_STREAMS", "64"))
+LLM_MAX_INFLIGHT_TOKENS = int(os.getenv("LLM_MAX_INFLIGHT_TOKENS", "400000"))
+LLM_RATE_LIMIT_RPS = float(os.getenv("LLM_RATE_LIMIT_RPS", "20"))
+LLM_RATE_LIMIT_BURST = int(os.getenv("LLM_RATE_LIMIT_BURST", "40"))
+
 # Tokens iniciales para nuevos usuarios
 # Recomendación: 15,000 tokens (costo: ~$0.0027 USD, permite 3 consultas rápidas o 1-2 profundas)
 INITIAL_TOKENS = 15000
@@ -0,0 +1,119 @@
+-- ============================================================================
+-- FUNCIONES RPC chat_prepare Y chat_finalize
+-- ============================================================================
+-- Reducen las idas y vueltas a Supabase en cada consulta de /chat:
+--
+--   chat_prepare  -> lee tokens_restantes del perfil + busca chunks en
+--                    book_chunks + une el filename desde documents
+--                    (antes: 3 llamadas separadas)
+--   chat_finalize -> descuenta tokens de forma atómica y devuelve el perfil
+--                    actualizado para la lógica de uso justo
+--                    (antes: SELECT de perfil + UPDATE)
+--
+-- El backend detecta si estas funciones no existen y vuelve automáticamente
+-- al flujo anterior de varias llamadas, así que el script es opcional.
+-- ============================================================================
+
+-- PASO 1: Crear función chat_prepare
+-- IMPORTANTE: Ajusta 'book_chunks.embedding' si tu columna vector se llama 'vec'
+CREATE OR REPLACE FUNCTION chat_prepare(
+  p_user_id uuid,
+  query_embedding vector(384),
+  match_count int DEFAULT 5,
+  category_filter text DEFAULT NULL
+)
+RETURNS jsonb
+LANGUAGE plpgsql
+STABLE
+PARALLEL SAFE
+AS $$
+DECLARE
+  v_tokens integer;
+  v_chunks jsonb;
+BEGIN
+  SELECT tokens_restantes INTO v_tokens
+  FROM profiles
+  WHERE id = p_user_id;
+
+  IF NOT FOUND THEN
+    RETURN jsonb_build_object('profile_found', false);
+  END IF;
+
+  -- Sin saldo: no tiene sentido buscar contexto, el backend responde 402
+  IF v_tokens <= 0 THEN
+    RETURN jsonb_build_object(
+      'profile_found', true,
+      'tokens_restantes', v_tokens,
+      'chunks', '[]'::jsonb
+    );
+  END IF;
+
+  SELECT COALESCE(jsonb_agg(c ORDER BY c.similarity DESC), '[]'::jsonb)
+  INTO v_chunks
+  FROM (
+    SELECT
+      m.id,
+      m.content,
+      m.metadata,
+      m.similarity,
+      d.filename
+    FROM (
+      SELECT
+        book_chunks.id,
+        book_chunks.content,
+        book_chunks.metadata,
+        1 - (book_chunks.embedding <=> query_embedding) AS similarity
+      FROM book_chunks
+      WHERE (category_filter IS NULL OR book_chunks.metadata->>'category' = category_filter)
+      ORDER BY book_chunks.embedding <=> query_embedding
+      LIMIT match_count
+    ) m
+    LEFT JOIN documents d ON d.doc_id = m.metadata->>'doc_id'
+  ) c;
+
+  RETURN jsonb_build_object(
+    'profile_found', true,
+    'tokens_restantes', v_tokens,
+    'chunks', v_chunks
+  );
+END;
+$$;
+
+-- PASO 2: Crear función chat_finalize
+-- Descuenta los tokens con un UPDATE atómico (sin leer antes el saldo) y
+-- devuelve la fila completa del perfil ya actualizada.
+CREATE OR REPLACE FUNCTION chat_finalize(
+  p_user_id uuid,
+  p_tokens_usados int
+)
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_profile jsonb;
+BEGIN
+  UPDATE profiles
+  SET tokens_restantes = tokens_restantes - p_tokens_usados
+  WHERE id = p_user_id
+  RETURNING to_jsonb(profiles.*) INTO v_profile;
+
+  RETURN v_profile;
+END;
+$$;
+
+-- PASO 3: Verificar que las funciones se crearon correctamente
+SELECT
+    routine_name,
+    routine_type
+FROM information_schema.routines
+WHERE routine_schema = 'public'
+  AND routine_name IN ('chat_prepare', 'chat_finalize');
+
+-- ============================================================================
+-- NOTAS IMPORTANTES:
+-- ============================================================================
+-- 1. chat_prepare usa la misma búsqueda por distancia coseno que match_documents_384
+-- 2. Si el usuario no tiene tokens, chat_prepare no ejecuta la búsqueda vectorial
+-- 3. chat_finalize evita la condición de carrera de leer-y-restar entre pestañas
+-- 4. El historial de mensajes (conversations) se sigue guardando aparte
+-- ============================================================================
@@ -0,0 +1,113 @@
+-- ============================================================================
+-- FUNCIÓN RPC complete_checkout
+-- ============================================================================
+-- Aplica un checkout.session.completed de Stripe al perfil en una sola
+-- llamada a Supabase y en una transacción: bloquea la fila (FOR UPDATE),
+-- suma los tokens del plan, actualiza plan/customer/período y los flags de
+-- uso justo, registra el pago inicial en stripe_payments y devuelve el email
+-- del usuario.
+-- Antes: SELECT de tokens + SELECT de fair_use_discount_eligible + UPDATE +
+-- SELECT de email + INSERT del pago (5 llamadas), con carrera entre lectura y
+-- escritura si llegaban dos webhooks a la vez y sin garantía de que el pago
+-- quedara registrado si el perfil se había actualizado.
+--
+-- El backend detecta si esta función no existe y vuelve automáticamente
+-- a las consultas separadas, así que el script es opcional.
+-- ============================================================================
+
+-- PASO 1: Crear función complete_checkout
+-- (se elimina la versión anterior sin los parámetros del pago para no dejar
+-- dos sobrecargas con el mismo nombre)
+DROP FUNCTION IF EXISTS complete_checkout(uuid, text, bigint, text, timestamptz, boolean);
+
+CREATE OR REPLACE FUNCTION complete_checkout(
+  p_user_id uuid,
+  p_plan_code text,
+  p_tokens_per_month bigint,
+  p_customer_id text,
+  p_period_end timestamptz,
+  p_fair_use_applied boolean,
+  p_invoice_id text DEFAULT NULL,
+  p_amount_usd numeric DEFAULT NULL,
+  p_currency text DEFAULT 'usd',
+  p_payment_date timestamptz DEFAULT NULL
+)
+RETURNS TABLE (
+  email text,
+  tokens_anteriores bigint,
+  tokens_restantes bigint,
+  primera_suscripcion boolean,
+  pago_registrado boolean
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_tokens bigint;
+  v_first boolean;
+  v_email text;
+  v_tokens_restantes bigint;
+  v_pago boolean := false;
+BEGIN
+  SELECT COALESCE(p.tokens_restantes, 0)
+  INTO v_tokens
+  FROM profiles p
+  WHERE p.id = p_user_id
+  FOR UPDATE;
+
+  IF NOT FOUND THEN
+    RETURN;
+  END IF;
+
+  -- Los flags de uso justo solo se resetean en la primera suscripción
+  v_first := p_plan_code IS NOT NULL AND p_tokens_per_month IS NOT NULL AND v_tokens = 0;
+
+  UPDATE profiles p
+  SET stripe_customer_id = p_customer_id,
+      current_plan = COALESCE(p_plan_code, p.current_plan),
+      tokens_restantes = CASE
+        WHEN p_plan_code IS NOT NULL AND p_tokens_per_month IS NOT NULL THEN v_tokens + p_tokens_per_month
+        ELSE p.tokens_restantes
+      END,
+      tokens_monthly_limit = CASE
+        WHEN p_plan_code IS NOT NULL AND p_tokens_per_month IS NOT NULL
+          THEN GREATEST(COALESCE(p.tokens_monthly_limit, 0), p_tokens_per_month)
+        ELSE p.tokens_monthly_limit
+      END,
+      current_period_end = COALESCE(p_period_end, p.current_period_end),
+      fair_use_warning_shown = CASE WHEN v_first THEN false ELSE p.fair_use_warning_shown END,
+      fair_use_discount_eligible = CASE WHEN v_first THEN false ELSE p.fair_use_discount_eligible END,
+      fair_use_discount_eligible_at = CASE WHEN v_first THEN NULL ELSE p.fair_use_discount_eligible_at END,
+      fair_use_email_sent = CASE WHEN v_first THEN false ELSE p.fair_use_email_sent END,
+      fair_use_discount_used = CASE
+        WHEN p_fair_use_applied AND COALESCE(p.fair_use_discount_eligible, false) THEN true
+        WHEN v_first THEN false
+        ELSE p.fair_use_discount_used
+      END
+  WHERE p.id = p_user_id
+  RETURNING p.email, p.tokens_restantes INTO v_email, v_tokens_restantes;
+
+  -- Pago inicial en la misma transacción (los reintentos no lo duplican)
+  IF p_invoice_id IS NOT NULL AND p_amount_usd IS NOT NULL THEN
+    BEGIN
+      INSERT INTO stripe_payments (invoice_id, customer_id, user_id, plan_code, amount_usd, currency, payment_date)
+      VALUES (p_invoice_id, p_customer_id, p_user_id, p_plan_code, p_amount_usd,
+              COALESCE(p_currency, 'usd'), COALESCE(p_payment_date, NOW()))
+      ON CONFLICT (invoice_id) DO NOTHING;
+      v_pago := FOUND;
+    EXCEPTION WHEN undefined_table THEN
+      -- stripe_payments es opcional (create_stripe_payments_table.sql)
+      v_pago := false;
+    END;
+  END IF;
+
+  RETURN QUERY SELECT v_email, v_tokens, v_tokens_restantes, v_first, v_pago;
+END;
+$$;
+
+-- PASO 2: Verificar que la función se creó correctamente
+SELECT
+    routine_name,
+    routine_type
+FROM information_schema.routines
+WHERE routine_schema = 'public'
+  AND routine_name = 'complete_checkout';
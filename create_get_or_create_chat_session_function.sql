@@ -0,0 +1,56 @@
+-- ============================================================================
+-- FUNCIÓN RPC get_or_create_chat_session
+-- ============================================================================
+-- Devuelve el id de la sesión de chat del usuario, creándola si no existe,
+-- en una sola llamada a Supabase.
+-- Antes: SELECT en chat_sessions + INSERT si no se encontraba (2 llamadas).
+--
+-- - Con p_conversation_id: crea la sesión con ese id si no existe. Si el id
+--   ya pertenece a otro usuario se crea una sesión nueva con otro id.
+-- - Sin p_conversation_id: crea una sesión nueva.
+--
+-- El backend detecta si esta función no existe y vuelve automáticamente
+-- a las consultas separadas, así que el script es opcional.
+-- ============================================================================
+
+-- PASO 1: Crear función get_or_create_chat_session
+CREATE OR REPLACE FUNCTION get_or_create_chat_session(
+  p_user_id uuid,
+  p_conversation_id uuid,
+  p_title text
+)
+RETURNS uuid
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_id uuid;
+BEGIN
+  IF p_conversation_id IS NOT NULL THEN
+    INSERT INTO chat_sessions (id, user_id, title)
+    VALUES (p_conversation_id, p_user_id, p_title)
+    ON CONFLICT (id) DO NOTHING;
+
+    SELECT id INTO v_id
+    FROM chat_sessions
+    WHERE id = p_conversation_id AND user_id = p_user_id;
+
+    IF v_id IS NOT NULL THEN
+      RETURN v_id;
+    END IF;
+  END IF;
+
+  INSERT INTO chat_sessions (user_id, title)
+  VALUES (p_user_id, p_title)
+  RETURNING id INTO v_id;
+
+  RETURN v_id;
+END;
+$$;
+
+-- PASO 2: Verificar que la función se creó correctamente
+SELECT
+    routine_name,
+    routine_type
+FROM information_schema.routines
+WHERE routine_schema = 'public'
+  AND routine_name = 'get_or_create_chat_session';
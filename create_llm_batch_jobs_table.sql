@@ -0,0 +1,35 @@
+-- ============================================================================
+-- TABLA PARA CONSULTAS EN SEGUNDO PLANO (BATCH API DEL PROVEEDOR)
+-- ============================================================================
+-- Las consultas en modo "Estudio Profundo" marcadas como background se envían
+-- a la Batch API de OpenAI (50% más barata, entrega en hasta 24h). Esta tabla
+-- guarda cada trabajo para que el backend consulte su estado y guarde la
+-- respuesta en el historial cuando termine.
+-- ============================================================================
+
+CREATE TABLE IF NOT EXISTS public.llm_batch_jobs (
+  id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+  user_id UUID REFERENCES public.profiles(id) ON DELETE CASCADE,
+  conversation_id UUID,
+  batch_id TEXT NOT NULL,            -- Id del batch en el proveedor
+  model TEXT NOT NULL,               -- Ej: "gpt-4o-mini"
+  status TEXT NOT NULL DEFAULT 'pending',  -- pending | processing | completed | failed
+  query TEXT NOT NULL,
+  response_mode TEXT NOT NULL DEFAULT 'deep',
+  response TEXT,
+  error TEXT,
+  created_at TIMESTAMP WITH TIME ZONE DEFAULT TIMEZONE('utc'::text, NOW()) NOT NULL,
+  completed_at TIMESTAMP WITH TIME ZONE
+);
+
+-- El poller solo lee trabajos pendientes
+CREATE INDEX IF NOT EXISTS llm_batch_jobs_pending_idx ON public.llm_batch_jobs(created_at) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS llm_batch_jobs_user_id_idx ON public.llm_batch_jobs(user_id);
+
+-- ============================================================================
+-- NOTAS
+-- ============================================================================
+-- 1. Solo se usa si LLM_BATCH_ENABLED=true y el modelo de chat es de OpenAI
+--    (Deepseek no tiene Batch API; en ese caso la consulta va por streaming)
+-- 2. Los tokens se descuentan cuando el batch termina, no al encolarlo
+-- ============================================================================
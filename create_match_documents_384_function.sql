@@ -32,10 +32,16 @@ WHERE table_schema = 'public'
 -- Si la columna se llama 'embedding', usa 'embedding'
 -- Si la columna se llama 'vec', usa 'vec'
 
+-- La versión anterior recibía "filter jsonb"; se elimina para que PostgREST no
+-- tenga que elegir entre dos sobrecargas con tipos distintos
+DROP FUNCTION IF EXISTS match_documents_384(vector, int, jsonb);
+
+-- Función SQL pura con tipos explícitos, STABLE y PARALLEL SAFE: Postgres puede
+-- reutilizar el plan y paralelizar el escaneo del índice vectorial
 CREATE OR REPLACE FUNCTION match_documents_384(
   query_embedding vector(384),
   match_count int DEFAULT 5,
-  filter jsonb DEFAULT '{}'::jsonb
+  category_filter text DEFAULT NULL
 )
 RETURNS TABLE (
   id bigint,
@@ -43,20 +49,19 @@ RETURNS TABLE (
   metadata jsonb,
   similarity float
 )
-LANGUAGE plpgsql
+LANGUAGE sql
+STABLE
+PARALLEL SAFE
 AS $$
-BEGIN
-  RETURN QUERY
   SELECT
     book_chunks.id,
     book_chunks.content,
     book_chunks.metadata,
     1 - (book_chunks.embedding <=> query_embedding) AS similarity
   FROM book_chunks
-  WHERE (filter->>'doc_id' IS NULL OR book_chunks.metadata->>'doc_id' = filter->>'doc_id')
+  WHERE (category_filter IS NULL OR book_chunks.metadata->>'category' = category_filter)
   ORDER BY book_chunks.embedding <=> query_embedding
   LIMIT match_count;
-END;
 $$;
 
 -- NOTA: Si tu columna vector se llama 'vec' en lugar de 'embedding', 
@@ -105,5 +110,6 @@ WHERE schemaname = 'public'
 -- 4. IVFFlat es mejor para tablas grandes (>100K registros)
 -- 5. HNSW es mejor para búsquedas muy frecuentes
 -- 6. Asegúrate de que la columna vector tenga exactamente 384 dimensiones
+-- 7. category_filter coincide con el parámetro que envía el backend (rag_service.py)
 -- ============================================================================
 
@@ -0,0 +1,25 @@
+-- ============================================================================
+-- TABLA DE EVENTOS DE STRIPE YA PROCESADOS (IDEMPOTENCIA DE WEBHOOKS)
+-- ============================================================================
+-- Stripe reintenta los webhooks y puede entregar el mismo evento más de una
+-- vez. El backend inserta aquí el id de cada evento cuando termina de
+-- procesarlo con éxito; los eventos que ya están en la tabla se ignoran
+-- (evita sumar los tokens del plan dos veces). Si el procesamiento falla, el
+-- id no se registra y un reenvío desde Stripe lo vuelve a procesar.
+--
+-- El backend detecta si esta tabla no existe y procesa los webhooks sin
+-- deduplicar, así que el script es opcional.
+-- ============================================================================
+
+CREATE TABLE IF NOT EXISTS public.processed_stripe_events (
+  event_id TEXT PRIMARY KEY,         -- Ej: "evt_1Nxxxxxxxx"
+  processed_at TIMESTAMP WITH TIME ZONE DEFAULT TIMEZONE('utc'::text, NOW()) NOT NULL
+);
+
+-- ============================================================================
+-- NOTAS
+-- ============================================================================
+-- 1. Stripe solo reintenta durante unos días: las filas antiguas se pueden
+--    borrar sin riesgo, por ejemplo:
+--    DELETE FROM public.processed_stripe_events WHERE processed_at < NOW() - INTERVAL '30 days';
+-- ============================================================================
@@ -0,0 +1,37 @@
+-- ============================================================================
+-- FUNCIÓN RPC reload_user_tokens
+-- ============================================================================
+-- Recarga tokens de un usuario en una sola llamada a Supabase: suma p_delta
+-- a tokens_restantes de forma atómica (sin carrera entre SELECT y UPDATE) y
+-- resetea tokens_reload_email_sent para permitir el email de confirmación.
+-- Antes: SELECT de tokens_restantes + UPDATE (2 llamadas).
+--
+-- El backend detecta si esta función no existe y vuelve automáticamente
+-- a las consultas separadas, así que el script es opcional.
+-- ============================================================================
+
+-- PASO 1: Crear función reload_user_tokens
+CREATE OR REPLACE FUNCTION reload_user_tokens(
+  p_user_id uuid,
+  p_delta bigint
+)
+RETURNS TABLE (tokens_anteriores bigint, tokens_nuevos bigint)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  RETURN QUERY
+  UPDATE profiles
+  SET tokens_restantes = profiles.tokens_restantes + p_delta,
+      tokens_reload_email_sent = false
+  WHERE id = p_user_id
+  RETURNING profiles.tokens_restantes - p_delta, profiles.tokens_restantes;
+END;
+$$;
+
+-- PASO 2: Verificar que la función se creó correctamente
+SELECT
+    routine_name,
+    routine_type
+FROM information_schema.routines
+WHERE routine_schema = 'public'
+  AND routine_name = 'reload_user_tokens';
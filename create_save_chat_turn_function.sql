@@ -0,0 +1,43 @@
+-- ============================================================================
+-- FUNCIÓN RPC save_chat_turn
+-- ============================================================================
+-- Guarda un turno completo del chat (mensaje del usuario + respuesta del
+-- asistente) en una sola llamada a Supabase, dentro de una transacción.
+-- Antes: 2 INSERT en conversations + 1 UPDATE de chat_sessions.updated_at.
+--
+-- chat_sessions.updated_at lo actualiza el trigger
+-- update_chat_sessions_updated_at_trigger al insertar en conversations.
+--
+-- El backend detecta si esta función no existe y vuelve automáticamente
+-- a los INSERT separados, así que el script es opcional.
+-- ============================================================================
+
+-- PASO 1: Crear función save_chat_turn
+-- clock_timestamp() (y no NOW()) para que la respuesta quede siempre después
+-- de la pregunta al ordenar por created_at dentro de la misma transacción
+CREATE OR REPLACE FUNCTION save_chat_turn(
+  p_user_id uuid,
+  p_conversation_id uuid,
+  p_user_msg text,
+  p_assistant_msg text,
+  p_tokens int
+)
+RETURNS void
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  INSERT INTO conversations (user_id, conversation_id, message_role, message_content, tokens_used, created_at)
+  VALUES (p_user_id, p_conversation_id, 'user', p_user_msg, 0, clock_timestamp());
+
+  INSERT INTO conversations (user_id, conversation_id, message_role, message_content, tokens_used, created_at)
+  VALUES (p_user_id, p_conversation_id, 'assistant', p_assistant_msg, p_tokens, clock_timestamp());
+END;
+$$;
+
+-- PASO 2: Verificar que la función se creó correctamente
+SELECT
+    routine_name,
+    routine_type
+FROM information_schema.routines
+WHERE routine_schema = 'public'
+  AND routine_name = 'save_chat_turn';
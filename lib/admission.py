@@ -0,0 +1,130 @@
+"""
+Control de admisión (bulkhead) para las llamadas de chat al proveedor de IA.
+
+Cada modelo tiene un tope de streams simultáneos, un presupuesto de tokens en
+vuelo (entrada estimada + max_tokens) y un token bucket de requests por
+segundo. Si una request no cabe se rechaza al instante con 429 en lugar de
+encolarse detrás de las demás y superar los rate limits del proveedor.
+"""
+import time
+import threading
+import logging
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class _TokenBucket:
+    """Token bucket clásico: `rate` requests por segundo con ráfagas de hasta `burst`."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def try_take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class AdmissionTicket:
+    """Reserva de capacidad de una request; release() es idempotente."""
+
+    def __init__(self, bulkhead: "ModelBulkhead", estimated_tokens: int):
+        self._bulkhead = bulkhead
+        self.estimated_tokens = estimated_tokens
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._bulkhead._release(self.estimated_tokens)
+
+
+class ModelBulkhead:
+    """Límites de concurrencia, tokens en vuelo y requests por segundo de un modelo."""
+
+    def __init__(self, max_concurrent: int, max_inflight_tokens: int, rate: float, burst: int):
+        self.max_concurrent = max_concurrent
+        self.max_inflight_tokens = max_inflight_tokens
+        self.bucket = _TokenBucket(rate, burst) if rate > 0 else None
+        self.active = 0
+        self.inflight_tokens = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, estimated_tokens: int) -> Optional[AdmissionTicket]:
+        """Reserva capacidad sin esperar; devuelve None si la request no cabe."""
+        with self._lock:
+            if self.max_concurrent and self.active >= self.max_concurrent:
+                return None
+            # Una request sola siempre cabe aunque supere el presupuesto
+            if (
+                self.max_inflight_tokens
+                and self.active
+                and self.inflight_tokens + estimated_tokens > self.max_inflight_tokens
+            ):
+                return None
+            if self.bucket is not None and not self.bucket.try_take():
+                return None
+            self.active += 1
+            self.inflight_tokens += estimated_tokens
+        return AdmissionTicket(self, estimated_tokens)
+
+    def _release(self, estimated_tokens: int):
+        with self._lock:
+            self.active -= 1
+            self.inflight_tokens -= estimated_tokens
+
+
+# Un bulkhead por modelo de chat (se crean al primer uso)
+_BULKHEADS: Dict[str, ModelBulkhead] = {}
+_BULKHEADS_LOCK = threading.Lock()
+
+
+def _get_bulkhead(chat_model: str) -> ModelBulkhead:
+    bulkhead = _BULKHEADS.get(chat_model)
+    if bulkhead is None:
+        with _BULKHEADS_LOCK:
+            bulkhead = _BULKHEADS.setdefault(chat_model, ModelBulkhead(
+                max_concurrent=config.LLM_MAX_CONCURRENT_STREAMS,
+                max_inflight_tokens=config.LLM_MAX_INFLIGHT_TOKENS,
+                rate=config.LLM_RATE_LIMIT_RPS,
+                burst=config.LLM_RATE_LIMIT_BURST
+            ))
+    return bulkhead
+
+
+def admit(chat_model: str, estimated_tokens: int) -> AdmissionTicket:
+    """
+    Admite una request de chat para el modelo o la rechaza con 429.
+
+    Args:
+        chat_model: Modelo de chat que atenderá la request
+        estimated_tokens: Tokens de entrada estimados + max_tokens de la respuesta
+
+    Returns:
+        AdmissionTicket que hay que liberar al terminar el stream
+
+    Raises:
+        HTTPException: 429 si el modelo está saturado
+    """
+    ticket = _get_bulkhead(chat_model).try_acquire(estimated_tokens)
+    if ticket is None:
+        logger.warning(f"🚦 Request rechazada por saturación de {chat_model} (~{estimated_tokens} tokens)")
+        raise HTTPException(
+            status_code=429,
+            detail="El servicio está recibiendo muchas consultas en este momento. Por favor, intenta de nuevo en unos segundos.",
+            headers={"Retry-After": "5"}
+        )
+    return ticket
@@ -0,0 +1,91 @@
+"""
+Cola de eventos de alertas de uso (emails al admin).
+
+El descuento de tokens solo publica un evento pequeño (user_id, plan, uso);
+el renderizado del HTML, el envío y la marca en la base de datos los hace un
+único consumidor persistente que arranca con la aplicación. La comprobación
+de "ya enviado" se hace en el consumidor con un UPDATE condicional, así dos
+requests simultáneas que cruzan el umbral no envían el email dos veces.
+"""
+import queue
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+from lib.dependencies import supabase_client
+from lib.email_templates import render_email, format_usage_values, ADMIN_80_PERCENT_HTML
+
+logger = logging.getLogger(__name__)
+
+FAIR_USE_80 = "fair_use_80"
+
+_events: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+_consumer: Optional[threading.Thread] = None
+
+
+def publish(event: Dict[str, Any]):
+    """
+    Publica un evento de alerta (no bloquea).
+
+    Si el consumidor no está en marcha (scripts, tests manuales) el evento se
+    procesa en el worker persistente de emails.
+    """
+    if _consumer is not None and _consumer.is_alive():
+        _events.put_nowait(event)
+    else:
+        from lib.email import submit_email_task
+        submit_email_task(_handle_event, event)
+
+
+def _claim_flag(user_id: str, flag: str) -> bool:
+    """Marca el flag solo si aún no estaba marcado; True si esta llamada lo marcó."""
+    response = supabase_client.table("profiles").update({flag: True}).eq(
+        "id", user_id
+    ).or_(f"{flag}.is.null,{flag}.eq.false").execute()
+    return bool(response.data)
+
+
+def _handle_fair_use_80(event: Dict[str, Any]):
+    user_id = event["user_id"]
+    if not _claim_flag(user_id, "fair_use_warning_shown"):
+        logger.debug("Alerta 80%% ya enviada para %s, se omite", user_id)
+        return
+
+    from lib.email import send_admin_email
+    admin_html = render_email(
+        ADMIN_80_PERCENT_HTML,
+        user_email=event.get("user_email") or 'N/A',
+        user_id=str(user_id),
+        current_plan=event.get("current_plan") or 'N/A',
+        fecha=datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        **format_usage_values(event["nuevos_tokens"], event["tokens_monthly_limit"], event["usage_percent"])
+    )
+    send_admin_email("⚠️ Alerta: Usuario alcanzó 80% de límite de tokens", admin_html)
+
+
+_HANDLERS = {
+    FAIR_USE_80: _handle_fair_use_80,
+}
+
+
+def _handle_event(event: Dict[str, Any]):
+    try:
+        _HANDLERS[event["type"]](event)
+    except Exception as e:
+        logger.warning(f"[BG] ⚠️ Error procesando alerta {event.get('type')}: {e}")
+
+
+def _consume():
+    while True:
+        _handle_event(_events.get())
+
+
+def start_consumer():
+    """Arranca el consumidor de alertas (una sola vez, en el startup de la app)."""
+    global _consumer
+    if _consumer is not None and _consumer.is_alive():
+        return
+    _consumer = threading.Thread(target=_consume, name="alert-events", daemon=True)
+    _consumer.start()
+    logger.info("📨 Consumidor de alertas de uso iniciado")
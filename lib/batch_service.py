@@ -0,0 +1,216 @@
+"""
+Consultas en segundo plano vía Batch API del proveedor.
+
+Las consultas "Estudio Profundo" que el cliente marca como background no
+necesitan respuesta inmediata: se envían a la Batch API de OpenAI (50% más
+barata, ventana de 24h) y un poller guarda la respuesta en el historial
+cuando el batch termina. Los trabajos se registran en la tabla llm_batch_jobs.
+"""
+import json
+import uuid
+import asyncio
+import logging
+from typing import Optional, Dict, Any, Callable
+
+import config
+from lib import llm_provider
+from lib.config_shared import OPENAI_API_KEY
+from lib.dependencies import supabase_client
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+
+# Estados terminales sin salida utilizable
+_FAILED_STATUSES = ("failed", "expired", "cancelled")
+
+
+class BatchService:
+    """Encola consultas en la Batch API y recoge sus resultados."""
+
+    def __init__(self):
+        self.enabled = config.LLM_BATCH_ENABLED
+        # Se desactiva si la tabla llm_batch_jobs no existe
+        self._table_available = True
+
+    def is_eligible(self, chat_model: str) -> bool:
+        """Indica si el modelo puede ir por la Batch API (solo OpenAI directo)."""
+        if not (self.enabled and self._table_available and OPENAI_API_KEY):
+            return False
+        direct = llm_provider._resolve_direct_provider(chat_model)
+        return direct is not None and direct[0] == "openai"
+
+    def _get_client(self):
+        return llm_provider._get_sdk_client("openai", OPENAI_API_KEY)
+
+    async def submit(
+        self,
+        user_id: str,
+        conversation_id: Optional[str],
+        query: str,
+        response_mode: str,
+        litellm_params: Dict[str, Any]
+    ) -> Optional[str]:
+        """
+        Envía una consulta a la Batch API y registra el trabajo.
+
+        Args:
+            user_id: ID del usuario
+            conversation_id: Sesión de chat donde se guardará la respuesta
+            query: Consulta del usuario
+            response_mode: Modo de respuesta
+            litellm_params: Parámetros de la llamada (ver LLMService.build_request_params)
+
+        Returns:
+            ID del trabajo en llm_batch_jobs, o None si no se pudo encolar
+            (la consulta debe responderse por streaming)
+        """
+        job_id = str(uuid.uuid4())
+        model_name = llm_provider._resolve_direct_provider(litellm_params["model"])[1]
+        body = {
+            key: value
+            for key, value in litellm_params.items()
+            if key not in ("model", "api_key", "stream", "stream_options")
+        }
+        request_line = json.dumps({
+            "custom_id": job_id,
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": {"model": model_name, **body}
+        }, ensure_ascii=False)
+
+        try:
+            client = self._get_client()
+            input_file = await client.files.create(
+                file=(f"{job_id}.jsonl", request_line.encode("utf-8")),
+                purpose="batch"
+            )
+            batch = await client.batches.create(
+                input_file_id=input_file.id,
+                endpoint=BATCH_ENDPOINT,
+                completion_window=BATCH_COMPLETION_WINDOW
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo enviar la consulta a la Batch API: {e}")
+            return None
+
+        try:
+            supabase_client.table("llm_batch_jobs").insert({
+                "id": job_id,
+                "user_id": user_id,
+                "conversation_id": conversation_id,
+                "batch_id": batch.id,
+                "model": model_name,
+                "status": "pending",
+                "query": query,
+                "response_mode": response_mode
+            }).execute()
+        except Exception as e:
+            logger.error(f"❌ No se pudo registrar el trabajo batch {batch.id}: {e}")
+            self._table_available = False
+            try:
+                await client.batches.cancel(batch.id)
+            except Exception:
+                pass
+            return None
+
+        logger.info(f"📦 Consulta encolada en Batch API: job {job_id} (batch {batch.id})")
+        return job_id
+
+    def get_job(self, job_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        """Devuelve el trabajo si pertenece al usuario."""
+        response = supabase_client.table("llm_batch_jobs").select(
+            "id, conversation_id, status, response, error, created_at, completed_at"
+        ).eq("id", job_id).eq("user_id", user_id).execute()
+        return response.data[0] if response.data else None
+
+    async def poll_once(self, on_complete: Callable[[Dict[str, Any], str, Dict[str, int]], None]):
+        """
+        Revisa los trabajos pendientes y procesa los que ya terminaron.
+
+        Args:
+            on_complete: Función síncrona (job, respuesta, usage) que guarda el
+                historial y descuenta los tokens; se ejecuta en un hilo
+        """
+        response = await asyncio.to_thread(
+            supabase_client.table("llm_batch_jobs").select("*").eq(
+                "status", "pending"
+            ).order("created_at").limit(50).execute
+        )
+        if not response.data:
+            return
+
+        client = self._get_client()
+        for job in response.data:
+            try:
+                batch = await client.batches.retrieve(job["batch_id"])
+                if batch.status == "completed" and batch.output_file_id:
+                    output = await client.files.content(batch.output_file_id)
+                    result = json.loads(output.text.splitlines()[0])
+                    body = result["response"]["body"]
+                    respuesta = body["choices"][0]["message"]["content"] or ""
+                    raw_usage = body.get("usage") or {}
+                    usage = {
+                        "input_tokens": raw_usage.get("prompt_tokens", 0),
+                        "output_tokens": raw_usage.get("completion_tokens", 0),
+                        "total_tokens": raw_usage.get("total_tokens", 0)
+                    }
+
+                    # Reclamar el trabajo antes de guardar el historial y descontar
+                    # tokens: si la marca final falla no se vuelve a cobrar en el
+                    # siguiente ciclo
+                    claim = await asyncio.to_thread(
+                        supabase_client.table("llm_batch_jobs").update({
+                            "status": "processing"
+                        }).eq("id", job["id"]).eq("status", "pending").execute
+                    )
+                    if not claim.data:
+                        continue
+                    
+                    try:
+                        await asyncio.to_thread(on_complete, job, respuesta, usage)
+                    except Exception as e:
+                        await asyncio.to_thread(
+                            supabase_client.table("llm_batch_jobs").update({
+                                "status": "failed",
+                                "error": f"Error guardando respuesta: {e}",
+                                "completed_at": "now()"
+                            }).eq("id", job["id"]).execute
+                        )
+                        raise
+                    
+                    await asyncio.to_thread(
+                        supabase_client.table("llm_batch_jobs").update({
+                            "status": "completed",
+                            "response": respuesta,
+                            "completed_at": "now()"
+                        }).eq("id", job["id"]).execute
+                    )
+                    logger.info(f"✅ Trabajo batch {job['id']} completado ({usage['total_tokens']} tokens)")
+                elif batch.status in _FAILED_STATUSES or (batch.status == "completed" and not batch.output_file_id):
+                    await asyncio.to_thread(
+                        supabase_client.table("llm_batch_jobs").update({
+                            "status": "failed",
+                            "error": f"Batch {batch.status}",
+                            "completed_at": "now()"
+                        }).eq("id", job["id"]).eq("status", "pending").execute
+                    )
+                    logger.warning(f"⚠️ Trabajo batch {job['id']} terminó sin respuesta: {batch.status}")
+            except Exception as e:
+                logger.error(f"❌ Error procesando trabajo batch {job['id']}: {e}")
+
+    async def poll_periodically(self, on_complete: Callable[[Dict[str, Any], str, Dict[str, int]], None]):
+        """Tarea de fondo que revisa los batches pendientes cada LLM_BATCH_POLL_SECONDS."""
+        while True:
+            try:
+                await self.poll_once(on_complete)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Error revisando trabajos batch: {e}")
+            await asyncio.sleep(config.LLM_BATCH_POLL_SECONDS)
+
+
+# Instancia global del servicio
+batch_service = BatchService()
@@ -16,3 +16,11 @@ REF_MAX_REWARDS = 5  # Máximo referidos con recompensa completa
 APP_NAME = "Codex Trader"
 APP_DESCRIPTION = "Tu asistente de IA especializado en trading, entrenado con contenido profesional"
 
+
+# Modos de respuesta que se consideran "Estudio Profundo"
+DEEP_RESPONSE_MODES = frozenset({'deep', 'estudio profundo', 'profundo'})
+
+
+def is_deep_response_mode(response_mode) -> bool:
+    """Indica si el modo de respuesta corresponde a "Estudio Profundo"."""
+    return bool(response_mode) and response_mode.lower() in DEEP_RESPONSE_MODES
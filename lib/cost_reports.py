@@ -6,7 +6,9 @@ import os
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
 from dotenv import load_dotenv
-from supabase import create_client
+from functools import lru_cache
+
+from lib.dependencies import create_supabase_client
 
 # Cargar variables de entorno
 load_dotenv()
@@ -62,8 +64,12 @@ def _derive_rest_url_from_db(db_url: str) -> str:
     
     return f"https://{host}"
 
+@lru_cache(maxsize=1)
 def get_supabase_client():
-    """Obtiene el cliente de Supabase, inicializándolo si es necesario."""
+    """
+    Obtiene el cliente de Supabase, inicializándolo si es necesario.
+    Se crea una sola vez y reutiliza su pool de conexiones keep-alive.
+    """
     if not SUPABASE_SERVICE_KEY:
         raise ValueError("SUPABASE_SERVICE_KEY debe estar configurado en .env")
     
@@ -86,7 +92,7 @@ def get_supabase_client():
             "Configura SUPABASE_REST_URL o SUPABASE_DB_URL en .env"
         )
     
-    return create_client(SUPABASE_REST_URL, SUPABASE_SERVICE_KEY)
+    return create_supabase_client(SUPABASE_REST_URL, SUPABASE_SERVICE_KEY)
 
 
 def get_cost_summary_data(from_date: str, to_date: str) -> Dict[str, Any]:
@@ -3,7 +3,13 @@ Dependencias compartidas para los routers.
 Contiene funciones de autenticación y utilidades comunes.
 """
 import os
+import hmac
+import time
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from types import SimpleNamespace
 from typing import Optional
 from fastapi import HTTPException, Header
 from supabase import create_client
@@ -20,6 +26,59 @@ SUPABASE_ANON_KEY = None
 ADMIN_EMAILS = []
 
 
+# Pool HTTP compartido por el cliente global de Supabase (keep-alive entre requests)
+SUPABASE_HTTP_MAX_KEEPALIVE = int(os.getenv("SUPABASE_HTTP_MAX_KEEPALIVE", "40"))
+SUPABASE_HTTP_MAX_CONNECTIONS = int(os.getenv("SUPABASE_HTTP_MAX_CONNECTIONS", "60"))
+SUPABASE_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_HTTP_KEEPALIVE_EXPIRY", "40"))
+
+# HTTP/2 solo si el paquete h2 está disponible (httpx lo requiere): varias
+# llamadas concurrentes a PostgREST comparten una sola conexión TLS
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+def create_supabase_client(rest_url: str, service_key: str):
+    """
+    Crea el cliente global de Supabase con un pool httpx con keep-alive.
+    
+    Así cada .execute() reutiliza conexiones TLS abiertas en lugar de abrir
+    una nueva. Si la versión instalada de supabase no acepta un httpx_client
+    propio, se crea el cliente con la configuración por defecto.
+    """
+    try:
+        import httpx
+        from supabase.lib.client_options import SyncClientOptions
+    except ImportError:
+        return create_client(rest_url, service_key)
+    
+    limits = httpx.Limits(
+        max_keepalive_connections=SUPABASE_HTTP_MAX_KEEPALIVE,
+        max_connections=SUPABASE_HTTP_MAX_CONNECTIONS,
+        keepalive_expiry=SUPABASE_HTTP_KEEPALIVE_EXPIRY
+    )
+    http_client = httpx.Client(
+        transport=httpx.HTTPTransport(retries=3, limits=limits, http2=HTTP2_AVAILABLE),
+        timeout=httpx.Timeout(120.0)
+    )
+    
+    try:
+        options = SyncClientOptions(httpx_client=http_client)
+    except TypeError:
+        # supabase-py sin soporte de httpx_client en las opciones
+        http_client.close()
+        return create_client(rest_url, service_key)
+    
+    logger.info(
+        f"🔌 Pool HTTP de Supabase: keepalive={SUPABASE_HTTP_MAX_KEEPALIVE}, "
+        f"max={SUPABASE_HTTP_MAX_CONNECTIONS}, expiry={SUPABASE_HTTP_KEEPALIVE_EXPIRY}s, "
+        f"HTTP/2: {'sí' if HTTP2_AVAILABLE else 'no'}"
+    )
+    return create_client(rest_url, service_key, options=options)
+
+
 def init_dependencies(
     client,
     rest_url: str,
@@ -63,11 +122,125 @@ def get_user_supabase_client(token: str):
     return client
 
 
-async def get_user(authorization: Optional[str] = Header(None)):
+# Identidad firmada por el edge (opcional). Solo activar si el gateway/edge
+# propio valida el JWT y firma los headers X-Edge-* con este secreto HMAC.
+EDGE_AUTH_SECRET = os.getenv("EDGE_AUTH_SECRET", "").strip('"').strip("'").strip().encode("utf-8")
+EDGE_AUTH_MAX_SKEW_SECONDS = 30
+
+
+def _get_edge_user(
+    user_id: Optional[str],
+    email: Optional[str],
+    timestamp: Optional[str],
+    signature: Optional[str]
+):
+    """
+    Verifica la identidad inyectada por el edge de confianza.
+    
+    La firma es HMAC-SHA256(EDGE_AUTH_SECRET, "<user_id>:<email>:<timestamp>")
+    en hexadecimal y el timestamp (epoch en segundos) no puede desviarse más de
+    EDGE_AUTH_MAX_SKEW_SECONDS del reloj local.
+    
+    Returns:
+        Objeto con la misma forma que el usuario de Supabase (id, email),
+        o None si el fast path no está activo o la firma no es válida.
+    """
+    if not EDGE_AUTH_SECRET or not (user_id and timestamp and signature):
+        return None
+    
+    try:
+        if abs(time.time() - int(timestamp)) >= EDGE_AUTH_MAX_SKEW_SECONDS:
+            logger.warning("⚠️ get_user: Headers de edge expirados, validando con Supabase")
+            return None
+    except ValueError:
+        return None
+    
+    message = f"{user_id}:{email or ''}:{timestamp}".encode("utf-8")
+    expected = hmac.new(EDGE_AUTH_SECRET, message, hashlib.sha256).hexdigest()
+    # compare_digest lanza TypeError con str no ASCII: comparar bytes
+    if not hmac.compare_digest(expected.encode("ascii"), signature.encode("utf-8", "surrogateescape")):
+        logger.warning("⚠️ get_user: Firma de edge inválida, validando con Supabase")
+        return None
+    
+    return SimpleNamespace(id=user_id, email=email, user_metadata={}, app_metadata={})
+
+
+# Cache de tokens ya validados con Supabase Auth: los clientes que consultan
+# /tokens cada pocos segundos no pagan una llamada a Auth por request.
+# Clave: hash del token (el token en claro no se guarda en memoria).
+# Un token revocado o de una sesión cerrada sigue aceptándose como mucho
+# _USER_CACHE_TTL_SECONDS desde su última validación con Supabase.
+_USER_CACHE_TTL_SECONDS = 30
+_USER_CACHE_MAX_SIZE = 10_000
+_user_cache: "OrderedDict[bytes, tuple]" = OrderedDict()
+_user_cache_lock = threading.Lock()
+user_cache_hits = 0
+user_cache_misses = 0
+
+
+def _token_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+
+
+def _get_cached_user(token: str):
+    """Usuario validado para el token si sigue dentro del TTL, o None."""
+    global user_cache_hits, user_cache_misses
+    key = _token_key(token)
+    with _user_cache_lock:
+        entry = _user_cache.get(key)
+        if entry is not None and time.monotonic() - entry[0] < _USER_CACHE_TTL_SECONDS:
+            user_cache_hits += 1
+            return entry[1]
+        if entry is not None:
+            del _user_cache[key]
+        user_cache_misses += 1
+    return None
+
+
+def _cache_user(token: str, user):
+    with _user_cache_lock:
+        _user_cache[_token_key(token)] = (time.monotonic(), user)
+        if len(_user_cache) > _USER_CACHE_MAX_SIZE:
+            _user_cache.popitem(last=False)
+
+
+def get_user_cache_stats() -> dict:
+    """Aciertos, fallos y tamaño de la cache de tokens validados (para /debug/user-cache)."""
+    with _user_cache_lock:
+        hits, misses, size = user_cache_hits, user_cache_misses, len(_user_cache)
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / total, 4) if total else None,
+        "size": size,
+        "max_size": _USER_CACHE_MAX_SIZE,
+        "ttl_seconds": _USER_CACHE_TTL_SECONDS,
+    }
+
+
+async def get_user(
+    authorization: Optional[str] = Header(None),
+    x_edge_user_id: Optional[str] = Header(None),
+    x_edge_user_email: Optional[str] = Header(None),
+    x_edge_ts: Optional[str] = Header(None),
+    x_edge_sig: Optional[str] = Header(None)
+):
     """
     Valida el token JWT de Supabase y devuelve el objeto usuario.
     Lanza HTTPException 401 si el token es inválido o no está presente.
+    
+    Si EDGE_AUTH_SECRET está configurado y el edge envió una identidad firmada
+    válida (X-Edge-User-Id, X-Edge-User-Email, X-Edge-Ts, X-Edge-Sig), se
+    omite la llamada a Supabase Auth.
+    
+    Los tokens ya validados se reutilizan durante _USER_CACHE_TTL_SECONDS sin
+    volver a consultar Supabase Auth.
     """
+    edge_user = _get_edge_user(x_edge_user_id, x_edge_user_email, x_edge_ts, x_edge_sig)
+    if edge_user is not None:
+        return edge_user
+    
     if not authorization:
         logger.warning("⚠️ get_user: No se recibió header Authorization")
         raise HTTPException(
@@ -91,6 +264,10 @@ async def get_user(authorization: Optional[str] = Header(None)):
             detail="Formato de token inválido. Usa 'Bearer <token>'"
         )
     
+    cached_user = _get_cached_user(token)
+    if cached_user is not None:
+        return cached_user
+    
     # Validar el token con Supabase
     try:
         logger.debug(f"🔐 get_user: Validando token (primeros 20 chars: {token[:20]}...)")
@@ -119,6 +296,7 @@ async def get_user(authorization: Optional[str] = Header(None)):
                 detail="Token inválido o expirado"
             )
         logger.debug(f"✅ get_user: Usuario validado: {user_response.user.email}")
+        _cache_user(token, user_response.user)
         return user_response.user
     except HTTPException:
         raise
@@ -3,14 +3,19 @@ Módulo de utilidades para envío de emails usando Resend (API REST) o SMTP como
 Proporciona funciones para enviar emails genéricos y notificaciones al administrador.
 """
 import os
+import atexit
 import smtplib
 import time
+import logging
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from typing import Optional
+from typing import Optional, List, Dict
 from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
+
 # Intentar importar Resend
 try:
     import resend
@@ -114,6 +119,27 @@ if not RESEND_AVAILABLE_AND_CONFIGURED and not SMTP_AVAILABLE:
     print("   Configura RESEND_API_KEY (recomendado) o SMTP_HOST, SMTP_USER, SMTP_PASS, EMAIL_FROM")
 
 
+# Pool persistente para enviar emails fuera de la request (en lugar de crear un
+# hilo nuevo por cada email). 4 hilos acotan las conexiones simultáneas a
+# Resend/SMTP aunque muchos usuarios crucen un umbral a la vez.
+_EMAIL_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="email")
+atexit.register(_EMAIL_EXECUTOR.shutdown, wait=False)
+
+
+def submit_email_task(func, *args, **kwargs):
+    """
+    Ejecuta una función de envío de emails en el worker persistente de emails.
+    
+    Args:
+        func: Función a ejecutar (debe capturar sus propias excepciones)
+        *args, **kwargs: Argumentos para func
+        
+    Returns:
+        Future de concurrent.futures
+    """
+    return _EMAIL_EXECUTOR.submit(func, *args, **kwargs)
+
+
 def send_email(
     to: str,
     subject: str,
@@ -313,6 +339,34 @@ def _send_email_resend(
         return False
 
 
+def _build_smtp_message(to: str, subject: str, html: str, text: Optional[str] = None) -> MIMEMultipart:
+    """Construye el mensaje MIME (texto plano + HTML) para enviar por SMTP."""
+    msg = MIMEMultipart('alternative')
+    msg['From'] = EMAIL_FROM
+    msg['To'] = to
+    msg['Subject'] = subject
+    
+    # Agregar contenido en texto plano si se proporciona, sino generar desde HTML
+    if text:
+        part_text = MIMEText(text, 'plain', 'utf-8')
+        msg.attach(part_text)
+    else:
+        # Generar texto plano básico desde HTML (remover tags HTML simples)
+        import re
+        text_content = re.sub(r'<[^>]+>', '', html)
+        text_content = text_content.replace('&nbsp;', ' ')
+        text_content = text_content.replace('&amp;', '&')
+        text_content = text_content.replace('&lt;', '<')
+        text_content = text_content.replace('&gt;', '>')
+        part_text = MIMEText(text_content, 'plain', 'utf-8')
+        msg.attach(part_text)
+    
+    # Agregar contenido HTML
+    part_html = MIMEText(html, 'html', 'utf-8')
+    msg.attach(part_html)
+    return msg
+
+
 def _send_email_smtp(
     to: str,
     subject: str,
@@ -336,30 +390,7 @@ def _send_email_smtp(
         return False
     
     try:
-        # Crear mensaje
-        msg = MIMEMultipart('alternative')
-        msg['From'] = EMAIL_FROM
-        msg['To'] = to
-        msg['Subject'] = subject
-        
-        # Agregar contenido en texto plano si se proporciona, sino generar desde HTML
-        if text:
-            part_text = MIMEText(text, 'plain', 'utf-8')
-            msg.attach(part_text)
-        else:
-            # Generar texto plano básico desde HTML (remover tags HTML simples)
-            import re
-            text_content = re.sub(r'<[^>]+>', '', html)
-            text_content = text_content.replace('&nbsp;', ' ')
-            text_content = text_content.replace('&amp;', '&')
-            text_content = text_content.replace('&lt;', '<')
-            text_content = text_content.replace('&gt;', '>')
-            part_text = MIMEText(text_content, 'plain', 'utf-8')
-            msg.attach(part_text)
-        
-        # Agregar contenido HTML
-        part_html = MIMEText(html, 'html', 'utf-8')
-        msg.attach(part_html)
+        msg = _build_smtp_message(to, subject, html, text)
         
         # Conectar al servidor SMTP y enviar
         # Agregar timeout para evitar que se quede colgado
@@ -434,6 +465,60 @@ def send_admin_email(
     )
 
 
+def send_many(messages: List[Dict[str, str]]) -> List[bool]:
+    """
+    Envía varios emails de una vez (p. ej. admin + usuario de la misma operación).
+    
+    Con Resend usa la API de batch (una sola request HTTP); con SMTP abre una
+    única conexión (un handshake TLS y un login) para todos los mensajes. Si el
+    envío agrupado falla, se reintenta email por email con send_email.
+    Como send_email, no lanza excepciones.
+    
+    Args:
+        messages: Lista de dicts con to, subject, html (obligatorios) y opcionalmente text
+        
+    Returns:
+        Lista de bools (True si se envió) en el mismo orden que messages
+    """
+    if not messages:
+        return []
+    
+    if RESEND_AVAILABLE_AND_CONFIGURED:
+        batch_api = getattr(resend, "Batch", None)
+        if batch_api is not None and hasattr(batch_api, "send"):
+            try:
+                _wait_for_rate_limit()
+                batch_api.send([
+                    {"from": EMAIL_FROM, "to": [m["to"]], "subject": m["subject"], "html": m["html"],
+                     **({"text": m["text"]} if m.get("text") else {})}
+                    for m in messages
+                ])
+                logger.info("OK: %d emails enviados en un solo batch usando Resend", len(messages))
+                return [True] * len(messages)
+            except Exception as e:
+                logger.warning("WARNING: Error en batch de Resend, enviando uno por uno: %s", e)
+        return [send_email(**m) for m in messages]
+    
+    if SMTP_AVAILABLE:
+        results: List[bool] = []
+        try:
+            with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30) as server:
+                server.starttls()
+                server.login(SMTP_USER, SMTP_PASS)
+                for m in messages:
+                    server.send_message(_build_smtp_message(m["to"], m["subject"], m["html"], m.get("text")))
+                    results.append(True)
+            logger.info("OK: %d emails enviados en una sola conexión SMTP", len(messages))
+            return results
+        except Exception as e:
+            logger.warning("WARNING: Error en envío SMTP agrupado, enviando uno por uno: %s", e)
+        # Solo los que no llegaron a enviarse
+        return results + [send_email(**m) for m in messages[len(results):]]
+    
+    logger.warning("WARNING: No se puede enviar email: Ni Resend ni SMTP están configurados")
+    return [False] * len(messages)
+
+
 def send_critical_error_email(
     error_type: str,
     error_message: str,
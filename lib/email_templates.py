@@ -0,0 +1,406 @@
+"""
+Plantillas HTML de los emails (alertas de tokens del 80% y 90%, tokens agotados, recargas y checkout).
+
+Las plantillas son constantes de módulo con marcadores {nombre} para
+str.format_map: se cargan una sola vez al importar y en cada envío solo se
+rellenan los valores, en lugar de reconstruir todo el HTML con un f-string.
+"""
+import html
+
+
+def render_email(template: str, **values) -> str:
+    """
+    Rellena una plantilla HTML con los valores dados.
+    
+    Los valores de texto se escapan para HTML; los numéricos se pasan tal cual.
+    """
+    return template.format_map({
+        key: html.escape(value) if isinstance(value, str) else value
+        for key, value in values.items()
+    })
+
+
+
+def format_usage_values(nuevos_tokens: int, tokens_monthly_limit: int, usage_percent: float) -> dict:
+    """
+    Formatea una sola vez las cifras de uso que comparten los emails de alerta
+    (usuario y admin): miles con coma y porcentaje con un decimal.
+    """
+    return {
+        "nuevos_tokens": f"{nuevos_tokens:,}",
+        "tokens_monthly_limit": f"{tokens_monthly_limit:,}",
+        "usage_percent": f"{usage_percent:.1f}",
+    }
+
+
+# Las cifras de uso (tokens_monthly_limit, nuevos_tokens, usage_percent) llegan ya
+# formateadas por format_usage_values.
+
+# Email al admin cuando un usuario alcanza el 80% de su límite mensual
+# Valores: user_email, user_id, current_plan, tokens_monthly_limit, nuevos_tokens, usage_percent, fecha
+ADMIN_80_PERCENT_HTML = """\
+<html>
+<body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
+    <div style="background: linear-gradient(135deg, #f59e0b 0%, #d97706 100%); padding: 20px; text-align: center; border-radius: 10px 10px 0 0;">
+        <h2 style="color: white; margin: 0; font-size: 24px;">⚠️ Alerta: Usuario alcanzó 80% de límite</h2>
+    </div>
+
+    <div style="background: #ffffff; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
+        <p style="font-size: 16px; margin-bottom: 20px;">
+            Un usuario ha alcanzado el <strong>80% de su límite mensual de tokens</strong>.
+        </p>
+
+        <div style="background: #fef3c7; padding: 20px; border-radius: 8px; margin: 20px 0; border-left: 4px solid #f59e0b;">
+            <ul style="list-style: none; padding: 0; margin: 0;">
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #92400e;">Email del usuario:</strong> 
+                    <span style="color: #333;">{user_email}</span>
+                </li>
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #92400e;">ID de usuario:</strong> 
+                    <span style="color: #333; font-family: monospace; font-size: 12px;">{user_id}</span>
+                </li>
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #92400e;">Plan actual:</strong> 
+                    <span style="color: #333;">{current_plan}</span>
+                </li>
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #92400e;">Límite mensual:</strong> 
+                    <span style="color: #333;">{tokens_monthly_limit} tokens</span>
+                </li>
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #92400e;">Tokens restantes:</strong> 
+                    <span style="color: #333;">{nuevos_tokens} tokens</span>
+                </li>
+                <li style="margin-bottom: 0;">
+                    <strong style="color: #92400e;">Porcentaje usado:</strong> 
+                    <span style="color: #d97706; font-weight: bold; font-size: 18px;">{usage_percent}%</span>
+                </li>
+            </ul>
+        </div>
+
+        <p style="font-size: 14px; color: #666; margin-top: 20px;">
+            <strong>Nota:</strong> El usuario recibirá un aviso suave. Si alcanza el 90%, será elegible para un descuento del 20%.
+        </p>
+
+        <p style="font-size: 12px; color: #666; margin-top: 20px; text-align: center;">
+            Fecha: {fecha} UTC
+        </p>
+    </div>
+</body>
+</html>
+"""
+
+# Email al usuario cuando alcanza el 90% de su límite (oferta de descuento)
+# Valores: plan_name, nuevos_tokens, tokens_monthly_limit, usage_percent, planes_url
+USER_90_PERCENT_HTML = """\
+<html>
+<body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
+    <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 30px; text-align: center; border-radius: 12px;">
+        <h1 style="color: white; margin: 0;">🚨 Alerta de Uso</h1>
+    </div>
+    <div style="background: white; padding: 30px; border-radius: 8px; margin-top: 20px;">
+        <p>Has alcanzado el <strong>90% de tu límite</strong> en tu plan <strong>{plan_name}</strong>.</p>
+        <div style="background: #f0fdf4; padding: 20px; border-radius: 8px; margin: 20px 0;">
+            <p><strong>📊 Tu uso actual:</strong></p>
+            <p>Tokens restantes: <strong>{nuevos_tokens}</strong> de <strong>{tokens_monthly_limit}</strong></p>
+            <p>Porcentaje usado: <strong>{usage_percent}%</strong></p>
+        </div>
+        <div style="background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%); color: white; padding: 25px; border-radius: 10px; text-align: center; margin: 25px 0;">
+            <h2 style="margin: 0 0 10px 0;">🎁 ¡Descuento Especial del 20%!</h2>
+            <p>Te ofrecemos un <strong>20% de descuento</strong> para actualizar tu plan.</p>
+            <div style="background: white; color: #f5576c; padding: 15px 30px; border-radius: 8px; font-size: 24px; font-weight: bold; margin: 15px 0; display: inline-block;">CUPON20</div>
+        </div>
+        <div style="text-align: center; margin: 30px 0;">
+            <a href="{planes_url}" style="display: inline-block; background: #667eea; color: white; padding: 15px 40px; text-decoration: none; border-radius: 8px; font-weight: bold;">Ver Planes y Aprovechar Descuento</a>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+
+# Email al admin cuando un usuario alcanza el 90% de su límite mensual
+# Valores: user_email, user_id, plan_name, usage_percent
+ADMIN_90_PERCENT_HTML = """\
+<html>
+<body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
+    <div style="background: linear-gradient(135deg, #ef4444 0%, #dc2626 100%); padding: 20px; text-align: center; border-radius: 10px 10px 0 0;">
+        <h2 style="color: white; margin: 0; font-size: 24px;">🚨 ALERTA CRÍTICA: Usuario alcanzó 90% de límite</h2>
+    </div>
+
+    <div style="background: #ffffff; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
+        <p>Un usuario ha alcanzado el <strong>90% de su límite mensual de tokens</strong>.</p>
+        <div style="background: #fee2e2; padding: 20px; border-radius: 8px; margin: 20px 0;">
+            <p><strong>Email:</strong> {user_email}</p>
+            <p><strong>ID:</strong> {user_id}</p>
+            <p><strong>Plan:</strong> {plan_name}</p>
+            <p><strong>Uso:</strong> {usage_percent}%</p>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+
+# Email al usuario cuando sus tokens se agotan
+# Valores: user_name, billing_url
+TOKENS_EXHAUSTED_HTML = """\
+<html>
+<body style="font-family: Arial, sans-serif; line-height: 1.8; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
+    <div style="background: linear-gradient(135deg, #ef4444 0%, #dc2626 100%); padding: 30px; text-align: center; border-radius: 10px 10px 0 0;">
+        <h1 style="color: white; margin: 0; font-size: 28px;">⚠️ Tus Tokens se Han Agotado</h1>
+    </div>
+
+    <div style="background: #ffffff; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
+        <p style="font-size: 16px; margin-bottom: 20px;">
+            Hola <strong>{user_name}</strong>,
+        </p>
+
+        <p style="font-size: 16px; margin-bottom: 20px;">
+            Te informamos que tus tokens se han agotado. Para continuar usando Codex Trader, necesitas recargar tokens.
+        </p>
+
+        <div style="background: #fee2e2; padding: 20px; border-radius: 8px; border-left: 4px solid #ef4444; margin: 20px 0;">
+            <p style="margin: 0; color: #991b1b; font-weight: bold; font-size: 18px;">
+                Tokens restantes: 0
+            </p>
+        </div>
+
+        <div style="background: #f0fdf4; padding: 20px; border-radius: 8px; margin: 20px 0; border-left: 4px solid #10b981;">
+            <h3 style="color: #059669; margin-top: 0; font-size: 18px;">💡 Opciones para continuar:</h3>
+            <ul style="margin: 10px 0; padding-left: 20px; color: #333;">
+                <li style="margin-bottom: 10px;">Recargar tokens desde tu panel de cuenta</li>
+                <li style="margin-bottom: 10px;">Actualizar a un plan con más tokens mensuales</li>
+                <li style="margin-bottom: 0;">Contactarnos si necesitas ayuda</li>
+            </ul>
+        </div>
+
+        <div style="text-align: center; margin: 30px 0;">
+            <a href="{billing_url}" style="display: inline-block; background: #10b981; color: white; padding: 15px 30px; text-decoration: none; border-radius: 8px; font-weight: bold; font-size: 16px;">
+                💰 Recargar Tokens
+            </a>
+        </div>
+
+        <p style="font-size: 12px; margin-top: 30px; color: #666; text-align: center; border-top: 1px solid #e5e7eb; padding-top: 20px; line-height: 1.6;">
+            Si tienes alguna pregunta, no dudes en contactarnos respondiendo a este correo.
+        </p>
+    </div>
+</body>
+</html>
+"""
+
+
+# Email al admin cuando un usuario recarga tokens
+# Valores: user_email, user_id, tokens_actuales, cantidad, nuevos_tokens, fecha
+RELOAD_ADMIN_HTML = """\
+<html>
+<body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
+    <div style="background: linear-gradient(135deg, #2563eb 0%, #1e40af 100%); padding: 20px; text-align: center; border-radius: 10px 10px 0 0;">
+        <h2 style="color: white; margin: 0; font-size: 24px;">💰 Recarga de Tokens</h2>
+    </div>
+
+    <div style="background: #ffffff; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
+        <p style="font-size: 16px; margin-bottom: 20px;">
+            Un usuario ha recargado tokens en Codex Trader.
+        </p>
+
+        <div style="background: #f9fafb; padding: 20px; border-radius: 8px; margin: 20px 0;">
+            <ul style="list-style: none; padding: 0; margin: 0;">
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #2563eb;">Email del usuario:</strong>
+                    <span style="color: #333;">{user_email}</span>
+                </li>
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #2563eb;">ID de usuario:</strong>
+                    <span style="color: #333; font-family: monospace; font-size: 12px;">{user_id}</span>
+                </li>
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #2563eb;">Tokens anteriores:</strong>
+                    <span style="color: #333;">{tokens_actuales:,}</span>
+                </li>
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #2563eb;">Tokens recargados:</strong>
+                    <span style="color: #10b981; font-weight: bold;">+{cantidad:,}</span>
+                </li>
+                <li style="margin-bottom: 0;">
+                    <strong style="color: #2563eb;">Tokens totales ahora:</strong>
+                    <span style="color: #333; font-weight: bold; font-size: 18px;">{nuevos_tokens:,}</span>
+                </li>
+            </ul>
+        </div>
+
+        <p style="font-size: 12px; color: #666; margin-top: 20px; text-align: center;">
+            Fecha: {fecha} UTC
+        </p>
+    </div>
+</body>
+</html>
+"""
+
+
+# Email de confirmación al usuario cuando recarga tokens
+# Valores: user_name, tokens_actuales, cantidad, nuevos_tokens, app_url
+RELOAD_USER_HTML = """\
+<html>
+<body style="font-family: Arial, sans-serif; line-height: 1.8; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
+    <div style="background: linear-gradient(135deg, #10b981 0%, #059669 100%); padding: 30px; text-align: center; border-radius: 10px 10px 0 0;">
+        <h1 style="color: white; margin: 0; font-size: 28px;">✅ Tokens Recargados Exitosamente</h1>
+    </div>
+
+    <div style="background: #ffffff; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
+        <p style="font-size: 16px; margin-bottom: 20px;">
+            Hola <strong>{user_name}</strong>,
+        </p>
+
+        <p style="font-size: 16px; margin-bottom: 20px;">
+            Tu recarga de tokens se ha procesado correctamente.
+        </p>
+
+        <div style="background: #f0fdf4; padding: 20px; border-radius: 8px; border-left: 4px solid #10b981; margin: 20px 0;">
+            <ul style="list-style: none; padding: 0; margin: 0;">
+                <li style="margin-bottom: 10px; color: #333;">
+                    <strong>Tokens anteriores:</strong> {tokens_actuales:,}
+                </li>
+                <li style="margin-bottom: 10px; color: #333;">
+                    <strong>Tokens recargados:</strong> <span style="color: #10b981; font-weight: bold;">+{cantidad:,}</span>
+                </li>
+                <li style="margin-bottom: 0; color: #333;">
+                    <strong>Tokens totales ahora:</strong> <span style="color: #059669; font-weight: bold; font-size: 20px;">{nuevos_tokens:,}</span>
+                </li>
+            </ul>
+        </div>
+
+        <div style="text-align: center; margin: 30px 0;">
+            <a href="{app_url}" style="display: inline-block; background: #10b981; color: white; padding: 15px 30px; text-decoration: none; border-radius: 8px; font-weight: bold; font-size: 16px;">
+                🚀 Continuar usando Codex Trader
+            </a>
+        </div>
+
+        <p style="font-size: 12px; margin-top: 30px; color: #666; text-align: center; border-top: 1px solid #e5e7eb; padding-top: 20px; line-height: 1.6;">
+            Si no realizaste esta recarga, por favor contáctanos respondiendo a este correo.
+        </p>
+    </div>
+</body>
+</html>
+"""
+
+
+# Email al admin cuando un usuario completa el checkout de Stripe
+# Valores: user_email, user_id, plan_name, plan_code, tokens_per_month, customer_id, subscription_id, amount_usd, fecha
+CHECKOUT_ADMIN_HTML = """\
+<html>
+<body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
+    <div style="background: linear-gradient(135deg, #10b981 0%, #059669 100%); padding: 20px; text-align: center; border-radius: 10px 10px 0 0;">
+        <h2 style="color: white; margin: 0; font-size: 24px;">🎉 Nueva Compra - Checkout Completado</h2>
+    </div>
+
+    <div style="background: #ffffff; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
+        <p style="font-size: 16px; margin-bottom: 20px;">
+            Un usuario ha completado el checkout y activado su suscripción en Codex Trader.
+        </p>
+
+        <div style="background: #f0fdf4; padding: 20px; border-radius: 8px; margin: 20px 0; border-left: 4px solid #10b981;">
+            <ul style="list-style: none; padding: 0; margin: 0;">
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #059669;">Email del usuario:</strong> 
+                    <span style="color: #333;">{user_email}</span>
+                </li>
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #059669;">ID de usuario:</strong> 
+                    <span style="color: #333; font-family: monospace; font-size: 12px;">{user_id}</span>
+                </li>
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #059669;">Plan adquirido:</strong> 
+                    <span style="color: #333; font-weight: bold;">{plan_name} ({plan_code})</span>
+                </li>
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #059669;">Tokens asignados:</strong> 
+                    <span style="color: #333;">{tokens_per_month:,} tokens</span>
+                </li>
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #059669;">Customer ID (Stripe):</strong> 
+                    <span style="color: #333; font-family: monospace; font-size: 12px;">{customer_id}</span>
+                </li>
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #059669;">Subscription ID (Stripe):</strong> 
+                    <span style="color: #333; font-family: monospace; font-size: 12px;">{subscription_id}</span>
+                </li>
+                <li style="margin-bottom: 0;">
+                    <strong style="color: #059669;">Monto pagado:</strong> 
+                    <span style="color: #10b981; font-weight: bold; font-size: 18px;">${amount_usd:.2f} USD</span>
+                </li>
+            </ul>
+        </div>
+
+        <p style="font-size: 12px; color: #666; margin-top: 20px; text-align: center;">
+            Fecha: {fecha} UTC
+        </p>
+    </div>
+</body>
+</html>
+"""
+
+
+# Email de confirmación al usuario cuando completa el checkout de Stripe
+# Valores: user_email, plan_name, tokens_per_month, plan_price, next_renewal_str, app_url
+CHECKOUT_USER_HTML = """\
+<html>
+<body style="font-family: Arial, sans-serif; line-height: 1.8; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
+    <div style="background: linear-gradient(135deg, #10b981 0%, #059669 100%); padding: 30px; text-align: center; border-radius: 10px 10px 0 0;">
+        <h1 style="color: white; margin: 0; font-size: 28px;">¡Pago Exitoso! 🎉</h1>
+    </div>
+
+    <div style="background: #ffffff; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
+        <p style="font-size: 16px; margin-bottom: 20px;">
+            Hola <strong>{user_email}</strong>,
+        </p>
+
+        <p style="font-size: 16px; margin-bottom: 20px;">
+            ¡Gracias por tu compra! Tu suscripción a <strong>{plan_name}</strong> ha sido activada exitosamente.
+        </p>
+
+        <div style="background: #f0fdf4; padding: 20px; border-radius: 8px; margin: 20px 0; border-left: 4px solid #10b981;">
+            <h3 style="color: #059669; margin-top: 0;">Detalles de tu suscripción:</h3>
+            <ul style="list-style: none; padding: 0; margin: 0;">
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #059669;">Plan:</strong> 
+                    <span style="color: #333; font-weight: bold;">{plan_name}</span>
+                </li>
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #059669;">Tokens recibidos:</strong> 
+                    <span style="color: #10b981; font-weight: bold; font-size: 18px;">{tokens_per_month:,} tokens</span>
+                </li>
+                <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <strong style="color: #059669;">Monto pagado:</strong> 
+                    <span style="color: #333; font-weight: bold;">${plan_price:.2f} USD</span>
+                </li>
+                <li style="margin-bottom: 0;">
+                    <strong style="color: #059669;">Próxima renovación:</strong> 
+                    <span style="color: #333;">{next_renewal_str}</span>
+                </li>
+            </ul>
+        </div>
+
+        <div style="text-align: center; margin: 30px 0;">
+            <a href="{app_url}" style="display: inline-block; background: #10b981; color: white; padding: 15px 30px; text-decoration: none; border-radius: 8px; font-weight: bold; font-size: 16px;">
+                🚀 Empezar a usar Codex Trader
+            </a>
+        </div>
+
+        <p style="font-size: 14px; color: #666; margin-top: 30px;">
+            <strong>¿Qué puedes hacer ahora?</strong>
+        </p>
+        <ul style="color: #333; line-height: 1.8;">
+            <li>Hacer consultas al asistente de IA especializado en trading</li>
+            <li>Acceder a tu biblioteca profesional de contenido</li>
+            <li>Ver tu uso de tokens en el panel de cuenta</li>
+        </ul>
+
+        <p style="font-size: 12px; color: #666; margin-top: 30px; text-align: center; border-top: 1px solid #e5e7eb; padding-top: 20px;">
+            Si no reconoces este pago, contáctanos respondiendo a este correo.
+        </p>
+    </div>
+</body>
+</html>
+"""
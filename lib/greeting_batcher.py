@@ -0,0 +1,142 @@
+"""
+Micro-batching de saludos: agrupa saludos simples que llegan casi a la vez en
+una sola llamada al modelo, para no pagar el system prompt una vez por saludo.
+"""
+import re
+import asyncio
+import logging
+from typing import Optional, Dict, Any, Tuple, List
+
+import config
+from lib import llm_provider
+
+logger = logging.getLogger(__name__)
+
+# Instrucción añadida al system prompt de saludos cuando se responde en lote
+_BATCH_INSTRUCTION = """
+
+Vas a recibir varios mensajes numerados de usuarios distintos ("1) ...", "2) ...").
+Responde a CADA uno por separado, en el mismo orden, empezando cada respuesta en
+una línea nueva con su número: "1) ...", "2) ...". No añadas nada más."""
+
+_NUMBERED_LINE = re.compile(r"^\s*(\d+)\)\s*", re.MULTILINE)
+
+
+def _split_numbered_answers(content: str, expected: int) -> List[Optional[str]]:
+    """Separa la respuesta del lote por su prefijo numérico ("1) ...")."""
+    answers: List[Optional[str]] = [None] * expected
+    matches = list(_NUMBERED_LINE.finditer(content))
+    for i, match in enumerate(matches):
+        index = int(match.group(1)) - 1
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(content)
+        answer = content[match.end():end].strip()
+        if 0 <= index < expected and answer:
+            answers[index] = answer
+    return answers
+
+
+class GreetingBatcher:
+    """Agrupa saludos en ventanas de `flush_after_ms` hasta `max_batch` mensajes."""
+
+    def __init__(self, flush_after_ms: int = 50, max_batch: int = 8):
+        self.enabled = config.GREETING_BATCH_ENABLED
+        self.flush_after = flush_after_ms / 1000
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, query: str, litellm_params: Dict[str, Any]) -> Optional[Tuple[str, Dict[str, int]]]:
+        """
+        Encola un saludo y espera su respuesta del lote.
+
+        Returns:
+            Tuple[respuesta, usage] con la parte proporcional de tokens, o None si
+            el saludo llegó solo o el lote falló (se responde con el flujo normal).
+        """
+        if self._worker is None or self._worker.done():
+            if self._queue is not None:
+                # Saludos que quedaron en la cola del worker anterior: al flujo normal
+                _resolve_pending(self._queue)
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._collect())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((future, query, litellm_params))
+        return await future
+
+    async def _collect(self):
+        """Tarea única que forma los lotes y lanza cada uno sin bloquear la cola."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                deadline = loop.time() + self.flush_after
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                # Un saludo solo no se agrupa: calidad y latencia iguales al flujo normal
+                if len(batch) == 1:
+                    if not batch[0][0].done():
+                        batch[0][0].set_result(None)
+                    continue
+
+                asyncio.create_task(self._answer_batch(batch))
+            except Exception as e:
+                # Un saludo problemático no debe tumbar el worker
+                logger.warning(f"⚠️ Error formando lote de saludos: {e}")
+                for future, _, _ in batch:
+                    if not future.done():
+                        future.set_result(None)
+
+    async def _answer_batch(self, batch: List[Tuple[asyncio.Future, str, Dict[str, Any]]]):
+        size = len(batch)
+        try:
+            params = dict(batch[0][2])
+            params.pop("stream_options", None)
+            params["stream"] = False
+            params["max_tokens"] = params["max_tokens"] * size
+            params["messages"] = [
+                {"role": "system", "content": params["messages"][0]["content"] + _BATCH_INSTRUCTION},
+                {"role": "user", "content": "\n".join(f"{i}) {query}" for i, (_, query, _) in enumerate(batch, 1))}
+            ]
+
+            response = await llm_provider.acompletion(params)
+            content = response.choices[0].message.content or ""
+            answers = _split_numbered_answers(content, size)
+
+            usage = getattr(response, "usage", None)
+            input_share = (getattr(usage, "prompt_tokens", 0) or 0) // size
+            output_share = (getattr(usage, "completion_tokens", 0) or 0) // size
+            usage_share = {
+                "input_tokens": input_share,
+                "output_tokens": output_share,
+                "total_tokens": input_share + output_share
+            }
+
+            logger.info(f"👋 Lote de {size} saludos respondido en una sola llamada")
+            for (future, _, _), answer in zip(batch, answers):
+                if not future.done():
+                    future.set_result((answer, usage_share) if answer else None)
+        except Exception as e:
+            logger.warning(f"⚠️ Error en lote de saludos, se responden individualmente: {e}")
+            for future, _, _ in batch:
+                if not future.done():
+                    future.set_result(None)
+
+
+def _resolve_pending(queue: asyncio.Queue):
+    """Resuelve con None los saludos que siguen en la cola (se responden individualmente)."""
+    while not queue.empty():
+        future, _, _ = queue.get_nowait()
+        if not future.done():
+            future.set_result(None)
+
+
+# Instancia global del batcher
+greeting_batcher = GreetingBatcher()
@@ -0,0 +1,152 @@
+"""
+Despacho de llamadas de chat a los proveedores de IA.
+
+OpenAI y Deepseek (API compatible con OpenAI) se llaman directamente con el SDK
+asíncrono de OpenAI sobre un httpx.AsyncClient compartido (HTTP/2 si el paquete
+h2 está instalado). El resto de modelos (Claude, Gemini, Cohere...) sigue
+pasando por LiteLLM.
+"""
+import os
+import logging
+from functools import lru_cache
+from typing import Optional, Dict, Any, Tuple
+
+import litellm
+
+logger = logging.getLogger(__name__)
+
+# Permite desactivar el camino directo y usar siempre LiteLLM
+LLM_DIRECT_SDK_ENABLED = os.getenv("LLM_DIRECT_SDK", "true").strip().lower() not in ("0", "false", "no")
+
+DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com").strip('"').strip("'").strip()
+
+# HTTP/2 solo si el paquete h2 está disponible (httpx lo requiere)
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Conteo local de tokens (tiktoken viene con litellm; si falta se estima len // 4)
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+# Cliente HTTP y clientes de SDK compartidos entre requests (se crean al primer uso)
+_http_client = None
+_sdk_clients: Dict[str, Any] = {}
+
+
+def _resolve_direct_provider(model: str) -> Optional[Tuple[str, str]]:
+    """
+    Determina si el modelo se puede llamar con el SDK de OpenAI.
+
+    Returns:
+        Tuple[provider, model_name] ("openai" o "deepseek", nombre sin prefijo
+        de LiteLLM), o None si debe usarse LiteLLM.
+    """
+    model_lower = model.lower()
+    if model_lower.startswith("deepseek/"):
+        return "deepseek", model.split("/", 1)[1]
+    if model_lower.startswith("deepseek"):
+        return "deepseek", model
+    if model_lower.startswith("openai/"):
+        return "openai", model.split("/", 1)[1]
+    if model_lower.startswith(("gpt", "o1", "o3", "o4")):
+        return "openai", model
+    return None
+
+
+@lru_cache(maxsize=16)
+def _get_encoding(model: str):
+    """Encoder de tiktoken para el modelo (cl100k_base si no es un modelo de OpenAI)."""
+    try:
+        return tiktoken.encoding_for_model(model.split("/", 1)[-1])
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Cuenta los tokens de un texto para el modelo dado.
+
+    Se usa cuando el proveedor no devuelve usage. Con tiktoken el conteo es
+    exacto para OpenAI y una buena aproximación para el resto; sin tiktoken se
+    usa la estimación clásica de 4 caracteres por token.
+    """
+    if not text:
+        return 0
+    if TIKTOKEN_AVAILABLE:
+        try:
+            return len(_get_encoding(model).encode(text, disallowed_special=()))
+        except Exception as e:
+            logger.debug(f"No se pudo contar tokens con tiktoken: {e}")
+    return len(text) // 4
+
+
+def supports_stream_usage(model: str) -> bool:
+    """Indica si el proveedor acepta stream_options={"include_usage": True}."""
+    return _resolve_direct_provider(model) is not None
+
+
+def _get_http_client():
+    """Devuelve el httpx.AsyncClient compartido (pool de conexiones keep-alive)."""
+    global _http_client
+    if _http_client is None:
+        import httpx
+        _http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=256, max_keepalive_connections=64),
+            timeout=httpx.Timeout(600.0, connect=10.0)
+        )
+        logger.info(f"🔌 Cliente HTTP para proveedores de IA creado (HTTP/2: {'sí' if HTTP2_AVAILABLE else 'no'})")
+    return _http_client
+
+
+def _get_sdk_client(provider: str, api_key: str):
+    """Devuelve (y cachea) el cliente AsyncOpenAI para el proveedor."""
+    client = _sdk_clients.get(provider)
+    if client is None or client.api_key != api_key:
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=DEEPSEEK_BASE_URL if provider == "deepseek" else None,
+            http_client=_get_http_client()
+        )
+        _sdk_clients[provider] = client
+    return client
+
+
+async def acompletion(litellm_params: Dict[str, Any]):
+    """
+    Ejecuta una completion de chat con los mismos parámetros que litellm.acompletion.
+
+    Para OpenAI/Deepseek traduce los parámetros al SDK de OpenAI; los chunks
+    de streaming tienen la misma forma (choices[0].delta.content, usage).
+
+    Args:
+        litellm_params: Parámetros en formato LiteLLM (model, messages, api_key, ...)
+
+    Returns:
+        Respuesta o stream asíncrono del proveedor
+    """
+    direct = _resolve_direct_provider(litellm_params["model"]) if LLM_DIRECT_SDK_ENABLED else None
+    api_key = litellm_params.get("api_key")
+
+    if direct and api_key:
+        provider, model_name = direct
+        try:
+            client = _get_sdk_client(provider, api_key)
+        except ImportError:
+            logger.warning("⚠️ SDK de OpenAI no disponible, usando LiteLLM")
+        else:
+            request_params = {
+                key: value
+                for key, value in litellm_params.items()
+                if key not in ("model", "api_key")
+            }
+            return await client.chat.completions.create(model=model_name, **request_params)
+
+    return await litellm.acompletion(**litellm_params)
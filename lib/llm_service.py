@@ -2,11 +2,14 @@
 Servicio para llamadas a modelos de IA (LiteLLM): construcción de prompts y streaming.
 """
 import os
+import json
+import asyncio
+import hashlib
 import logging
+from functools import lru_cache
 from typing import Optional, Dict, Any, AsyncGenerator, Tuple
 
 from fastapi import HTTPException
-import litellm
 
 from lib.config_shared import (
     modelo_por_defecto,
@@ -14,56 +17,25 @@ from lib.config_shared import (
     GOOGLE_API_KEY, COHERE_API_KEY
 )
 import config
+from lib.business import is_deep_response_mode
+from lib import llm_provider
+from lib.greeting_batcher import greeting_batcher
+
+# orjson (opcional) para la clave de deduplicación y la caché en disco
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 logger = logging.getLogger(__name__)
 
+# =============================================================================
+# PROMPTS ESTÁTICOS
+# =============================================================================
+# Se definen a nivel de módulo para no reconstruirlos en cada request de /chat.
 
-class LLMService:
-    """Servicio para generar respuestas usando modelos de IA."""
-    
-    def __init__(self):
-        self.default_model = modelo_por_defecto
-        self.api_keys = {
-            "deepseek": DEEPSEEK_API_KEY,
-            "openai": OPENAI_API_KEY,
-            "anthropic": ANTHROPIC_API_KEY,
-            "google": GOOGLE_API_KEY,
-            "cohere": COHERE_API_KEY
-        }
-    
-    def get_chat_model(self) -> str:
-        """Obtiene el modelo de chat a usar."""
-        chat_model = self.default_model
-        if not chat_model:
-            if DEEPSEEK_API_KEY:
-                chat_model = "deepseek/deepseek-chat"
-            else:
-                chat_model = "gpt-3.5-turbo"
-        return chat_model
-    
-    def _build_system_prompt(
-        self,
-        context: str,
-        citation_list: str,
-        is_greeting: bool,
-        response_mode: str,
-        is_deep_mode: bool
-    ) -> Tuple[str, int]:
-        """
-        Construye el system prompt según el contexto y modo.
-        
-        Args:
-            context: Contexto RAG recuperado
-            citation_list: Lista de citaciones (solo en modo deep)
-            is_greeting: Si es un saludo simple
-            response_mode: Modo de respuesta ('fast' o 'deep')
-            is_deep_mode: Si está en modo estudio profundo
-            
-        Returns:
-            Tuple[system_prompt, max_tokens]
-        """
-        if is_greeting:
-            system_prompt = """Eres CODEX TRADER, un asistente de IA especializado en trading.
+_GREETING_SYSTEM_PROMPT = """Eres CODEX TRADER, un asistente de IA especializado en trading.
 
 INSTRUCCIONES PARA SALUDOS:
 - Responde SOLO con 1-2 frases muy cortas
@@ -76,86 +48,8 @@ INSTRUCCIONES PARA SALUDOS:
 Ejemplo: "¡Hola! Soy Codex Trader, tu asistente de IA especializado en trading. Puedo ayudarte con gestión de riesgo, análisis técnico, psicología del trader y diseño de estrategias. ¿Sobre qué tema de trading te gustaría que empecemos?"
 
 Responde siempre en español."""
-            return system_prompt, 100
-        
-        # Construir instrucciones según el modo
-        greetings_instruction = self._get_greetings_instruction()
-        mode_instruction = self._get_mode_instruction(response_mode)
-        
-        if is_deep_mode and citation_list:
-            # Modo Estudio Profundo con citaciones
-            system_prompt = f"""Eres Codex Trader, un experto financiero y asistente de RAG. Tu tarea es responder a la pregunta del usuario basándote en el contexto proporcionado.
-
-Sigue estrictamente estas reglas:
-
-1. **PRIORIDAD 1 - Usar RAG**: Si el contexto recuperado contiene información relevante para responder la pregunta, úsalo como base principal de tu respuesta.
 
-2. **PRIORIDAD 2 - Complementar con conocimiento general**: Si el contexto recuperado es insuficiente o no cubre completamente la pregunta, complementa tu respuesta usando tu conocimiento general sobre trading, pero siempre menciona primero lo que encontraste en el contexto.
-
-3. **PRIORIDAD 3 - Usar solo conocimiento general**: Si el contexto recuperado NO contiene información relevante para la pregunta (por ejemplo, si la pregunta es sobre un tema completamente diferente), entonces:
-   - NO digas "no puedo responder" o "el contexto no contiene información"
-   - En su lugar, usa tu conocimiento general para dar una respuesta completa y útil
-   - Al final, menciona brevemente que esta información proviene de conocimiento general sobre trading
-
-4. POR CADA HECHO del contexto RAG que utilices, debes **citar inmediatamente la fuente** usando el formato [X] al final de la frase, donde X es el número de la fuente.
-
-5. Al final de la respuesta, bajo el encabezado '**Fuentes Utilizadas:**', lista todas las fuentes del RAG citadas en el formato [X] Nombre del libro. Si solo usaste conocimiento general, omite esta sección.
-
-Contexto Recuperado:
-
----
-
-{context}
-
----
-
-Fuentes a Listar:
-
----
-
-{citation_list}
-
----
-
-"""
-            return system_prompt, 4000
-        else:
-            # Modo Rápido o sin citaciones
-            if context:
-                # Hay contexto RAG disponible
-                context_section = f"""
-Contexto Recuperado:
-
----
-
-{context}
-
----
-
-INSTRUCCIONES:
-- Usa el contexto recuperado como base principal de tu respuesta
-- Si el contexto es insuficiente o no cubre completamente la pregunta, complementa con tu conocimiento general sobre trading
-- Si el contexto NO es relevante para la pregunta, usa tu conocimiento general para responder completamente
-- NO digas "no puedo responder" - siempre proporciona una respuesta útil
-
-"""
-            else:
-                # No hay contexto RAG - usar conocimiento general
-                context_section = """
-INSTRUCCIONES:
-- No hay contexto RAG disponible para esta pregunta
-- Usa tu conocimiento general sobre trading para responder completamente
-- Proporciona una respuesta útil y detallada según el modo seleccionado
-
-"""
-            base_prompt = config.ASSISTANT_DESCRIPTION + '\n\n' + greetings_instruction + '\n\n' + mode_instruction
-            system_prompt = base_prompt + context_section
-            max_tokens = 300 if response_mode == 'fast' else 4000
-            return system_prompt, max_tokens
-    
-    def _get_greetings_instruction(self) -> str:
-        """Retorna las instrucciones para manejo de saludos."""
-        return """
+_GREETINGS_INSTRUCTION = """
 
 REGLA CRÍTICA SOBRE SALUDOS (OBEDECE ESTO SIEMPRE):
 
@@ -223,11 +117,8 @@ REGLA CRÍTICA SOBRE SALUDOS (OBEDECE ESTO SIEMPRE):
 
    - Aplica el modo de respuesta (Rápida o Estudio profundo) según corresponda.
 """
-    
-    def _get_mode_instruction(self, response_mode: str) -> str:
-        """Retorna las instrucciones según el modo de respuesta."""
-        if response_mode == 'fast':
-            return """
+
+_MODE_FAST = """
 
 ═══════════════════════════════════════════════════════════════
 MODO: RESPUESTA RÁPIDA (OBLIGATORIO - RESPETA ESTO ESTRICTAMENTE)
@@ -250,8 +141,8 @@ EJEMPLO DE LONGITUD CORRECTA:
 
 Si excedes 2 párrafos, estás violando el modo Rápida.
 """
-        else:  # 'deep'
-            return """
+
+_MODE_DEEP = """
 
 ═══════════════════════════════════════════════════════════════
 MODO: ESTUDIO PROFUNDO (OBLIGATORIO - RESPETA ESTO ESTRICTAMENTE)
@@ -290,51 +181,343 @@ EJEMPLO DE ESTRUCTURA:
 
 Si tienes menos de 5 párrafos, estás violando el modo Estudio Profundo.
 """
+
+# Plantilla de modo Estudio Profundo con citaciones ({context}, {citation_list})
+_SYSTEM_PROMPT_DEEP_TEMPLATE = """Eres Codex Trader, un experto financiero y asistente de RAG. Tu tarea es responder a la pregunta del usuario basándote en el contexto proporcionado.
+
+Sigue estrictamente estas reglas:
+
+1. **PRIORIDAD 1 - Usar RAG**: Si el contexto recuperado contiene información relevante para responder la pregunta, úsalo como base principal de tu respuesta.
+
+2. **PRIORIDAD 2 - Complementar con conocimiento general**: Si el contexto recuperado es insuficiente o no cubre completamente la pregunta, complementa tu respuesta usando tu conocimiento general sobre trading, pero siempre menciona primero lo que encontraste en el contexto.
+
+3. **PRIORIDAD 3 - Usar solo conocimiento general**: Si el contexto recuperado NO contiene información relevante para la pregunta (por ejemplo, si la pregunta es sobre un tema completamente diferente), entonces:
+   - NO digas "no puedo responder" o "el contexto no contiene información"
+   - En su lugar, usa tu conocimiento general para dar una respuesta completa y útil
+   - Al final, menciona brevemente que esta información proviene de conocimiento general sobre trading
+
+4. POR CADA HECHO del contexto RAG que utilices, debes **citar inmediatamente la fuente** usando el formato [X] al final de la frase, donde X es el número de la fuente.
+
+5. Al final de la respuesta, bajo el encabezado '**Fuentes Utilizadas:**', lista todas las fuentes del RAG citadas en el formato [X] Nombre del libro. Si solo usaste conocimiento general, omite esta sección.
+
+Contexto Recuperado:
+
+---
+
+{context}
+
+---
+
+Fuentes a Listar:
+
+---
+
+{citation_list}
+
+---
+
+"""
+
+# Sección de contexto para modo Rápido ({context})
+_CONTEXT_SECTION_TEMPLATE = """
+Contexto Recuperado:
+
+---
+
+{context}
+
+---
+
+INSTRUCCIONES:
+- Usa el contexto recuperado como base principal de tu respuesta
+- Si el contexto es insuficiente o no cubre completamente la pregunta, complementa con tu conocimiento general sobre trading
+- Si el contexto NO es relevante para la pregunta, usa tu conocimiento general para responder completamente
+- NO digas "no puedo responder" - siempre proporciona una respuesta útil
+
+"""
+
+_NO_CONTEXT_SECTION = """
+INSTRUCCIONES:
+- No hay contexto RAG disponible para esta pregunta
+- Usa tu conocimiento general sobre trading para responder completamente
+- Proporciona una respuesta útil y detallada según el modo seleccionado
+
+"""
+
+# Prompt base (descripción + saludos + modo) precalculado por modo
+_BASE_PROMPT_FAST = config.ASSISTANT_DESCRIPTION + '\n\n' + _GREETINGS_INSTRUCTION + '\n\n' + _MODE_FAST
+_BASE_PROMPT_DEEP = config.ASSISTANT_DESCRIPTION + '\n\n' + _GREETINGS_INSTRUCTION + '\n\n' + _MODE_DEEP
+
+# Plantillas partidas alrededor de sus huecos: en cada request solo se une el
+# texto variable (contexto/citaciones) con las partes fijas
+_DEEP_PROMPT_HEAD, _, _deep_rest = _SYSTEM_PROMPT_DEEP_TEMPLATE.partition("{context}")
+_DEEP_PROMPT_MID, _, _DEEP_PROMPT_TAIL = _deep_rest.partition("{citation_list}")
+_CONTEXT_SECTION_HEAD, _, _CONTEXT_SECTION_TAIL = _CONTEXT_SECTION_TEMPLATE.partition("{context}")
+
+# Longitud de las partes fijas del prompt profundo (para estimar tokens sin recalcularla)
+_DEEP_PROMPT_STATIC_CHARS = len(_DEEP_PROMPT_HEAD) + len(_DEEP_PROMPT_MID) + len(_DEEP_PROMPT_TAIL)
+
+
+@lru_cache(maxsize=8)
+def _static_prompt_parts(is_greeting: bool, is_fast: bool, has_context: bool) -> Tuple[str, str, int]:
+    """
+    Partes fijas del system prompt para una combinación (saludo, modo, contexto).
     
-    def _configure_api_key(self, chat_model: str, litellm_params: Dict[str, Any]):
-        """Configura la API key según el modelo."""
-        if chat_model.startswith("deepseek") or "deepseek" in chat_model.lower():
+    Returns:
+        Tuple[prefijo, sufijo, max_tokens]: el contexto RAG va entre prefijo y sufijo
+    """
+    if is_greeting:
+        return _GREETING_SYSTEM_PROMPT, "", 100
+    base_prompt = _BASE_PROMPT_FAST if is_fast else _BASE_PROMPT_DEEP
+    max_tokens = 300 if is_fast else 4000
+    if has_context:
+        return base_prompt + _CONTEXT_SECTION_HEAD, _CONTEXT_SECTION_TAIL, max_tokens
+    # No hay contexto RAG - usar conocimiento general
+    return base_prompt + _NO_CONTEXT_SECTION, "", max_tokens
+
+
+class _SharedStream:
+    """
+    Respuesta en curso de un proveedor compartida entre requests idénticas.
+    
+    La request que hace la llamada publica cada delta; las demás con la misma
+    clave reproducen los deltas ya recibidos y esperan los siguientes.
+    """
+    
+    def __init__(self):
+        self.parts = []
+        self.usage: Dict[str, int] = {}
+        self.error: Optional[str] = None
+        self.done = False
+        self._changed = asyncio.Event()
+    
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+    
+    def publish(self, text: str):
+        self.parts.append(text)
+        self._notify()
+    
+    def finish(self, usage: Dict[str, int], error: Optional[str]):
+        self.usage = usage
+        self.error = error
+        self.done = True
+        self._notify()
+    
+    async def follow(self) -> AsyncGenerator[str, None]:
+        index = 0
+        while True:
+            changed = self._changed
+            while index < len(self.parts):
+                yield self.parts[index]
+                index += 1
+            if self.done:
+                return
+            await changed.wait()
+
+
+# Encabezado que precede a las citaciones al final de las respuestas en modo profundo
+_CITATIONS_HEADER = "\n\n---\n**FUENTES DETALLADAS:**\n"
+
+# Chunk fijo que se envía al cliente si el stream falla
+_STREAM_ERROR_CHUNK = "\n[Error] Ocurrió un problema al generar la respuesta. Por favor, intenta nuevamente."
+
+
+# Llamadas al proveedor en curso, por clave de request canónica
+_IN_FLIGHT: Dict[str, _SharedStream] = {}
+
+
+def _request_key(litellm_params: Dict[str, Any]) -> str:
+    """Clave de deduplicación: hash de los parámetros de la llamada (sin api_key)."""
+    params = {key: value for key, value in litellm_params.items() if key != "api_key"}
+    if ORJSON_AVAILABLE:
+        canonical = orjson.dumps(params, option=orjson.OPT_SORT_KEYS)
+    else:
+        canonical = json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(canonical, digest_size=16).hexdigest()
+
+
+# Caché en disco de respuestas deterministas (temperatura baja, modo no profundo)
+LLM_DISK_CACHE_DIR = os.getenv("LLM_DISK_CACHE_DIR", "").strip('"').strip("'").strip()
+LLM_DISK_CACHE_MAX_TEMPERATURE = 0.3
+
+
+def _read_cached_completion(request_key: str) -> Optional[Dict[str, Any]]:
+    """Lee una respuesta cacheada en disco ({content, input_tokens, output_tokens})."""
+    try:
+        with open(os.path.join(LLM_DISK_CACHE_DIR, request_key + ".json"), "rb") as f:
+            data = f.read()
+        return orjson.loads(data) if ORJSON_AVAILABLE else json.loads(data)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo leer caché de respuesta {request_key}: {e}")
+        return None
+
+
+def _write_cached_completion(request_key: str, payload: Dict[str, Any]):
+    """Guarda una respuesta en la caché de disco (escritura atómica)."""
+    try:
+        os.makedirs(LLM_DISK_CACHE_DIR, exist_ok=True)
+        path = os.path.join(LLM_DISK_CACHE_DIR, request_key + ".json")
+        tmp_path = path + ".tmp"
+        if ORJSON_AVAILABLE:
+            with open(tmp_path, "wb") as f:
+                f.write(orjson.dumps(payload))
+        else:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo guardar caché de respuesta {request_key}: {e}")
+
+
+# =============================================================================
+# API KEYS POR PROVEEDOR
+# =============================================================================
+# (prefijo del modelo, proveedor en el nombre, API key, variable de entorno, etiqueta, obligatoria)
+# Las keys ya están inicializadas por init_shared_config al importar este módulo.
+_PROVIDER_API_KEYS = (
+    ("deepseek", "deepseek", DEEPSEEK_API_KEY, "DEEPSEEK_API_KEY", "Deepseek", True),
+    ("claude", "anthropic", ANTHROPIC_API_KEY, "ANTHROPIC_API_KEY", "Anthropic (Claude)", False),
+    ("gemini", "google", GOOGLE_API_KEY, "GOOGLE_API_KEY", "Google (Gemini)", False),
+    ("command", "cohere", COHERE_API_KEY, "COHERE_API_KEY", "Cohere", False),
+    ("gpt", "openai", OPENAI_API_KEY, "OPENAI_API_KEY", "OpenAI/ChatGPT", True),
+)
+
+# LiteLLM lee OPENAI_API_KEY del entorno en algunas rutas internas
+if OPENAI_API_KEY:
+    os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
+
+
+@lru_cache(maxsize=32)
+def _api_key_for_model(chat_model: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Resuelve la API key del modelo (una vez por modelo).
+    
+    Returns:
+        Tuple[api_key, error]: error es el mensaje a devolver si falta una key obligatoria
+    """
+    model_lower = chat_model.lower()
+    for prefix, provider, api_key, env_name, label, required in _PROVIDER_API_KEYS:
+        if chat_model.startswith(prefix) or provider in model_lower:
+            if required and not api_key:
+                return None, f"{env_name} no está configurada pero se intentó usar {label}"
+            return api_key, None
+    return None, None
+
+
+class LLMService:
+    """Servicio para generar respuestas usando modelos de IA."""
+    
+    def __init__(self):
+        self.default_model = modelo_por_defecto
+        self.api_keys = {
+            "deepseek": DEEPSEEK_API_KEY,
+            "openai": OPENAI_API_KEY,
+            "anthropic": ANTHROPIC_API_KEY,
+            "google": GOOGLE_API_KEY,
+            "cohere": COHERE_API_KEY
+        }
+        
+        # Validar una sola vez que el modelo por defecto tenga su API key
+        _, missing_error = _api_key_for_model(self.get_chat_model())
+        if missing_error:
+            logger.error(f"❌ {missing_error}")
+        else:
+            logger.debug("✓ API Key configurada para %s", self.get_chat_model())
+    
+    def get_chat_model(self) -> str:
+        """Obtiene el modelo de chat a usar."""
+        chat_model = self.default_model
+        if not chat_model:
             if DEEPSEEK_API_KEY:
-                litellm_params["api_key"] = DEEPSEEK_API_KEY
-                logger.info("✓ API Key de Deepseek configurada")
+                chat_model = "deepseek/deepseek-chat"
             else:
-                raise HTTPException(
-                    status_code=500,
-                    detail="DEEPSEEK_API_KEY no está configurada pero se intentó usar Deepseek"
-                )
-        elif chat_model.startswith("claude") or "anthropic" in chat_model.lower():
-            if ANTHROPIC_API_KEY:
-                litellm_params["api_key"] = ANTHROPIC_API_KEY
-                logger.info("✓ API Key de Anthropic (Claude) configurada")
-        elif chat_model.startswith("gemini") or "google" in chat_model.lower():
-            if GOOGLE_API_KEY:
-                litellm_params["api_key"] = GOOGLE_API_KEY
-                logger.info("✓ API Key de Google (Gemini) configurada")
-        elif chat_model.startswith("command") or "cohere" in chat_model.lower():
-            if COHERE_API_KEY:
-                litellm_params["api_key"] = COHERE_API_KEY
-                logger.info("✓ API Key de Cohere configurada")
-        elif chat_model.startswith("gpt") or "openai" in chat_model.lower():
-            if not OPENAI_API_KEY:
-                raise HTTPException(
-                    status_code=500,
-                    detail="OPENAI_API_KEY no está configurada pero se intentó usar OpenAI/ChatGPT"
-                )
-            os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
-            litellm_params["api_key"] = OPENAI_API_KEY
-            logger.info(f"✓ API Key de OpenAI configurada para {chat_model}")
+                chat_model = "gpt-3.5-turbo"
+        return chat_model
     
-    async def generate_stream(
+    def _build_system_prompt(
+        self,
+        context: str,
+        citation_list: str,
+        is_greeting: bool,
+        response_mode: str,
+        is_deep_mode: bool
+    ) -> Tuple[str, int]:
+        """
+        Construye el system prompt según el contexto y modo.
+        
+        Args:
+            context: Contexto RAG recuperado
+            citation_list: Lista de citaciones (solo en modo deep)
+            is_greeting: Si es un saludo simple
+            response_mode: Modo de respuesta ('fast' o 'deep')
+            is_deep_mode: Si está en modo estudio profundo
+            
+        Returns:
+            Tuple[system_prompt, max_tokens]
+        """
+        if is_deep_mode and citation_list and not is_greeting:
+            # Modo Estudio Profundo con citaciones
+            system_prompt = "".join((
+                _DEEP_PROMPT_HEAD, context, _DEEP_PROMPT_MID, citation_list, _DEEP_PROMPT_TAIL
+            ))
+            return system_prompt, 4000
+        
+        # Saludo, modo Rápido o sin citaciones: partes fijas cacheadas
+        prefix, suffix, max_tokens = _static_prompt_parts(
+            is_greeting, response_mode == 'fast', bool(context)
+        )
+        if is_greeting or not context:
+            return prefix, max_tokens
+        return prefix + context + suffix, max_tokens
+    
+    def estimate_request_tokens(
+        self,
+        query: str,
+        context: str,
+        citation_list: str,
+        is_greeting: bool,
+        response_mode: str
+    ) -> int:
+        """
+        Estimación barata (sin tokenizar) de los tokens que ocupará una request:
+        entrada aproximada a 3 caracteres por token + max_tokens de la respuesta.
+        Se usa para el control de admisión antes de llamar al proveedor.
+        """
+        is_deep_mode = is_deep_response_mode(response_mode)
+        if is_deep_mode and citation_list and not is_greeting:
+            prompt_chars = _DEEP_PROMPT_STATIC_CHARS
+            max_tokens = 4000
+        else:
+            prefix, suffix, max_tokens = _static_prompt_parts(
+                is_greeting, response_mode == 'fast', bool(context)
+            )
+            prompt_chars = len(prefix) + len(suffix)
+        input_chars = prompt_chars + len(query) + len(context) + len(citation_list)
+        return input_chars // 3 + max_tokens
+    
+    def _configure_api_key(self, chat_model: str, litellm_params: Dict[str, Any]):
+        """Configura la API key según el modelo."""
+        api_key, missing_error = _api_key_for_model(chat_model)
+        if missing_error:
+            raise HTTPException(status_code=500, detail=missing_error)
+        if api_key:
+            litellm_params["api_key"] = api_key
+    
+    def build_request_params(
         self,
         query: str,
         context: str,
         citation_list: str,
         is_greeting: bool,
         response_mode: str,
-        stream_state: Dict[str, Any]
-    ) -> AsyncGenerator[str, None]:
+        stream: bool = True
+    ) -> Dict[str, Any]:
         """
-        Genera un stream de respuesta del LLM.
+        Construye los parámetros de la llamada al modelo (formato LiteLLM).
         
         Args:
             query: Consulta del usuario
@@ -342,17 +525,13 @@ Si tienes menos de 5 párrafos, estás violando el modo Estudio Profundo.
             citation_list: Lista de citaciones
             is_greeting: Si es un saludo
             response_mode: Modo de respuesta
-            stream_state: Estado del stream (se actualiza durante el streaming)
+            stream: Si la respuesta se pedirá en streaming
             
-        Yields:
-            str: Chunks de texto de la respuesta
+        Returns:
+            Dict con model, messages, temperature, max_tokens, stream y api_key
         """
         chat_model = self.get_chat_model()
-        is_deep_mode = response_mode and (
-            response_mode.lower() == 'deep' or 
-            response_mode.lower() == 'estudio profundo' or
-            response_mode.lower() == 'profundo'
-        )
+        is_deep_mode = is_deep_response_mode(response_mode)
         
         system_prompt, max_tokens = self._build_system_prompt(
             context, citation_list, is_greeting, response_mode, is_deep_mode
@@ -373,12 +552,48 @@ Si tienes menos de 5 párrafos, estás violando el modo Estudio Profundo.
             ],
             "temperature": config.MODEL_TEMPERATURE,
             "max_tokens": max_tokens,
-            "stream": True
+            "stream": stream
         }
         
+        # Pedir el uso de tokens en el último chunk del stream (API estilo OpenAI)
+        if stream and llm_provider.supports_stream_usage(chat_model):
+            litellm_params["stream_options"] = {"include_usage": True}
+        
         # Configurar API key
         self._configure_api_key(chat_model, litellm_params)
         
+        return litellm_params
+    
+    async def generate_stream(
+        self,
+        query: str,
+        context: str,
+        citation_list: str,
+        is_greeting: bool,
+        response_mode: str,
+        stream_state: Dict[str, Any]
+    ) -> AsyncGenerator[str, None]:
+        """
+        Genera un stream de respuesta del LLM.
+        
+        Args:
+            query: Consulta del usuario
+            context: Contexto RAG
+            citation_list: Lista de citaciones
+            is_greeting: Si es un saludo
+            response_mode: Modo de respuesta
+            stream_state: Estado del stream (se actualiza durante el streaming)
+            
+        Yields:
+            str: Chunks de texto de la respuesta
+        """
+        chat_model = self.get_chat_model()
+        is_deep_mode = is_deep_response_mode(response_mode)
+        
+        litellm_params = self.build_request_params(
+            query, context, citation_list, is_greeting, response_mode, stream=True
+        )
+        
         logger.info(f"📤 Enviando consulta a {chat_model} (query: {query[:50]}...)")
         
         # Funciones auxiliares para procesar chunks
@@ -431,48 +646,132 @@ Si tienes menos de 5 párrafos, estás violando el modo Estudio Profundo.
                 logger.debug(f"[STREAM] Error al extraer delta: {parse_error}")
                 return ""
         
+        # Saludos simultáneos: responderlos en un solo lote si está activado
+        if is_greeting and greeting_batcher.enabled:
+            batched = await greeting_batcher.submit(query, litellm_params)
+            if batched:
+                answer, usage = batched
+                stream_state["full_response"] = answer
+                stream_state.update(usage)
+                yield answer
+                return
+        
+        # Respuestas deterministas: servir desde la caché de disco si existe
+        cache_key = None
+        if (
+            LLM_DISK_CACHE_DIR
+            and not is_deep_mode
+            and config.MODEL_TEMPERATURE <= LLM_DISK_CACHE_MAX_TEMPERATURE
+        ):
+            cache_key = _request_key(litellm_params)
+            cached = await asyncio.to_thread(_read_cached_completion, cache_key)
+            if cached:
+                logger.info(f"💾 Respuesta servida desde caché de disco ({cache_key})")
+                stream_state["full_response"] = cached["content"]
+                stream_state["input_tokens"] = cached.get("input_tokens", 0)
+                stream_state["output_tokens"] = cached.get("output_tokens", 0)
+                stream_state["total_tokens"] = stream_state["input_tokens"] + stream_state["output_tokens"]
+                yield cached["content"]
+                return
+        
+        # Si ya hay una llamada idéntica en curso, reutilizar su respuesta
+        request_key = _request_key(litellm_params) if config.LLM_INFLIGHT_DEDUP else None
+        shared = _IN_FLIGHT.get(request_key) if request_key else None
+        if shared is not None:
+            logger.info(f"♻️ Reutilizando respuesta en curso de {chat_model} para una consulta idéntica")
+            response_parts = []
+            async for text in shared.follow():
+                response_parts.append(text)
+                yield text
+            stream_state["full_response"] = "".join(response_parts)
+            stream_state.update(shared.usage)
+            if shared.error:
+                stream_state["error"] = shared.error
+            return
+        
+        if request_key:
+            shared = _SharedStream()
+            _IN_FLIGHT[request_key] = shared
+        
+        def emit(text: str) -> str:
+            response_parts.append(text)
+            if shared is not None:
+                shared.publish(text)
+            return text
+        
         # Generar stream
+        # IMPORTANTE: usar una llamada asíncrona + async for para no bloquear el
+        # event loop mientras se esperan los tokens del proveedor; cada delta se
+        # envía al cliente en cuanto llega. OpenAI/Deepseek van por su SDK directo.
         response_stream = None
+        # Los deltas se acumulan en una lista y se unen una sola vez al final
+        response_parts = []
+        # Solo un stream que llegó al final se guarda en caché (no uno cortado
+        # porque el cliente se desconectó)
+        completed = False
+        
+        def finalize_state():
+            stream_state["full_response"] = "".join(response_parts)
+            
+            # Calcular tokens estimados si no se obtuvieron
+            if stream_state.get("total_tokens", 0) == 0 and stream_state["full_response"]:
+                approx_input = llm_provider.count_tokens(stream_state.get("prompt_text", query), chat_model)
+                approx_output = llm_provider.count_tokens(stream_state["full_response"], chat_model)
+                stream_state["input_tokens"] = stream_state.get("input_tokens") or approx_input
+                stream_state["output_tokens"] = stream_state.get("output_tokens") or approx_output
+                stream_state["total_tokens"] = stream_state["input_tokens"] + stream_state["output_tokens"]
+        
         try:
-            response_stream = litellm.completion(**litellm_params)
+            response_stream = await llm_provider.acompletion(litellm_params)
             chunk_count = 0
-            for chunk in response_stream:
+            async for chunk in response_stream:
                 usage_chunk = getattr(chunk, "usage", None)
                 if usage_chunk:
                     assign_usage_values(usage_chunk)
                 delta_text = extract_delta_text(chunk)
                 if delta_text:
                     chunk_count += 1
-                    stream_state["full_response"] += delta_text
                     if chunk_count % 10 == 0:
                         logger.debug(f"[STREAM] Chunk {chunk_count} enviado: {len(delta_text)} chars")
-                    yield delta_text
+                    yield emit(delta_text)
             
             # Procesar respuesta final si existe
             final_response = getattr(response_stream, "final_response", None)
             if final_response:
                 assign_usage_values(getattr(final_response, "usage", None))
             
-            # Agregar citaciones si es modo deep
+            # Agregar citaciones si es modo deep (encabezado fijo + lista, sin concatenar)
             if citation_list and is_deep_mode:
-                fuentes_chunk = "\n\n---\n**FUENTES DETALLADAS:**\n" + citation_list
-                stream_state["full_response"] += fuentes_chunk
-                yield fuentes_chunk
+                yield emit(_CITATIONS_HEADER)
+                yield emit(citation_list)
+            completed = True
+            
+            if cache_key:
+                finalize_state()
+                if stream_state["full_response"]:
+                    await asyncio.to_thread(_write_cached_completion, cache_key, {
+                        "content": stream_state["full_response"],
+                        "input_tokens": stream_state.get("input_tokens", 0),
+                        "output_tokens": stream_state.get("output_tokens", 0)
+                    })
                 
         except Exception as stream_error:
-            logger.error(f"❌ Error durante streaming: {stream_error}")
-            stream_state["error"] = str(stream_error)
-            fallback_chunk = "\n[Error] Ocurrió un problema al generar la respuesta. Por favor, intenta nuevamente."
-            stream_state["full_response"] += fallback_chunk
-            yield fallback_chunk
+            error_msg = str(stream_error)
+            logger.error("❌ Error durante streaming: " + error_msg)
+            stream_state["error"] = error_msg
+            yield emit(_STREAM_ERROR_CHUNK)
         finally:
-            # Calcular tokens estimados si no se obtuvieron
-            if stream_state.get("total_tokens", 0) == 0 and stream_state["full_response"]:
-                approx_input = len(stream_state.get("prompt_text", query)) // 4
-                approx_output = len(stream_state["full_response"]) // 4
-                stream_state["input_tokens"] = stream_state.get("input_tokens") or approx_input
-                stream_state["output_tokens"] = stream_state.get("output_tokens") or approx_output
-                stream_state["total_tokens"] = stream_state["input_tokens"] + stream_state["output_tokens"]
+            finalize_state()
+            
+            if shared is not None:
+                # Si el cliente que hace la llamada se desconecta, los que la
+                # comparten reciben un error en lugar de una respuesta cortada
+                # que parecería completa (y se guardaría y cobraría)
+                shared.finish(
+                    {key: stream_state.get(key, 0) for key in ("input_tokens", "output_tokens", "total_tokens")},
+                    stream_state.get("error") or (None if completed else "cancelled")
+                )
+                _IN_FLIGHT.pop(request_key, None)
 
 
 # Instancia global del servicio
@@ -0,0 +1,53 @@
+"""
+Marcado por lotes de flags booleanos de profiles (emails ya enviados).
+
+Tras enviar un email, los workers solo anotan el user_id; un temporizador
+agrupa las marcas de los últimos segundos y las escribe con un único
+UPDATE ... WHERE id IN (...) por flag, en lugar de un UPDATE por email.
+"""
+import atexit
+import logging
+import threading
+from typing import Dict, Set, Optional
+
+from lib.dependencies import supabase_client
+
+logger = logging.getLogger(__name__)
+
+# Segundos que se acumulan marcas antes de escribirlas
+FLUSH_AFTER_SECONDS = 2.0
+
+_pending: Dict[str, Set[str]] = {}
+_lock = threading.Lock()
+_timer: Optional[threading.Timer] = None
+
+
+def mark_flag(user_id: str, flag: str):
+    """Anota `flag = true` para el usuario; se escribe en el próximo flush (no bloquea)."""
+    global _timer
+    with _lock:
+        _pending.setdefault(flag, set()).add(str(user_id))
+        if _timer is None:
+            _timer = threading.Timer(FLUSH_AFTER_SECONDS, flush)
+            _timer.daemon = True
+            _timer.start()
+
+
+def flush():
+    """Escribe todas las marcas pendientes (un UPDATE por flag)."""
+    global _timer
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _timer = None
+
+    for flag, user_ids in pending.items():
+        try:
+            supabase_client.table("profiles").update({flag: True}).in_("id", list(user_ids)).execute()
+            logger.debug("Flag %s marcado para %d usuario(s)", flag, len(user_ids))
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo marcar flag {flag} para {len(user_ids)} usuario(s): {e} (no crítico)")
+
+
+# No perder las marcas pendientes al apagar el proceso
+atexit.register(flush)
@@ -1,15 +1,23 @@
 """
 Servicio para búsqueda RAG: embeddings y recuperación de documentos desde Supabase.
 """
+import io
 import logging
 import time
 from typing import Optional, Tuple, List, Dict, Any
 
 from lib.dependencies import supabase_client
 from lib.config_shared import RAG_AVAILABLE, local_embedder
+from lib.business import is_deep_response_mode
 
 logger = logging.getLogger(__name__)
 
+# Tiempo de vida de la caché de nombres de archivo (segundos)
+FILENAME_CACHE_TTL_SECONDS = 600
+
+# Formato compacto de cada componente del embedding enviado a Supabase
+_EMBEDDING_FORMAT = "{:.6g}".format
+
 
 class RAGService:
     """Servicio para realizar búsquedas RAG en la biblioteca de documentos."""
@@ -18,6 +26,11 @@ class RAGService:
         self.supabase = supabase_client
         self.embedder = local_embedder
         self.rag_available = RAG_AVAILABLE
+        # Se desactiva si la función SQL chat_prepare no está creada en Supabase
+        self._chat_prepare_available = True
+        # Caché doc_id -> filename de la tabla documents
+        self._filename_cache: Dict[str, str] = {}
+        self._filename_cache_expiry = 0.0
     
     async def perform_rag_search(
         self,
@@ -56,28 +69,12 @@ class RAGService:
         logger.info("─" * 80)
         
         try:
-            if self.embedder is None:
-                raise RuntimeError("Embedder local MiniLM no inicializado")
-            
-            # Generar embedding local (384d) con SentenceTransformer
-            logger.info("⚙️  Generando embedding con all-MiniLM-L6-v2 (384 dimensiones)...")
-            query_vec = self.embedder.encode([query], show_progress_bar=False)[0]
-            query_embedding = query_vec.tolist()
+            query_embedding = self._embed_query(query)
             
             # Determinar match_count según el modo de respuesta
-            is_deep_mode = response_mode and (
-                response_mode.lower() == 'deep' or 
-                response_mode.lower() == 'estudio profundo' or
-                response_mode.lower() == 'profundo'
-            )
-            
+            is_deep_mode = is_deep_response_mode(response_mode)
             if match_count is None:
-                if is_deep_mode:
-                    match_count = 15  # Modo Estudio Profundo: más chunks
-                    logger.info(f"📚 Modo Estudio Profundo: usando {match_count} chunks para contexto amplio")
-                else:
-                    match_count = 5  # Modo Rápido: menos chunks
-                    logger.info(f"⚡ Modo Rápido: usando {match_count} chunks para respuesta rápida")
+                match_count = self._resolve_match_count(is_deep_mode)
             
             # Realizar búsqueda RPC en Supabase
             logger.info(f"🔎 Buscando en book_chunks usando match_documents_384 (top {match_count})...")
@@ -91,18 +88,13 @@ class RAGService:
             rows = rpc.data or []
             retrieved_chunks = rows
             
-            logger.info(f"🔍 [DEBUG] retrieved_chunks asignado: {len(retrieved_chunks) if retrieved_chunks else 0} chunks")
+            logger.debug("🔍 [DEBUG] retrieved_chunks asignado: %d chunks", len(retrieved_chunks))
             
             # Obtener nombres de archivo desde la tabla documents
             doc_id_to_filename = self._get_document_filenames(rows)
             
             # Construir contexto y citaciones según el modo
-            if is_deep_mode:
-                context_text, citation_list = self._build_deep_mode_context(rows, doc_id_to_filename)
-                logger.info(f"📚 Modo Estudio Profundo: {len(doc_id_to_filename)} fuentes únicas con citación")
-            else:
-                context_text, citation_list = self._build_fast_mode_context(rows)
-                logger.info("⚡ Modo rápido: sin citación de fuentes")
+            context_text, citation_list = self._build_context(rows, doc_id_to_filename, is_deep_mode)
             
             duration = time.time() - start_time
             logger.info("─" * 80)
@@ -129,6 +121,114 @@ class RAGService:
             
             return "", "", []
     
+    async def prepare_chat(
+        self,
+        user_id: str,
+        query: str,
+        category: Optional[str] = None,
+        response_mode: str = 'fast'
+    ) -> Optional[Tuple[Optional[int], str, str, List[Dict[str, Any]]]]:
+        """
+        Obtiene saldo de tokens y contexto RAG en una sola llamada RPC (chat_prepare).
+        
+        La función SQL lee tokens_restantes, busca los chunks y une el filename
+        desde documents, evitando las llamadas separadas a profiles, match_documents_384
+        y documents.
+        
+        Args:
+            user_id: ID del usuario
+            query: Consulta del usuario
+            category: Categoría opcional para filtrar
+            response_mode: Modo de respuesta ('fast' o 'deep')
+            
+        Returns:
+            Tuple[tokens_restantes, context_text, citation_list, retrieved_chunks], con
+            tokens_restantes = None si el perfil no existe; o None si la RPC no está
+            disponible y hay que usar el flujo de varias llamadas.
+        """
+        if not self._chat_prepare_available or not self.rag_available or self.embedder is None:
+            return None
+        
+        start_time = time.time()
+        try:
+            query_embedding = self._embed_query(query)
+            is_deep_mode = is_deep_response_mode(response_mode)
+            match_count = self._resolve_match_count(is_deep_mode)
+            
+            payload = {
+                "p_user_id": str(user_id),
+                "query_embedding": query_embedding,
+                "match_count": match_count,
+                "category_filter": category
+            }
+            result = self.supabase.rpc("chat_prepare", payload).execute().data or {}
+        except Exception as e:
+            error_msg = str(e)
+            if "PGRST202" in error_msg or ("function" in error_msg.lower() and "does not exist" in error_msg.lower()):
+                self._chat_prepare_available = False
+                logger.warning("⚠️ La función RPC 'chat_prepare' no existe en Supabase, usando flujo de varias llamadas")
+                logger.warning("ℹ️ Ejecuta el script SQL 'create_chat_prepare_finalize_functions.sql' en Supabase SQL Editor")
+            else:
+                logger.error(f"Error en RPC chat_prepare: {error_msg[:200]}")
+            return None
+        
+        if not result.get("profile_found"):
+            return None, "", "", []
+        
+        rows = result.get("chunks") or []
+        doc_id_to_filename = {}
+        for row in rows:
+            metadata = row.get("metadata")
+            doc_id = metadata.get("doc_id") if isinstance(metadata, dict) else None
+            if doc_id and row.get("filename"):
+                doc_id_to_filename[doc_id] = row["filename"]
+        
+        context_text, citation_list = self._build_context(rows, doc_id_to_filename, is_deep_mode)
+        
+        duration = time.time() - start_time
+        logger.info(f"✅ chat_prepare: {len(rows)} chunks recuperados en {duration:.2f}s")
+        
+        return result.get("tokens_restantes"), context_text, citation_list, rows
+    
+    def _embed_query(self, query: str) -> str:
+        """
+        Genera el embedding local (384d) de la consulta con SentenceTransformer.
+        
+        Se devuelve como literal de pgvector ("[x1,x2,...]") con 6 cifras
+        significativas: el float32 no tiene más precisión y el cuerpo JSON de
+        la RPC queda en menos de la mitad que con la lista de floats de tolist().
+        """
+        if self.embedder is None:
+            raise RuntimeError("Embedder local MiniLM no inicializado")
+        logger.info("⚙️  Generando embedding con all-MiniLM-L6-v2 (384 dimensiones)...")
+        query_vec = self.embedder.encode([query], show_progress_bar=False)[0]
+        return "[" + ",".join(map(_EMBEDDING_FORMAT, query_vec.tolist())) + "]"
+    
+    def _resolve_match_count(self, is_deep_mode: bool) -> int:
+        """Número de chunks a recuperar según el modo de respuesta."""
+        if is_deep_mode:
+            match_count = 15  # Modo Estudio Profundo: más chunks
+            logger.info(f"📚 Modo Estudio Profundo: usando {match_count} chunks para contexto amplio")
+        else:
+            match_count = 5  # Modo Rápido: menos chunks
+            logger.info(f"⚡ Modo Rápido: usando {match_count} chunks para respuesta rápida")
+        return match_count
+    
+    def _build_context(
+        self,
+        chunks: List[Dict[str, Any]],
+        doc_id_to_filename: Dict[str, str],
+        is_deep_mode: bool
+    ) -> Tuple[str, str]:
+        """Construye contexto y citaciones según el modo de respuesta."""
+        if is_deep_mode:
+            context_text, citation_list = self._build_deep_mode_context(chunks, doc_id_to_filename)
+            logger.info(f"📚 Modo Estudio Profundo: {len(doc_id_to_filename)} fuentes únicas con citación")
+        else:
+            context_text, citation_list = self._build_fast_mode_context(chunks)
+            logger.info("⚡ Modo rápido: sin citación de fuentes")
+        return context_text, citation_list
+    
     def _get_document_filenames(self, chunks: List[Dict[str, Any]]) -> Dict[str, str]:
         """
         Obtiene los nombres de archivo asociados a los doc_ids de los chunks.
@@ -139,29 +239,40 @@ class RAGService:
         Returns:
             Dict[doc_id, filename]: Mapeo de doc_id a nombre de archivo
         """
-        doc_ids = set()
-        for row in chunks:
-            # La función retorna doc_id directamente, pero también puede estar en metadata
-            doc_id = row.get("doc_id")
-            if not doc_id:
-                # Fallback: buscar en metadata si no está en el nivel superior
-                metadata = row.get("metadata", {})
-                if isinstance(metadata, dict):
-                    doc_id = metadata.get("doc_id")
-            if doc_id:
-                doc_ids.add(doc_id)
+        # La función puede retornar doc_id directamente o dentro de metadata
+        doc_ids = {
+            doc_id
+            for row in chunks
+            for metadata in (row.get("metadata"),)
+            for doc_id in (row.get("doc_id") or (metadata.get("doc_id") if isinstance(metadata, dict) else None),)
+            if doc_id
+        }
         
-        doc_id_to_filename = {}
-        if doc_ids:
+        # Los nombres de archivo casi nunca cambian: caché en memoria con TTL
+        now = time.time()
+        if now > self._filename_cache_expiry:
+            self._filename_cache.clear()
+            self._filename_cache_expiry = now + FILENAME_CACHE_TTL_SECONDS
+        
+        missing = doc_ids - self._filename_cache.keys()
+        if missing:
             try:
-                docs_response = self.supabase.table("documents").select("doc_id, filename").in_("doc_id", list(doc_ids)).execute()
-                if docs_response.data:
-                    for doc in docs_response.data:
-                        doc_id_to_filename[doc.get("doc_id")] = doc.get("filename", "Documento desconocido")
-                logger.info(f"📚 Fuentes encontradas: {len(doc_id_to_filename)} documentos únicos")
+                docs_response = self.supabase.table("documents").select("doc_id, filename").in_("doc_id", list(missing)).execute()
+                self._filename_cache.update({
+                    doc.get("doc_id"): doc.get("filename", "Documento desconocido")
+                    for doc in (docs_response.data or [])
+                })
             except Exception as e:
                 logger.warning(f"⚠️ Error al obtener nombres de archivo: {str(e)[:100]}")
         
+        doc_id_to_filename = {
+            doc_id: self._filename_cache[doc_id]
+            for doc_id in doc_ids
+            if doc_id in self._filename_cache
+        }
+        if doc_ids:
+            logger.info(f"📚 Fuentes encontradas: {len(doc_id_to_filename)} documentos únicos ({len(missing)} consultados en Supabase)")
+        
         return doc_id_to_filename
     
     def _build_deep_mode_context(
@@ -179,7 +290,8 @@ class RAGService:
         Returns:
             Tuple[context_text, citation_list]
         """
-        context_components = []
+        buffer = io.StringIO()
+        num_components = 0
         unique_sources = {}
         source_index = 1
         
@@ -207,12 +319,19 @@ class RAGService:
                 unique_sources[source_filename] = source_index
                 source_index += 1
             
-            source_tag = f"[{unique_sources[source_filename]}]"
-            context_components.append(f"{source_tag} {chunk_content}")
+            # Escribir directamente en el buffer (separador solo entre componentes)
+            if num_components:
+                buffer.write("\n---\n")
+            buffer.write("[")
+            buffer.write(str(unique_sources[source_filename]))
+            buffer.write("] ")
+            buffer.write(chunk_content)
+            num_components += 1
         
-        context_text = "\n---\n".join(context_components)
-        logger.info(f"🔍 [DEBUG] contexto construido (Estudio Profundo): {len(context_text)} caracteres, context_components={len(context_components)}")
-        logger.info(f"🔍 [DEBUG] Primeros 200 caracteres de contexto: {context_text[:200] if context_text else 'VACÍO'}")
+        context_text = buffer.getvalue()
+        logger.debug("🔍 [DEBUG] contexto construido (Estudio Profundo): %d caracteres, context_components=%d", len(context_text), num_components)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("🔍 [DEBUG] Primeros 200 caracteres de contexto: %s", context_text[:200] if context_text else 'VACÍO')
         
         # Crear la lista final de fuentes para el LLM
         citation_list = "\n".join([
@@ -234,8 +353,9 @@ class RAGService:
         """
         context_content = [chunk.get("content", "") for chunk in chunks if chunk.get("content")]
         context_text = "\n---\n".join(context_content)
-        logger.info(f"🔍 [DEBUG] contexto construido (Modo Rápido): {len(context_text)} caracteres, context_content={len(context_content)}")
-        logger.info(f"🔍 [DEBUG] Primeros 200 caracteres de contexto: {context_text[:200] if context_text else 'VACÍO'}")
+        logger.debug("🔍 [DEBUG] contexto construido (Modo Rápido): %d caracteres, context_content=%d", len(context_text), len(context_content))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("🔍 [DEBUG] Primeros 200 caracteres de contexto: %s", context_text[:200] if context_text else 'VACÍO')
         
         return context_text, ""
 
@@ -3,6 +3,7 @@ Módulo de configuración y utilidades para Stripe.
 Configura el cliente de Stripe y proporciona funciones auxiliares.
 """
 import os
+import importlib.util
 from typing import Dict, Optional
 
 # Intentar importar stripe
@@ -11,7 +12,6 @@ from typing import Dict, Optional
 # Importamos el paquete oficial 'stripe' usando __import__ con fromlist
 try:
     import sys
-    import importlib.util
     
     # Guardar referencia temporal si existe
     old_stripe = None
@@ -81,6 +81,17 @@ STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", "").strip('"').strip("'").str
 # Configurar el cliente de Stripe solo si está disponible
 if STRIPE_SECRET_KEY and STRIPE_IMPORTED:
     stripe.api_key = STRIPE_SECRET_KEY
+    # Un único cliente HTTP con pool keep-alive para todas las llamadas a Stripe,
+    # así solo la primera paga el handshake TLS
+    try:
+        if importlib.util.find_spec("requests") is not None:
+            stripe.default_http_client = stripe.RequestsClient()
+            print("✅ Stripe usando RequestsClient compartido (keep-alive)")
+        else:
+            stripe.default_http_client = stripe.HTTPXClient()
+            print("✅ Stripe usando HTTPXClient compartido (keep-alive)")
+    except Exception as e:
+        print(f"⚠️ WARNING: No se pudo configurar el cliente HTTP compartido de Stripe: {e}")
 elif not STRIPE_SECRET_KEY:
     # No lanzar error, solo advertir (para permitir que el backend funcione sin Stripe)
     print("WARNING: STRIPE_SECRET_KEY no esta configurada. Las funciones de Stripe no estaran disponibles.")
@@ -134,6 +145,10 @@ def get_stripe_price_id(plan_code: str) -> Optional[str]:
     return STRIPE_PRICE_IDS.get(plan_code.lower())
 
 
+# Códigos de plan válidos (el plan gratis no requiere Stripe)
+_VALID_PLAN_CODES = frozenset(STRIPE_PRICE_IDS) | {"gratis"}
+
+
 def is_valid_plan_code(plan_code: str) -> bool:
     """
     Valida si un código de plan es válido.
@@ -144,7 +159,5 @@ def is_valid_plan_code(plan_code: str) -> bool:
     Returns:
         True si el código es válido, False en caso contrario
     """
-    valid_codes = set(STRIPE_PRICE_IDS.keys())
-    valid_codes.add("gratis")  # El plan gratis no requiere Stripe
-    return plan_code.lower() in valid_codes
+    return plan_code.lower() in _VALID_PLAN_CODES
 
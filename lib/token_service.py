@@ -3,23 +3,192 @@ Servicio para gestión de tokens: verificación de saldo, descuento y uso justo.
 """
 import os
 import json
+import asyncio
+import time
 import threading
 import logging
+from collections import OrderedDict
 from datetime import datetime
 from typing import Optional, Dict, Any
-from fastapi import HTTPException
+from fastapi import HTTPException, BackgroundTasks
 
 from lib.dependencies import supabase_client
 from lib.model_usage import log_model_usage_from_response
+from lib.email_templates import render_email, format_usage_values, USER_90_PERCENT_HTML, ADMIN_90_PERCENT_HTML, TOKENS_EXHAUSTED_HTML
+from lib import alert_events
+
+# orjson (opcional) serializa las líneas del log de tokens más rápido que json
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 logger = logging.getLogger(__name__)
 
+# =============================================================================
+# LOG LOCAL DE TOKENS (tokens_log.jsonl)
+# =============================================================================
+# Una línea JSON por consulta. Las entradas se acumulan en memoria y se añaden
+# al final del archivo de forma periódica (y al apagar) con una sola escritura
+# O_APPEND, sin leer ni reescribir el archivo. Se recorta a las últimas
+# TOKENS_LOG_MAX_ENTRIES líneas al arrancar y cada vez que se han añadido otras
+# TOKENS_LOG_MAX_ENTRIES (el archivo nunca pasa de ~2x el máximo).
+TOKENS_LOG_FILE = "tokens_log.jsonl"
+TOKENS_LOG_MAX_ENTRIES = 100
+TOKENS_LOG_FLUSH_INTERVAL_SECONDS = 5.0
+
+_tokens_log_pending = []
+_tokens_log_lock = threading.Lock()
+# Serializa append y recorte del archivo (el volcado corre en hilos)
+_tokens_log_file_lock = threading.Lock()
+_tokens_log_appended_since_trim = 0
+
+
+def _dumps_line(entry: Dict[str, Any]) -> bytes:
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+    return (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _trim_tokens_log():
+    """Deja solo las últimas TOKENS_LOG_MAX_ENTRIES líneas del archivo."""
+    if not os.path.exists(TOKENS_LOG_FILE):
+        return
+    try:
+        with open(TOKENS_LOG_FILE, "rb") as f:
+            lines = f.readlines()
+        if len(lines) <= TOKENS_LOG_MAX_ENTRIES:
+            return
+        tmp_file = TOKENS_LOG_FILE + ".tmp"
+        with open(tmp_file, "wb") as f:
+            f.writelines(lines[-TOKENS_LOG_MAX_ENTRIES:])
+        os.replace(tmp_file, TOKENS_LOG_FILE)
+    except Exception as e:
+        logger.warning(f"⚠ No se pudo recortar log de tokens existente: {e}")
+
+
+def append_tokens_log(log_entry: Dict[str, Any]):
+    """Agrega una entrada al log de tokens en memoria (sin tocar disco)."""
+    with _tokens_log_lock:
+        _tokens_log_pending.append(log_entry)
+
+
+def flush_tokens_log():
+    """Añade las entradas pendientes al final de tokens_log.jsonl (una sola escritura)."""
+    global _tokens_log_pending, _tokens_log_appended_since_trim
+    with _tokens_log_lock:
+        if not _tokens_log_pending:
+            return
+        entries = _tokens_log_pending
+        _tokens_log_pending = []
+    
+    try:
+        data = b"".join(_dumps_line(entry) for entry in entries)
+        with _tokens_log_file_lock:
+            fd = os.open(TOKENS_LOG_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            _tokens_log_appended_since_trim += len(entries)
+            if _tokens_log_appended_since_trim >= TOKENS_LOG_MAX_ENTRIES:
+                _trim_tokens_log()
+                _tokens_log_appended_since_trim = 0
+    except Exception as e:
+        logger.warning(f"⚠ No se pudo guardar log de tokens: {e}")
+
+
+async def flush_tokens_log_periodically(interval: float = TOKENS_LOG_FLUSH_INTERVAL_SECONDS):
+    """Tarea de fondo que vuelca el log de tokens cada `interval` segundos."""
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(flush_tokens_log)
+
+
+_trim_tokens_log()
+
+
+# =============================================================================
+# CACHE DE GET /tokens
+# =============================================================================
+# El frontend consulta el saldo con frecuencia: se guarda la respuesta unos
+# segundos por usuario (user_id -> (expiración, respuesta)). Se invalida al
+# descontar, recargar o resetear tokens.
+_TOKENS_CACHE_TTL_SECONDS = 5
+_TOKENS_CACHE_MAX_SIZE = 10_000
+_tokens_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+
+def get_cached_tokens_response(user_id: str) -> Optional[dict]:
+    """Respuesta cacheada de GET /tokens para el usuario, o None si no hay o expiró."""
+    entry = _tokens_cache.get(user_id)
+    if entry is None:
+        return None
+    if entry[0] < time.monotonic():
+        _tokens_cache.pop(user_id, None)
+        return None
+    return entry[1]
+
+
+def cache_tokens_response(user_id: str, response: dict):
+    _tokens_cache[user_id] = (time.monotonic() + _TOKENS_CACHE_TTL_SECONDS, response)
+    _tokens_cache.move_to_end(user_id)
+    while len(_tokens_cache) > _TOKENS_CACHE_MAX_SIZE:
+        _tokens_cache.popitem(last=False)
+
+
+def invalidate_tokens_cache(user_id: str):
+    """Descarta el saldo cacheado de GET /tokens tras modificar tokens_restantes."""
+    _tokens_cache.pop(str(user_id), None)
+
+
+# =============================================================================
+# CACHE DE DESCUENTO FAIR USE
+# =============================================================================
+# Un usuario que va y viene entre planes en la página de precios crea varios
+# checkouts seguidos: se recuerda 60 s que no puede reclamar el descuento
+# (no elegible o ya usado) para no repetir el UPDATE condicional. Se invalida
+# cuando el usuario pasa a ser elegible (90% de uso).
+_FAIR_USE_CACHE_TTL_SECONDS = 60
+_FAIR_USE_CACHE_MAX_SIZE = 10_000
+_fair_use_not_claimable: "OrderedDict[str, float]" = OrderedDict()
+
+
+def is_fair_use_not_claimable(user_id: str) -> bool:
+    """True si hace menos de 60 s se comprobó que el usuario no puede reclamar el descuento."""
+    expires_at = _fair_use_not_claimable.get(str(user_id))
+    if expires_at is None:
+        return False
+    if expires_at < time.monotonic():
+        _fair_use_not_claimable.pop(str(user_id), None)
+        return False
+    return True
+
+
+def remember_fair_use_not_claimable(user_id: str):
+    _fair_use_not_claimable[str(user_id)] = time.monotonic() + _FAIR_USE_CACHE_TTL_SECONDS
+    _fair_use_not_claimable.move_to_end(str(user_id))
+    while len(_fair_use_not_claimable) > _FAIR_USE_CACHE_MAX_SIZE:
+        _fair_use_not_claimable.popitem(last=False)
+
+
+def invalidate_fair_use_cache(user_id: str):
+    """Olvida el resultado cacheado tras marcar al usuario como elegible."""
+    _fair_use_not_claimable.pop(str(user_id), None)
+
 
 class TokenService:
     """Servicio para gestionar tokens de usuarios."""
     
     def __init__(self):
         self.supabase = supabase_client
+        # Se desactiva si la función SQL chat_finalize no está creada en Supabase
+        self._chat_finalize_available = True
+        # Usuarios a los que este proceso ya envió la alerta del 90% en el ciclo
+        # actual (fair_use_email_sent en profiles sigue siendo la fuente de verdad)
+        self._notified_90 = set()
+        self._notified_90_lock = threading.Lock()
     
     def verify_token_balance(self, user_id: str) -> int:
         """
@@ -34,19 +203,40 @@ class TokenService:
         Raises:
             HTTPException: Si el perfil no existe o los tokens están agotados
         """
-        profile_response = self.supabase.table("profiles").select("tokens_restantes").eq("id", user_id).execute()
+        # Se leen también los datos del email de tokens agotados para no hacer
+        # un segundo SELECT si el saldo está en cero
+        profile_response = self.supabase.table("profiles").select(
+            "tokens_restantes, email, tokens_exhausted_email_sent"
+        ).eq("id", user_id).execute()
+        profile = profile_response.data[0] if profile_response.data else None
+        tokens_restantes = profile["tokens_restantes"] if profile else None
+        
+        return self.ensure_token_balance(user_id, tokens_restantes, profile=profile)
+    
+    def ensure_token_balance(self, user_id: str, tokens_restantes: Optional[int], profile: Optional[Dict[str, Any]] = None) -> int:
+        """
+        Valida un saldo de tokens ya leído (por ejemplo desde la RPC chat_prepare).
         
-        if not profile_response.data:
+        Args:
+            user_id: ID del usuario
+            tokens_restantes: Saldo leído del perfil, o None si el perfil no existe
+            profile: Fila del perfil ya leída (email, tokens_exhausted_email_sent), opcional
+            
+        Returns:
+            tokens_restantes: Cantidad de tokens disponibles
+            
+        Raises:
+            HTTPException: Si el perfil no existe o los tokens están agotados
+        """
+        if tokens_restantes is None:
             raise HTTPException(
                 status_code=404,
                 detail="Perfil de usuario no encontrado"
             )
         
-        tokens_restantes = profile_response.data[0]["tokens_restantes"]
-        
         if tokens_restantes <= 0:
             # Enviar email al usuario cuando los tokens se agoten (solo una vez)
-            self._send_tokens_exhausted_email(user_id)
+            self._send_tokens_exhausted_email(user_id, profile)
             
             raise HTTPException(
                 status_code=402,
@@ -55,15 +245,17 @@ class TokenService:
         
         return tokens_restantes
     
-    def _send_tokens_exhausted_email(self, user_id: str):
+    def _send_tokens_exhausted_email(self, user_id: str, profile: Optional[Dict[str, Any]] = None):
         """Envía email al usuario cuando los tokens se agotan (solo una vez)."""
         try:
-            from lib.email import send_email
+            from lib.email import send_email, submit_email_task
             
-            # Verificar si ya se envió el email de tokens agotados
-            profile_check = self.supabase.table("profiles").select("email, tokens_exhausted_email_sent").eq("id", user_id).execute()
-            user_email = profile_check.data[0].get("email") if profile_check.data else None
-            email_already_sent = profile_check.data[0].get("tokens_exhausted_email_sent", False) if profile_check.data else False
+            # Verificar si ya se envió el email de tokens agotados (reutiliza el perfil si ya se leyó)
+            if profile is None or "tokens_exhausted_email_sent" not in profile:
+                profile_check = self.supabase.table("profiles").select("email, tokens_exhausted_email_sent").eq("id", user_id).execute()
+                profile = profile_check.data[0] if profile_check.data else {}
+            user_email = profile.get("email")
+            email_already_sent = profile.get("tokens_exhausted_email_sent", False)
             
             if user_email and not email_already_sent:
                 def send_tokens_exhausted_email():
@@ -72,50 +264,11 @@ class TokenService:
                         frontend_url = os.getenv("FRONTEND_URL", "https://www.codextrader.tech").strip('"').strip("'").strip()
                         billing_url = f"{frontend_url.rstrip('/')}/billing"
                         
-                        user_html = f"""
-                        <html>
-                        <body style="font-family: Arial, sans-serif; line-height: 1.8; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
-                            <div style="background: linear-gradient(135deg, #ef4444 0%, #dc2626 100%); padding: 30px; text-align: center; border-radius: 10px 10px 0 0;">
-                                <h1 style="color: white; margin: 0; font-size: 28px;">⚠️ Tus Tokens se Han Agotado</h1>
-                            </div>
-                            
-                            <div style="background: #ffffff; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
-                                <p style="font-size: 16px; margin-bottom: 20px;">
-                                    Hola <strong>{user_name}</strong>,
-                                </p>
-                                
-                                <p style="font-size: 16px; margin-bottom: 20px;">
-                                    Te informamos que tus tokens se han agotado. Para continuar usando Codex Trader, necesitas recargar tokens.
-                                </p>
-                                
-                                <div style="background: #fee2e2; padding: 20px; border-radius: 8px; border-left: 4px solid #ef4444; margin: 20px 0;">
-                                    <p style="margin: 0; color: #991b1b; font-weight: bold; font-size: 18px;">
-                                        Tokens restantes: 0
-                                    </p>
-                                </div>
-                                
-                                <div style="background: #f0fdf4; padding: 20px; border-radius: 8px; margin: 20px 0; border-left: 4px solid #10b981;">
-                                    <h3 style="color: #059669; margin-top: 0; font-size: 18px;">💡 Opciones para continuar:</h3>
-                                    <ul style="margin: 10px 0; padding-left: 20px; color: #333;">
-                                        <li style="margin-bottom: 10px;">Recargar tokens desde tu panel de cuenta</li>
-                                        <li style="margin-bottom: 10px;">Actualizar a un plan con más tokens mensuales</li>
-                                        <li style="margin-bottom: 0;">Contactarnos si necesitas ayuda</li>
-                                    </ul>
-                                </div>
-                                
-                                <div style="text-align: center; margin: 30px 0;">
-                                    <a href="{billing_url}" style="display: inline-block; background: #10b981; color: white; padding: 15px 30px; text-decoration: none; border-radius: 8px; font-weight: bold; font-size: 16px;">
-                                        💰 Recargar Tokens
-                                    </a>
-                                </div>
-                                
-                                <p style="font-size: 12px; margin-top: 30px; color: #666; text-align: center; border-top: 1px solid #e5e7eb; padding-top: 20px; line-height: 1.6;">
-                                    Si tienes alguna pregunta, no dudes en contactarnos respondiendo a este correo.
-                                </p>
-                            </div>
-                        </body>
-                        </html>
-                        """
+                        user_html = render_email(
+                            TOKENS_EXHAUSTED_HTML,
+                            user_name=user_name,
+                            billing_url=billing_url
+                        )
                         send_email(
                             to=user_email,
                             subject="⚠️ Tus tokens se han agotado - Codex Trader",
@@ -131,8 +284,7 @@ class TokenService:
                     except Exception as e:
                         logger.warning(f"⚠️ Error al enviar email de tokens agotados: {e}")
                 
-                email_thread = threading.Thread(target=send_tokens_exhausted_email, daemon=True)
-                email_thread.start()
+                submit_email_task(send_tokens_exhausted_email)
         except Exception as email_error:
             logger.warning(f"⚠️ Error al preparar email de tokens agotados: {email_error}")
     
@@ -145,11 +297,16 @@ class TokenService:
         input_tokens: int,
         output_tokens: int,
         query_preview: str,
-        response_mode: str
+        response_mode: str,
+        background_tasks: Optional[BackgroundTasks] = None
     ) -> int:
         """
         Descuenta tokens del usuario y maneja la lógica de uso justo.
         
+        Los efectos secundarios no críticos (registro de uso del modelo, emails
+        de alerta) se encolan en background_tasks si se proporciona; si no, se
+        ejecutan como antes (registro en línea, emails en el worker persistente de emails).
+        
         Args:
             user_id: ID del usuario
             tokens_used: Tokens totales usados
@@ -159,176 +316,180 @@ class TokenService:
             output_tokens: Tokens de salida
             query_preview: Vista previa de la consulta
             response_mode: Modo de respuesta (fast/deep)
+            background_tasks: BackgroundTasks de FastAPI de la request (opcional)
             
         Returns:
             nuevos_tokens: Tokens restantes después del descuento
         """
-        nuevos_tokens = tokens_restantes - tokens_used
+        # Descuento atómico vía RPC chat_finalize (devuelve el perfil actualizado)
+        profile_actualizado = self._finalize_via_rpc(user_id, tokens_used)
+        if profile_actualizado is not None:
+            nuevos_tokens = profile_actualizado.get("tokens_restantes", tokens_restantes - tokens_used)
+            tokens_restantes = nuevos_tokens + tokens_used
+        else:
+            nuevos_tokens = tokens_restantes - tokens_used
+            # Sin RPC: el UPDATE devuelve la fila actualizada, así los datos de
+            # uso justo llegan en la misma llamada (sin SELECT previo)
+            profile_actualizado = self._update_token_balance(user_id, nuevos_tokens)
+        invalidate_tokens_cache(user_id)
         
         # Registrar uso del modelo (no crítico si falla)
-        try:
-            log_model_usage_from_response(
-                user_id=str(user_id),
-                model=chat_model,
-                tokens_input=input_tokens,
-                tokens_output=output_tokens
-            )
-        except Exception as usage_error:
-            logger.warning(f"[BG] Error al registrar uso de modelo: {usage_error}")
+        if background_tasks is not None:
+            background_tasks.add_task(self._log_model_usage, user_id, chat_model, input_tokens, output_tokens)
+        else:
+            self._log_model_usage(user_id, chat_model, input_tokens, output_tokens)
         
-        # Guardar log en archivo local
-        try:
-            log_entry = {
-                "timestamp": datetime.now().isoformat(),
-                "user_id": str(user_id),
-                "model": chat_model,
-                "query_preview": (query_preview[:50] + "...") if len(query_preview) > 50 else query_preview,
-                "response_mode": response_mode,
-                "input_tokens": input_tokens,
-                "output_tokens": output_tokens,
-                "total_tokens": tokens_used,
-                "tokens_antes": tokens_restantes,
-                "tokens_despues": nuevos_tokens
-            }
-            log_file = "tokens_log.json"
-            log_data = []
-            if os.path.exists(log_file):
-                try:
-                    with open(log_file, "r", encoding="utf-8") as f:
-                        log_data = json.load(f)
-                except Exception:
-                    log_data = []
-            log_data.append(log_entry)
-            if len(log_data) > 100:
-                log_data = log_data[-100:]
-            with open(log_file, "w", encoding="utf-8") as f:
-                json.dump(log_data, f, indent=2, ensure_ascii=False)
-        except Exception as e:
-            logger.warning(f"[BG] ⚠ No se pudo guardar log de tokens: {e}")
+        # Guardar log en memoria (se vuelca a tokens_log.json periódicamente)
+        append_tokens_log({
+            "timestamp": datetime.now().isoformat(),
+            "user_id": str(user_id),
+            "model": chat_model,
+            "query_preview": (query_preview[:50] + "...") if len(query_preview) > 50 else query_preview,
+            "response_mode": response_mode,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": tokens_used,
+            "tokens_antes": tokens_restantes,
+            "tokens_despues": nuevos_tokens
+        })
         
-        # Preparar datos de actualización
-        update_data = {
-            "tokens_restantes": nuevos_tokens
-        }
+        # Flags de uso justo a actualizar (el saldo ya está descontado); solo se
+        # construye el dict si hay algo que actualizar
+        update_data = None
         
         # Lógica de uso justo (fair use)
         try:
-            profile_fair_use = self.supabase.table("profiles").select(
-                "tokens_monthly_limit, fair_use_warning_shown, fair_use_discount_eligible, fair_use_discount_used, fair_use_email_sent, current_plan, email"
-            ).eq("id", user_id).execute()
+            profile = profile_actualizado
             
-            if profile_fair_use.data:
-                profile = profile_fair_use.data[0]
+            if profile:
                 tokens_monthly_limit = profile.get("tokens_monthly_limit") or 0
                 
                 if tokens_monthly_limit > 0:
                     tokens_usados_total = tokens_monthly_limit - nuevos_tokens
-                    usage_percent = (tokens_usados_total / tokens_monthly_limit) * 100
+                    # Umbrales en enteros: el porcentaje (float) solo se calcula si se cruza uno
+                    reached_80 = tokens_usados_total * 10 >= tokens_monthly_limit * 8
+                    reached_90 = tokens_usados_total * 10 >= tokens_monthly_limit * 9
+                    if reached_80:
+                        usage_percent = (tokens_usados_total / tokens_monthly_limit) * 100
                     
                     # Aviso al 80% de uso
-                    if usage_percent >= 80 and not profile.get("fair_use_warning_shown", False):
-                        update_data["fair_use_warning_shown"] = True
+                    # (el consumidor de alertas marca fair_use_warning_shown y envía el email)
+                    if reached_80 and not profile.get("fair_use_warning_shown", False):
                         logger.info(f"[BG] WARNING: Usuario {user_id} alcanzó 80% de uso ({usage_percent:.1f}%)")
-                        self._send_80_percent_alert(user_id, user_email=profile.get("email"), current_plan=profile.get("current_plan"), tokens_monthly_limit=tokens_monthly_limit, nuevos_tokens=nuevos_tokens, usage_percent=usage_percent)
+                        alert_events.publish({
+                            "type": alert_events.FAIR_USE_80,
+                            "user_id": str(user_id),
+                            "user_email": profile.get("email"),
+                            "current_plan": profile.get("current_plan"),
+                            "tokens_monthly_limit": tokens_monthly_limit,
+                            "nuevos_tokens": nuevos_tokens,
+                            "usage_percent": usage_percent
+                        })
                     
                     # Elegibilidad para descuento al 90% de uso
-                    if usage_percent >= 90 and not profile.get("fair_use_discount_eligible", False):
-                        update_data["fair_use_discount_eligible"] = True
-                        update_data["fair_use_discount_eligible_at"] = datetime.utcnow().isoformat()
+                    if reached_90 and not profile.get("fair_use_discount_eligible", False):
+                        update_data = {
+                            "fair_use_discount_eligible": True,
+                            "fair_use_discount_eligible_at": datetime.utcnow().isoformat()
+                        }
                         logger.info(f"[BG] Usuario {user_id} alcanzó 90% de uso ({usage_percent:.1f}%) - Elegible para descuento del 20%")
                         
                         if not profile.get("fair_use_email_sent", False):
-                            self._send_90_percent_alert(user_id, profile_fair_use.data[0], nuevos_tokens, tokens_monthly_limit, usage_percent)
+                            self._send_90_percent_alert(user_id, profile, nuevos_tokens, tokens_monthly_limit, usage_percent, background_tasks=background_tasks)
         except Exception as e:
             error_str = str(e)
             if "42703" not in error_str and "PGRST205" not in error_str and "does not exist" not in error_str.lower():
                 logger.warning(f"[BG] Columnas de uso justo no disponibles: {e}")
         
-        # Actualizar tokens en la base de datos
+        # Actualizar flags de uso justo en la base de datos
         try:
-            self.supabase.table("profiles").update(update_data).eq("id", user_id).execute()
-            logger.info(f"[BG] Tokens descontados: {tokens_used}")
-            logger.info(f"[BG] Tokens restantes después: {nuevos_tokens}")
+            if update_data:
+                self.supabase.table("profiles").update(update_data).eq("id", user_id).execute()
+                invalidate_fair_use_cache(user_id)
         except Exception as e:
             logger.error(f"[BG] ERROR al actualizar tokens: {e}")
         
         return nuevos_tokens
     
-    def _send_80_percent_alert(self, user_id: str, user_email: Optional[str], current_plan: Optional[str], tokens_monthly_limit: int, nuevos_tokens: int, usage_percent: float):
-        """Envía alerta al admin cuando un usuario alcanza el 80% de uso."""
+    def _update_token_balance(self, user_id: str, nuevos_tokens: int) -> Optional[Dict[str, Any]]:
+        """
+        Guarda el nuevo saldo y devuelve el perfil actualizado (el UPDATE de
+        PostgREST devuelve la fila completa).
+        
+        Returns:
+            El perfil actualizado, o None si el UPDATE falló
+        """
         try:
-            from lib.email import send_admin_email
-            
-            def send_admin_80_percent_email():
-                try:
-                    admin_html = f"""
-                    <html>
-                    <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
-                        <div style="background: linear-gradient(135deg, #f59e0b 0%, #d97706 100%); padding: 20px; text-align: center; border-radius: 10px 10px 0 0;">
-                            <h2 style="color: white; margin: 0; font-size: 24px;">⚠️ Alerta: Usuario alcanzó 80% de límite</h2>
-                        </div>
-                        
-                        <div style="background: #ffffff; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
-                            <p style="font-size: 16px; margin-bottom: 20px;">
-                                Un usuario ha alcanzado el <strong>80% de su límite mensual de tokens</strong>.
-                            </p>
-                            
-                            <div style="background: #fef3c7; padding: 20px; border-radius: 8px; margin: 20px 0; border-left: 4px solid #f59e0b;">
-                                <ul style="list-style: none; padding: 0; margin: 0;">
-                                    <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                        <strong style="color: #92400e;">Email del usuario:</strong> 
-                                        <span style="color: #333;">{user_email or 'N/A'}</span>
-                                    </li>
-                                    <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                        <strong style="color: #92400e;">ID de usuario:</strong> 
-                                        <span style="color: #333; font-family: monospace; font-size: 12px;">{user_id}</span>
-                                    </li>
-                                    <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                        <strong style="color: #92400e;">Plan actual:</strong> 
-                                        <span style="color: #333;">{current_plan or 'N/A'}</span>
-                                    </li>
-                                    <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                        <strong style="color: #92400e;">Límite mensual:</strong> 
-                                        <span style="color: #333;">{tokens_monthly_limit:,} tokens</span>
-                                    </li>
-                                    <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                        <strong style="color: #92400e;">Tokens restantes:</strong> 
-                                        <span style="color: #333;">{nuevos_tokens:,} tokens</span>
-                                    </li>
-                                    <li style="margin-bottom: 0;">
-                                        <strong style="color: #92400e;">Porcentaje usado:</strong> 
-                                        <span style="color: #d97706; font-weight: bold; font-size: 18px;">{usage_percent:.1f}%</span>
-                                    </li>
-                                </ul>
-                            </div>
-                            
-                            <p style="font-size: 14px; color: #666; margin-top: 20px;">
-                                <strong>Nota:</strong> El usuario recibirá un aviso suave. Si alcanza el 90%, será elegible para un descuento del 20%.
-                            </p>
-                            
-                            <p style="font-size: 12px; color: #666; margin-top: 20px; text-align: center;">
-                                Fecha: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC
-                            </p>
-                        </div>
-                    </body>
-                    </html>
-                    """
-                    send_admin_email("⚠️ Alerta: Usuario alcanzó 80% de límite de tokens", admin_html)
-                except Exception as e:
-                    logger.warning(f"[BG] ⚠️ Error al enviar email al admin por 80% de uso: {e}")
-            
-            admin_thread = threading.Thread(target=send_admin_80_percent_email, daemon=True)
-            admin_thread.start()
+            response = self.supabase.table("profiles").update({
+                "tokens_restantes": nuevos_tokens
+            }).eq("id", user_id).execute()
+            return response.data[0] if response.data else None
+        except Exception as e:
+            logger.error(f"[BG] ERROR al actualizar tokens: {e}")
+            return None
+    
+    def _finalize_via_rpc(self, user_id: str, tokens_used: int) -> Optional[Dict[str, Any]]:
+        """
+        Descuenta tokens con la RPC chat_finalize (UPDATE atómico ... RETURNING).
+        
+        Returns:
+            El perfil actualizado, o None si la RPC no está disponible o falló
+            (en ese caso se usa un UPDATE normal).
+        """
+        if not self._chat_finalize_available:
+            return None
+        try:
+            response = self.supabase.rpc("chat_finalize", {
+                "p_user_id": str(user_id),
+                "p_tokens_usados": tokens_used
+            }).execute()
+            return response.data if isinstance(response.data, dict) else None
         except Exception as e:
-            logger.warning(f"[BG] ⚠️ Error al preparar email al admin por 80% de uso: {e}")
+            error_msg = str(e)
+            if "PGRST202" in error_msg or ("function" in error_msg.lower() and "does not exist" in error_msg.lower()):
+                self._chat_finalize_available = False
+                logger.warning("[BG] ⚠️ La función RPC 'chat_finalize' no existe en Supabase, usando UPDATE normal")
+            else:
+                logger.warning(f"[BG] Error en RPC chat_finalize: {error_msg[:200]}")
+            return None
+    
+    def _log_model_usage(self, user_id: str, chat_model: str, input_tokens: int, output_tokens: int):
+        """Registra el uso del modelo en model_usage_events (no crítico si falla)."""
+        try:
+            log_model_usage_from_response(
+                user_id=str(user_id),
+                model=chat_model,
+                tokens_input=input_tokens,
+                tokens_output=output_tokens
+            )
+        except Exception as usage_error:
+            logger.warning(f"[BG] Error al registrar uso de modelo: {usage_error}")
+    
+    def _schedule(self, func, background_tasks: Optional[BackgroundTasks] = None):
+        """
+        Ejecuta func fuera de la respuesta: como BackgroundTask de FastAPI si hay
+        una disponible (se añade a la cola que ya se está procesando), o en el
+        worker persistente de emails.
+        """
+        if background_tasks is not None:
+            background_tasks.add_task(func)
+        else:
+            from lib.email import submit_email_task
+            submit_email_task(func)
     
-    def _send_90_percent_alert(self, user_id: str, profile: Dict[str, Any], nuevos_tokens: int, tokens_monthly_limit: int, usage_percent: float):
+    def _send_90_percent_alert(self, user_id: str, profile: Dict[str, Any], nuevos_tokens: int, tokens_monthly_limit: int, usage_percent: float, background_tasks: Optional[BackgroundTasks] = None):
         """Envía alerta al usuario y admin cuando alcanza el 90% de uso."""
         try:
             user_email = profile.get("email")
             if not user_email:
                 return
             
+            # Evitar preparar y programar la alerta otra vez si ya salió desde este proceso
+            with self._notified_90_lock:
+                if user_id in self._notified_90:
+                    return
+                self._notified_90.add(user_id)
+            
             plan_name = "tu plan actual"
             current_plan_code_for_email = profile.get("current_plan")
             if current_plan_code_for_email:
@@ -356,32 +517,16 @@ class TokenService:
                     
                     suggested_plan = get_plan_by_code(suggested_plan_code)
                     
+                    # Cifras formateadas una sola vez para los dos emails
+                    usage_values = format_usage_values(nuevos_tokens, tokens_monthly_limit, usage_percent)
+                    
                     # Email al usuario
-                    email_html = f"""
-                    <html>
-                    <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
-                        <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 30px; text-align: center; border-radius: 12px;">
-                            <h1 style="color: white; margin: 0;">🚨 Alerta de Uso</h1>
-                        </div>
-                        <div style="background: white; padding: 30px; border-radius: 8px; margin-top: 20px;">
-                            <p>Has alcanzado el <strong>90% de tu límite</strong> en tu plan <strong>{plan_name_for_thread}</strong>.</p>
-                            <div style="background: #f0fdf4; padding: 20px; border-radius: 8px; margin: 20px 0;">
-                                <p><strong>📊 Tu uso actual:</strong></p>
-                                <p>Tokens restantes: <strong>{nuevos_tokens:,}</strong> de <strong>{tokens_monthly_limit:,}</strong></p>
-                                <p>Porcentaje usado: <strong>{usage_percent:.1f}%</strong></p>
-                            </div>
-                            <div style="background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%); color: white; padding: 25px; border-radius: 10px; text-align: center; margin: 25px 0;">
-                                <h2 style="margin: 0 0 10px 0;">🎁 ¡Descuento Especial del 20%!</h2>
-                                <p>Te ofrecemos un <strong>20% de descuento</strong> para actualizar tu plan.</p>
-                                <div style="background: white; color: #f5576c; padding: 15px 30px; border-radius: 8px; font-size: 24px; font-weight: bold; margin: 15px 0; display: inline-block;">CUPON20</div>
-                            </div>
-                            <div style="text-align: center; margin: 30px 0;">
-                                <a href="{planes_url}" style="display: inline-block; background: #667eea; color: white; padding: 15px 40px; text-decoration: none; border-radius: 8px; font-weight: bold;">Ver Planes y Aprovechar Descuento</a>
-                            </div>
-                        </div>
-                    </body>
-                    </html>
-                    """
+                    email_html = render_email(
+                        USER_90_PERCENT_HTML,
+                        plan_name=plan_name_for_thread,
+                        planes_url=planes_url,
+                        **usage_values
+                    )
                     
                     send_email(
                         to=user_email,
@@ -396,34 +541,28 @@ class TokenService:
                     logger.info(f"[BG] ✅ Email de alerta al 90% enviado a {user_email}")
                     
                     # Email al admin
-                    admin_html_90 = f"""
-                    <html>
-                    <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
-                        <div style="background: linear-gradient(135deg, #ef4444 0%, #dc2626 100%); padding: 20px; text-align: center; border-radius: 10px 10px 0 0;">
-                            <h2 style="color: white; margin: 0; font-size: 24px;">🚨 ALERTA CRÍTICA: Usuario alcanzó 90% de límite</h2>
-                        </div>
-                        
-                        <div style="background: #ffffff; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
-                            <p>Un usuario ha alcanzado el <strong>90% de su límite mensual de tokens</strong>.</p>
-                            <div style="background: #fee2e2; padding: 20px; border-radius: 8px; margin: 20px 0;">
-                                <p><strong>Email:</strong> {user_email}</p>
-                                <p><strong>ID:</strong> {user_id}</p>
-                                <p><strong>Plan:</strong> {plan_name_for_thread}</p>
-                                <p><strong>Uso:</strong> {usage_percent:.1f}%</p>
-                            </div>
-                        </div>
-                    </body>
-                    </html>
-                    """
+                    admin_html_90 = render_email(
+                        ADMIN_90_PERCENT_HTML,
+                        user_email=user_email,
+                        user_id=str(user_id),
+                        plan_name=plan_name_for_thread,
+                        usage_percent=usage_values["usage_percent"]
+                    )
                     send_admin_email("🚨 ALERTA CRÍTICA: Usuario alcanzó 90% de límite de tokens", admin_html_90)
                     logger.info(f"[BG] ✅ Email al admin enviado por 90% de uso de usuario {user_id}")
                 except Exception as e:
                     logger.warning(f"[BG] ⚠️ Error al enviar email de alerta al 90%: {e}")
+                    self.reset_usage_alerts(user_id)
             
-            email_thread = threading.Thread(target=send_90_percent_email_background, daemon=True)
-            email_thread.start()
+            self._schedule(send_90_percent_email_background, background_tasks)
         except Exception as e:
             logger.warning(f"[BG] ⚠️ Error al preparar envío de email al 90%: {e}")
+            self.reset_usage_alerts(user_id)
+    
+    def reset_usage_alerts(self, user_id: str):
+        """Permite volver a enviar la alerta del 90% (nuevo ciclo o envío fallido)."""
+        with self._notified_90_lock:
+            self._notified_90.discard(user_id)
 
 
 # Instancia global del servicio
@@ -2,12 +2,14 @@ import os
 import sys
 import re
 import zipfile
+import fnmatch
 import io
 import shutil
 import asyncio
 from urllib.parse import quote_plus
 from dotenv import load_dotenv, find_dotenv
 from pathlib import Path
+from functools import lru_cache
 
 # Agregar el directorio actual al path de Python para que pueda encontrar módulos locales
 # Esto es necesario en Railway donde el path puede ser diferente
@@ -21,13 +23,12 @@ if os.path.exists(lib_dir) and lib_dir not in sys.path:
     sys.path.insert(0, lib_dir)
 
 from fastapi import FastAPI, Depends, HTTPException, Header, Query, Request, BackgroundTasks
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 # from llama_index.core import VectorStoreIndex
 # from llama_index.embeddings.openai import OpenAIEmbedding
 # from llama_index.vector_stores.supabase import SupabaseVectorStore
-from supabase import create_client
 import litellm
 from sentence_transformers import SentenceTransformer
 import uvicorn
@@ -40,15 +41,27 @@ if sys.platform == 'win32':
     sys.stdout.reconfigure(encoding='utf-8')
 
 # Configurar logging a archivo
+# Los handlers de archivo y stdout corren en un hilo aparte (QueueListener): en la
+# request solo se encola el registro, sin esperar a la escritura en disco/stdout
+import atexit
 import logging
+import logging.handlers
+import queue
 from datetime import datetime
+_log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+_log_handlers = [
+    logging.FileHandler('backend.log', encoding='utf-8'),
+    logging.StreamHandler(sys.stdout)
+]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, *_log_handlers, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('backend.log', encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
 logger = logging.getLogger(__name__)
 
@@ -73,9 +86,24 @@ if not _runtime_env:
 if _runtime_env:
     load_dotenv(dotenv_path=_runtime_env, override=True)
 
+# pathspec (opcional) para aplicar el .gitignore en la ruta de descarga de emergencia
+try:
+    import pathspec
+    PATHSPEC_AVAILABLE = True
+except ImportError:
+    PATHSPEC_AVAILABLE = False
+
+# orjson (opcional): serialización de respuestas JSON más rápida que json de la stdlib
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 # Importar módulo de Stripe (opcional, solo si está configurado)
 try:
-    from lib.stripe_config import get_stripe_price_id, is_valid_plan_code, get_plan_code_from_price_id, STRIPE_WEBHOOK_SECRET
+    from lib.stripe_config import get_stripe_price_id, get_plan_code_from_price_id, STRIPE_WEBHOOK_SECRET
     # Importar stripe - lib.stripe_config ya lo importó correctamente, solo lo obtenemos de sys.modules
     import stripe
     # Verificar que stripe.api_key esté configurado y que stripe tenga checkout
@@ -585,8 +613,7 @@ if RAG_AVAILABLE:
             
             # IMPORTANTE: Enviar email al admin sobre el error crítico
             try:
-                from lib.email import send_critical_error_email
-                import threading
+                from lib.email import send_critical_error_email, submit_email_task
                 import traceback
                 
                 def send_error_email_background():
@@ -602,11 +629,10 @@ if RAG_AVAILABLE:
                                 "Error Type": "Critical System Error"
                             }
                         )
-                    except Exception as email_err:
-                        print(f"⚠️ Error al enviar email de error crítico: {email_err}")
+                    except Exception:
+                        logger.warning("⚠️ Error al enviar email de error crítico", exc_info=True)
                 
-                error_thread = threading.Thread(target=send_error_email_background, daemon=True)
-                error_thread.start()
+                submit_email_task(send_error_email_background)
             except Exception as email_error:
                 print(f"⚠️ Error al preparar email de error crítico: {email_error}")
         else:
@@ -629,7 +655,8 @@ try:
     if not SUPABASE_SERVICE_KEY:
         raise ValueError("SUPABASE_SERVICE_KEY no está configurada")
     
-    supabase_client = create_client(SUPABASE_REST_URL, SUPABASE_SERVICE_KEY)
+    from lib.dependencies import create_supabase_client
+    supabase_client = create_supabase_client(SUPABASE_REST_URL, SUPABASE_SERVICE_KEY)
     # Probar la conexión haciendo una consulta simple
     try:
         test_response = supabase_client.table("profiles").select("id").limit(1).execute()
@@ -673,7 +700,11 @@ logger.info(f"🌐 Frontend URL: {FRONTEND_URL}")
 logger.info("=" * 80)
 
 # Inicializar FastAPI
-app = FastAPI(title=config.API_TITLE, description=config.API_DESCRIPTION)
+app = FastAPI(
+    title=config.API_TITLE,
+    description=config.API_DESCRIPTION,
+    default_response_class=ORJSONResponse if ORJSON_AVAILABLE else JSONResponse
+)
 
 # IMPORTANTE: Configurar CORS PRIMERO, antes de cualquier router o middleware
 # Configurar CORS para permitir peticiones desde el frontend
@@ -776,14 +807,12 @@ try:
     app.include_router(users_router)
     logger.info("✅ Router de usuarios registrado")
     # Log de endpoints disponibles para debugging
-    logger.debug(f"[DEBUG] Router de usuarios incluye estos endpoints:")
+    logger.debug("[DEBUG] Router de usuarios incluye estos endpoints:")
     for route in users_router.routes:
         if hasattr(route, 'methods') and hasattr(route, 'path'):
             logger.debug(f"   {', '.join(route.methods)} {route.path}")
-except Exception as e:
-    logger.error(f"❌ No se pudo registrar router de usuarios: {e}")
-    import traceback
-    logger.error(f"❌ Traceback completo: {traceback.format_exc()}")
+except Exception:
+    logger.exception("❌ No se pudo registrar router de usuarios")
 
 # Registrar router de debug (para diagnóstico desde móvil)
 try:
@@ -793,6 +822,58 @@ try:
 except Exception as e:
     logger.warning(f"⚠️ No se pudo registrar router de debug: {e}")
 
+# Volcado periódico del log local de tokens (tokens_log.jsonl)
+@app.on_event("startup")
+async def start_tokens_log_flusher():
+    from lib.token_service import flush_tokens_log_periodically
+    app.state.tokens_log_flusher = asyncio.create_task(flush_tokens_log_periodically())
+
+
+@app.on_event("shutdown")
+async def stop_tokens_log_flusher():
+    from lib.token_service import flush_tokens_log
+    flusher = getattr(app.state, "tokens_log_flusher", None)
+    if flusher:
+        flusher.cancel()
+    flush_tokens_log()
+
+# Consumidor persistente de alertas de uso (emails al admin)
+@app.on_event("startup")
+async def start_alert_events_consumer():
+    from lib.alert_events import start_consumer
+    start_consumer()
+
+
+# Consumidor de la cola de webhooks de Stripe
+@app.on_event("startup")
+async def start_stripe_webhook_consumer():
+    from routers.billing import start_webhook_consumer
+    start_webhook_consumer()
+
+
+@app.on_event("shutdown")
+async def stop_stripe_webhook_consumer():
+    from routers.billing import stop_webhook_consumer
+    await stop_webhook_consumer()
+
+
+# Poller de consultas en background enviadas a la Batch API del proveedor
+@app.on_event("startup")
+async def start_batch_poller():
+    from lib.batch_service import batch_service
+    if not batch_service.enabled:
+        return
+    from routers.chat import complete_batch_job
+    app.state.batch_poller = asyncio.create_task(batch_service.poll_periodically(complete_batch_job))
+    logger.info("📦 Poller de Batch API iniciado")
+
+
+@app.on_event("shutdown")
+async def stop_batch_poller():
+    poller = getattr(app.state, "batch_poller", None)
+    if poller:
+        poller.cancel()
+
 # Middleware para logging de requests (para debugging)
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
@@ -818,7 +899,6 @@ async def log_requests(request: Request, call_next):
 @app.options("/{full_path:path}")
 async def options_handler(full_path: str, request: Request):
     """Maneja requests OPTIONS (preflight) para CORS"""
-    from fastapi.responses import Response
     origin = request.headers.get("origin")
     if origin in origins:
         return Response(
@@ -876,6 +956,108 @@ async def root():
 async def health():
     return {"status": "healthy", "message": "El motor de chat está listo"}
 
+class _ZipChunkStream(io.RawIOBase):
+    """
+    Destino no buscable para zipfile: acumula lo escrito hasta que se drena.
+    zipfile detecta que no admite seek/tell y usa descriptores de datos.
+    """
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+@lru_cache(maxsize=1)
+def _load_ignore_matcher(project_root_str: str):
+    """
+    Lee el .gitignore del proyecto y devuelve la función should_ignore(path, is_dir).
+    Se construye una sola vez por proceso.
+    """
+    gitignore_path = Path(project_root_str) / ".gitignore"
+    gitignore_lines = []
+    if gitignore_path.exists():
+        gitignore_lines = gitignore_path.read_text(encoding='utf-8').splitlines()
+    
+    if PATHSPEC_AVAILABLE:
+        # Patrones de .gitignore compilados una sola vez (semántica gitwildmatch)
+        ignore_spec = pathspec.PathSpec.from_lines("gitwildmatch", gitignore_lines)
+
+        def should_ignore(path_str: str, is_dir: bool = False) -> bool:
+            return ignore_spec.match_file(path_str + '/' if is_dir else path_str)
+    else:
+        # Nombres sueltos (node_modules, .venv, __pycache__...) -> búsqueda en set
+        # por componente de la ruta; el resto (comodines o rutas) -> fnmatch
+        dir_names = set()
+        path_prefixes = []
+        glob_patterns = []
+        for line in gitignore_lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            pattern = line.rstrip('/').lstrip('/')
+            if not pattern:
+                continue
+            if any(ch in pattern for ch in '*?['):
+                glob_patterns.append(pattern)
+            elif '/' in pattern:
+                path_prefixes.append(pattern)
+            else:
+                dir_names.add(pattern)
+        dir_names = frozenset(dir_names)
+        path_prefixes = tuple(path_prefixes)
+        path_prefix_dirs = tuple(prefix + '/' for prefix in path_prefixes)
+
+        # Función para verificar si un archivo debe ser ignorado
+        def should_ignore(path_str: str, is_dir: bool = False) -> bool:
+            parts = path_str.split('/')
+            if not dir_names.isdisjoint(parts):
+                return True
+            if path_prefixes and (path_str in path_prefixes or path_str.startswith(path_prefix_dirs)):
+                return True
+            name = parts[-1]
+            return any(
+                fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(path_str, pattern)
+                for pattern in glob_patterns
+            )
+    return should_ignore
+
+
+def _iter_project_files(root: str, should_ignore, rel: str = ""):
+    """
+    Recorre el proyecto con os.scandir y devuelve (ruta_absoluta, ruta_relativa)
+    de cada archivo no ignorado, sin entrar en los directorios ignorados.
+    """
+    try:
+        entries = list(os.scandir(root))
+    except OSError as e:
+        logger.warning(f"⚠️ No se pudo listar {rel or '.'}: {e}")
+        return
+    for entry in entries:
+        relative_path = f"{rel}/{entry.name}" if rel else entry.name
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                if not should_ignore(relative_path, is_dir=True):
+                    yield from _iter_project_files(entry.path, should_ignore, relative_path)
+            elif entry.is_dir():
+                # Enlace simbólico a un directorio: no se sigue (igual que os.walk)
+                continue
+            elif not should_ignore(relative_path):
+                yield entry.path, relative_path
+        except OSError as e:
+            logger.warning(f"⚠️ Error procesando {relative_path}: {e}")
+
+
 # RUTA TEMPORAL DE EMERGENCIA - DESCARGAR TODO EL CÓDIGO COMO ZIP
 # ⚠️ ESTA RUTA SE ELIMINARÁ AUTOMÁTICAMENTE DESPUÉS DE SER USADA
 _emergency_route_used = False  # Flag para controlar si la ruta ya fue usada
@@ -898,82 +1080,42 @@ async def download_emergency_code():
         # Obtener el directorio raíz del proyecto
         project_root = Path(__file__).parent
         
-        # Crear un buffer en memoria para el ZIP
-        zip_buffer = io.BytesIO()
-        
-        # Leer .gitignore para excluir archivos
-        gitignore_path = project_root / ".gitignore"
-        ignore_patterns = []
-        if gitignore_path.exists():
-            with open(gitignore_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#'):
-                        # Convertir patrones de .gitignore a patrones de path
-                        if line.endswith('/'):
-                            ignore_patterns.append(line[:-1])
-                        else:
-                            ignore_patterns.append(line)
-        
-        # Función para verificar si un archivo debe ser ignorado
-        def should_ignore(file_path: Path) -> bool:
-            relative_path = file_path.relative_to(project_root)
-            path_str = str(relative_path).replace('\\', '/')
-            
-            for pattern in ignore_patterns:
-                # Patrón simple de coincidencia
-                if pattern in path_str or path_str.startswith(pattern):
-                    return True
-                # Verificar si es un directorio completo
-                if '/' in path_str:
-                    parts = path_str.split('/')
-                    if pattern in parts:
-                        return True
-            return False
+        # Patrones de .gitignore (se leen y compilan una sola vez por proceso)
+        should_ignore = _load_ignore_matcher(str(project_root))
         
-        # Crear el archivo ZIP
-        files_added = 0
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # Recorrer todos los archivos del proyecto
-            for root, dirs, files in os.walk(project_root):
-                # Filtrar directorios a ignorar
-                dirs[:] = [d for d in dirs if not should_ignore(Path(root) / d)]
-                
-                for file in files:
-                    file_path = Path(root) / file
+        # Generar el ZIP por partes: cada archivo comprimido se envía en cuanto está
+        # listo, sin construir el archivo completo en memoria
+        def generate_zip():
+            zip_stream = _ZipChunkStream()
+            files_added = 0
+            with zipfile.ZipFile(zip_stream, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                # Recorrer todos los archivos del proyecto
+                for file_path, relative_path in _iter_project_files(str(project_root), should_ignore):
+                    # Agregar el archivo al ZIP (zipfile lo lee y comprime por bloques)
                     try:
-                        # Verificar si el archivo debe ser ignorado
-                        if should_ignore(file_path):
-                            continue
-                        
-                        # Obtener la ruta relativa para el ZIP
-                        relative_path = file_path.relative_to(project_root)
-                        
-                        # Leer y agregar el archivo al ZIP
-                        try:
-                            with open(file_path, 'rb') as f:
-                                zip_file.writestr(str(relative_path), f.read())
-                            files_added += 1
-                        except (PermissionError, IOError) as e:
-                            logger.warning(f"⚠️ No se pudo leer {relative_path}: {e}")
-                            continue
+                        zip_file.write(file_path, arcname=relative_path)
+                        files_added += 1
+                    except (PermissionError, IOError) as e:
+                        logger.warning(f"⚠️ No se pudo leer {relative_path}: {e}")
+                        continue
                     except Exception as e:
                         logger.warning(f"⚠️ Error procesando {file_path}: {e}")
                         continue
+                    
+                    chunk = zip_stream.drain()
+                    if chunk:
+                        yield chunk
+            
+            # Directorio central del ZIP (se escribe al cerrar)
+            yield zip_stream.drain()
+            logger.info(f"✅ ZIP generado con {files_added} archivos")
         
-        logger.info(f"✅ ZIP generado con {files_added} archivos")
-        
-        # Preparar la respuesta con el archivo ZIP
-        zip_buffer.seek(0)
-        zip_data = zip_buffer.read()
-        
-        # Crear respuesta con el archivo ZIP
-        response = Response(
-            content=zip_data,
+        # Crear respuesta con el archivo ZIP (transferencia por chunks, sin Content-Length)
+        response = StreamingResponse(
+            generate_zip(),
             media_type="application/zip",
             headers={
-                "Content-Disposition": "attachment; filename=emergency-code-backup.zip",
-                "Content-Length": str(len(zip_data))
+                "Content-Disposition": "attachment; filename=emergency-code-backup.zip"
             }
         )
         
@@ -985,10 +1127,11 @@ async def download_emergency_code():
         async def disable_route_after_delay():
             await asyncio.sleep(3)  # Esperar 3 segundos para que la descarga comience
             try:
-                # Intentar eliminar la ruta de la aplicación
-                routes_to_remove = [route for route in app.routes if hasattr(route, 'path') and route.path == "/download-emergency-xyz789"]
-                for route in routes_to_remove:
-                    app.routes.remove(route)
+                # Intentar eliminar la ruta de la aplicación (una sola pasada, en el sitio)
+                app.router.routes[:] = [
+                    route for route in app.router.routes
+                    if getattr(route, 'path', None) != "/download-emergency-xyz789"
+                ]
                 logger.warning("🗑️ RUTA TEMPORAL /download-emergency-xyz789 ELIMINADA DEL ROUTER")
             except Exception as e:
                 logger.error(f"❌ Error al eliminar ruta temporal del router: {e}")
@@ -12,6 +12,7 @@ Los análisis con imágenes (gráficas) consumen aproximadamente 4x más tokens
 que los análisis de texto debido al procesamiento adicional con Gemini.
 """
 
+from functools import lru_cache
 from typing import Literal, Optional
 from dataclasses import dataclass
 
@@ -89,7 +90,11 @@ CODEX_PLANS: list[CodexPlan] = [
     )
 ]
 
+# Códigos de plan para validar con una búsqueda O(1)
+_PLAN_CODES = frozenset(p.code for p in CODEX_PLANS)
 
+
+@lru_cache(maxsize=32)
 def get_plan_by_code(code: PlanCode) -> Optional[CodexPlan]:
     """
     Obtiene un plan por su código.
@@ -123,5 +128,5 @@ def is_valid_plan_code(code: str) -> bool:
     Returns:
         True si el código es válido, False en caso contrario
     """
-    return any(p.code == code for p in CODEX_PLANS)
+    return code in _PLAN_CODES
 
@@ -4,7 +4,7 @@ Proporciona métricas y estadísticas del sistema.
 """
 from fastapi import APIRouter, Depends, HTTPException, Header
 from typing import Optional
-from supabase import create_client
+from lib.dependencies import create_supabase_client
 import os
 import logging
 from urllib.parse import urlparse
@@ -89,7 +89,7 @@ elif SUPABASE_URL_LEGACY and SUPABASE_URL_LEGACY.startswith("postgresql://"):
 supabase_admin_client = None
 if SUPABASE_REST_URL and SUPABASE_SERVICE_KEY:
     try:
-        supabase_admin_client = create_client(SUPABASE_REST_URL, SUPABASE_SERVICE_KEY)
+        supabase_admin_client = create_supabase_client(SUPABASE_REST_URL, SUPABASE_SERVICE_KEY)
         logger.info("✅ Cliente de Supabase admin inicializado")
     except Exception as e:
         logger.error(f"❌ Error al inicializar cliente de Supabase admin: {e}")
@@ -129,7 +129,6 @@ async def get_admin_user(authorization: Optional[str] = Header(None)):
             )
         
         # Validar token con Supabase
-        # Crear cliente temporal para validar token
         if not SUPABASE_REST_URL:
             raise HTTPException(
                 status_code=500,
@@ -142,9 +141,14 @@ async def get_admin_user(authorization: Optional[str] = Header(None)):
                 detail="SUPABASE_SERVICE_KEY no configurada"
             )
         
-        # Usar el cliente admin para validar el token del usuario
-        temp_client = create_client(SUPABASE_REST_URL, SUPABASE_SERVICE_KEY)
-        user_response = temp_client.auth.get_user(token)
+        if supabase_admin_client is None:
+            raise HTTPException(
+                status_code=500,
+                detail="Cliente de Supabase admin no inicializado"
+            )
+        
+        # Usar el cliente admin global para validar el token del usuario
+        user_response = supabase_admin_client.auth.get_user(token)
         
         if not user_response.user:
             raise HTTPException(
@@ -165,8 +169,7 @@ async def get_admin_user(authorization: Optional[str] = Header(None)):
         
         # Alternativa: verificar campo is_admin en profiles
         try:
-            temp_client = create_client(SUPABASE_REST_URL, SUPABASE_SERVICE_KEY)
-            profile_response = temp_client.table("profiles").select("is_admin").eq("id", user_id).execute()
+            profile_response = supabase_admin_client.table("profiles").select("is_admin").eq("id", user_id).execute()
             if profile_response.data and profile_response.data[0].get("is_admin", False):
                 return user_response.user
         except:
@@ -2,22 +2,36 @@
 Router para endpoints de billing y Stripe.
 """
 import os
+import hmac
+import json
+import time
+import atexit
+import asyncio
+import hashlib
 import logging
-from typing import Optional
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Tuple
 from fastapi import APIRouter, Depends, HTTPException, Request, BackgroundTasks
 from fastapi.responses import JSONResponse
 from datetime import datetime
-import threading
 
 from lib.dependencies import get_user, supabase_client
 from lib.config_shared import STRIPE_AVAILABLE, FRONTEND_URL
+from lib.token_service import (
+    token_service,
+    invalidate_tokens_cache,
+    is_fair_use_not_claimable,
+    remember_fair_use_not_claimable
+)
 from routers.models import CheckoutSessionInput
+from plans import get_plan_by_code
+from lib.email_templates import render_email, CHECKOUT_ADMIN_HTML, CHECKOUT_USER_HTML
 
 # Importar stripe y funciones de configuración
 try:
     from lib.stripe_config import (
         get_stripe_price_id,
-        is_valid_plan_code,
         get_plan_code_from_price_id,
         STRIPE_WEBHOOK_SECRET,
         STRIPE_FAIR_USE_COUPON_ID
@@ -26,7 +40,6 @@ try:
 except ImportError:
     stripe = None
     get_stripe_price_id = None
-    is_valid_plan_code = None
     get_plan_code_from_price_id = None
     STRIPE_WEBHOOK_SECRET = None
     STRIPE_FAIR_USE_COUPON_ID = None
@@ -36,6 +49,142 @@ logger = logging.getLogger(__name__)
 # Crear router
 billing_router = APIRouter(tags=["billing"])
 
+def _normalize_frontend_url(url: str) -> str:
+    """URL raíz del frontend para las redirecciones de checkout (sin /app y con www)."""
+    frontend_base_url = url.rstrip('/')
+    # Eliminar explícitamente /app si está al final
+    if frontend_base_url.endswith('/app'):
+        frontend_base_url = frontend_base_url[:-4]
+    frontend_base_url = frontend_base_url.rstrip('/')
+    
+    # Normalizar: si la URL no tiene www pero el dominio es codextrader.tech, añadir www
+    if 'codextrader.tech' in frontend_base_url and 'www.' not in frontend_base_url:
+        frontend_base_url = frontend_base_url.replace('https://codextrader.tech', 'https://www.codextrader.tech')
+        frontend_base_url = frontend_base_url.replace('http://codextrader.tech', 'http://www.codextrader.tech')
+    return frontend_base_url
+
+
+# Se calcula una vez al importar (main.py inicializa config_shared antes de importar los routers)
+FRONTEND_BASE_URL = _normalize_frontend_url(FRONTEND_URL or os.getenv("FRONTEND_URL", "https://www.codextrader.tech"))
+logger.info(f"🌐 FRONTEND_URL configurada: {FRONTEND_URL}, frontend_base_url procesada: {FRONTEND_BASE_URL}")
+
+# URLs de retorno del checkout (apuntan a la raíz / y no a /app). Stripe
+# sustituye {CHECKOUT_SESSION_ID} por el id real de la sesión.
+SUCCESS_URL_TEMPLATE = f"{FRONTEND_BASE_URL}/?checkout=success&session_id={{CHECKOUT_SESSION_ID}}"
+CANCEL_URL = f"{FRONTEND_BASE_URL}/?checkout=cancelled"
+
+# El SDK de Stripe es síncrono: sus llamadas HTTP van a un pool propio para no
+# bloquear el event loop ni ocupar el executor por defecto (Supabase, etc.)
+_STRIPE_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="stripe")
+atexit.register(_STRIPE_EXECUTOR.shutdown, wait=False)
+
+
+async def _stripe_call(func, *args, **kwargs):
+    """Ejecuta una llamada bloqueante del SDK de Stripe en el pool de Stripe."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_STRIPE_EXECUTOR, partial(func, *args, **kwargs))
+
+
+# Se desactiva si la función SQL complete_checkout no está creada en Supabase
+_complete_checkout_available = True
+
+# Columnas del perfil que usa el checkout cuando no está la RPC complete_checkout
+_CHECKOUT_PROFILE_COLUMNS = "tokens_restantes, tokens_monthly_limit, email, fair_use_discount_eligible"
+
+
+def _complete_checkout_rpc(
+    user_id: str,
+    plan_code: Optional[str],
+    tokens_per_month: Optional[int],
+    customer_id: str,
+    period_end: Optional[str],
+    fair_use_applied: bool,
+    payment: Optional[dict] = None
+) -> Optional[list]:
+    """
+    Aplica el checkout al perfil con la RPC complete_checkout (una sola llamada,
+    lectura y escritura en la misma transacción) y registra el pago inicial.
+    
+    Args:
+        payment: invoice_id, amount_usd, currency y payment_date del pago para
+            stripe_payments (None si no hay monto que registrar)
+    
+    Returns:
+        Filas devueltas por la RPC (email, tokens_anteriores, tokens_restantes,
+        primera_suscripcion, pago_registrado; vacía si el perfil no existe), o
+        None si la función no existe y hay que usar las consultas separadas
+    """
+    payment = payment or {}
+    global _complete_checkout_available
+    try:
+        response = supabase_client.rpc("complete_checkout", {
+            "p_user_id": str(user_id),
+            "p_plan_code": plan_code,
+            "p_tokens_per_month": tokens_per_month,
+            "p_customer_id": customer_id,
+            "p_period_end": period_end,
+            "p_fair_use_applied": fair_use_applied,
+            "p_invoice_id": payment.get("invoice_id"),
+            "p_amount_usd": payment.get("amount_usd"),
+            "p_currency": payment.get("currency", "usd"),
+            "p_payment_date": payment.get("payment_date")
+        }).execute()
+        return response.data or []
+    except Exception as e:
+        error_msg = str(e)
+        if "PGRST202" in error_msg or ("function" in error_msg.lower() and "does not exist" in error_msg.lower()):
+            _complete_checkout_available = False
+            logger.warning("⚠️ La función RPC 'complete_checkout' no existe en Supabase, usando SELECT + UPDATE + INSERT")
+            return None
+        raise
+
+
+# Se desactiva si la tabla processed_stripe_events no está creada en Supabase
+_processed_events_available = True
+
+
+def _processed_events_error(e: Exception) -> None:
+    """Desactiva la deduplicación si la tabla no existe; si no, solo avisa."""
+    global _processed_events_available
+    error_msg = str(e)
+    if "PGRST205" in error_msg or "42P01" in error_msg or "does not exist" in error_msg.lower():
+        _processed_events_available = False
+        logger.warning("⚠️ La tabla 'processed_stripe_events' no existe en Supabase, webhooks sin deduplicar")
+    else:
+        logger.warning("⚠️ Error consultando processed_stripe_events: %s", e)
+
+
+def _is_stripe_event_processed(event_id: Optional[str]) -> bool:
+    """True si el evento de Stripe ya se procesó con éxito (reintento o entrega duplicada)."""
+    if not event_id or not _processed_events_available:
+        return False
+    try:
+        response = supabase_client.table("processed_stripe_events").select("event_id").eq(
+            "event_id", event_id
+        ).limit(1).execute()
+        return bool(response.data)
+    except Exception as e:
+        _processed_events_error(e)
+        return False
+
+
+def _mark_stripe_event_processed(event_id: Optional[str]):
+    """
+    Registra el evento como procesado (INSERT con event_id como PK).
+    
+    Se llama solo cuando el handler terminó sin error: si falla o el proceso
+    muere con el evento en la cola, un reenvío de Stripe lo vuelve a procesar.
+    """
+    if not event_id or not _processed_events_available:
+        return
+    try:
+        supabase_client.table("processed_stripe_events").insert({"event_id": event_id}).execute()
+    except Exception as e:
+        error_msg = str(e)
+        if "23505" in error_msg or "duplicate key" in error_msg.lower():
+            return
+        _processed_events_error(e)
+
 
 @billing_router.post("/billing/create-checkout-session")
 async def create_checkout_session(
@@ -52,7 +201,7 @@ async def create_checkout_session(
     Retorna:
     - url: URL de la sesión de checkout de Stripe para redirigir al usuario
     """
-    logger.info(f"🔔 Creando checkout session - Método: {request.method}, Plan: {checkout_input.planCode}, Usuario: {user.email}")
+    logger.info("🔔 Creando checkout session - Método: %s, Plan: %s, Usuario: %s", request.method, checkout_input.planCode, user.email)
     
     if not STRIPE_AVAILABLE or not stripe:
         raise HTTPException(
@@ -61,28 +210,8 @@ async def create_checkout_session(
         )
     
     try:
-        # URL del frontend (usar la variable global ya configurada)
-        frontend_base_url = (FRONTEND_URL or os.getenv("FRONTEND_URL", "https://www.codextrader.tech")).rstrip('/')
-        # Eliminar explícitamente /app si está al final
-        if frontend_base_url.endswith('/app'):
-            frontend_base_url = frontend_base_url[:-4]
-        frontend_base_url = frontend_base_url.rstrip('/')
-        
-        # Normalizar: si la URL no tiene www pero el dominio es codextrader.tech, añadir www
-        if 'codextrader.tech' in frontend_base_url and 'www.' not in frontend_base_url:
-            frontend_base_url = frontend_base_url.replace('https://codextrader.tech', 'https://www.codextrader.tech')
-            frontend_base_url = frontend_base_url.replace('http://codextrader.tech', 'http://www.codextrader.tech')
-        
-        logger.info(f"🌐 FRONTEND_URL configurada: {FRONTEND_URL}, frontend_base_url procesada: {frontend_base_url}")
-        
-        plan_code = checkout_input.planCode.lower()
-        
-        # Validar que el código de plan sea válido
-        if not is_valid_plan_code or not is_valid_plan_code(plan_code):
-            raise HTTPException(
-                status_code=400,
-                detail=f"Código de plan inválido: {plan_code}. Debe ser uno de: gratis, explorer, trader, pro, institucional"
-            )
+        # CheckoutSessionInput ya validó el código y lo pasó a minúsculas
+        plan_code = checkout_input.planCode
         
         # Si es el plan gratis, no crear checkout de Stripe
         if plan_code == "gratis":
@@ -103,29 +232,32 @@ async def create_checkout_session(
         user_id = user.id
         user_email = user.email
         
-        # IMPORTANTE: Verificar elegibilidad para descuento de uso justo (Fair Use)
+        # IMPORTANTE: Descuento de uso justo (Fair Use). Se reclama con un UPDATE
+        # condicional (elegible y aún no usado): si devuelve la fila, esta request
+        # marcó el descuento como usado y aplica el cupón. Una sola llamada y sin
+        # carrera entre dos checkouts simultáneos.
         discounts = None
-        if STRIPE_FAIR_USE_COUPON_ID:
+        if STRIPE_FAIR_USE_COUPON_ID and not is_fair_use_not_claimable(user_id):
             try:
-                profile_response = supabase_client.table("profiles").select(
-                    "fair_use_discount_eligible, fair_use_discount_used"
-                ).eq("id", user_id).execute()
+                claim_response = await asyncio.to_thread(
+                    supabase_client.table("profiles").update({
+                        "fair_use_discount_used": True
+                    }).eq("id", user_id).eq("fair_use_discount_eligible", True).or_(
+                        "fair_use_discount_used.is.null,fair_use_discount_used.eq.false"
+                    ).execute
+                )
                 
-                if profile_response.data:
-                    profile = profile_response.data[0]
-                    fair_use_eligible = profile.get("fair_use_discount_eligible", False)
-                    fair_use_used = profile.get("fair_use_discount_used", False)
-                    
-                    # Aplicar cupón si es elegible y aún no lo ha usado
-                    if fair_use_eligible and not fair_use_used:
-                        discounts = [{"coupon": STRIPE_FAIR_USE_COUPON_ID}]
-                        logger.info(f"✅ Aplicando cupón de uso justo (20% OFF) para usuario {user_id}")
+                if claim_response.data:
+                    discounts = [{"coupon": STRIPE_FAIR_USE_COUPON_ID}]
+                    logger.info("✅ Aplicando cupón de uso justo (20%% OFF) para usuario %s", user_id)
+                # Reclamado ahora o no disponible: en ambos casos no se puede volver a reclamar
+                remember_fair_use_not_claimable(user_id)
             except Exception as e:
                 error_msg = str(e)
                 if "does not exist" in error_msg or "42703" in error_msg:
-                    logger.warning(f"⚠️ Columnas de fair use no disponibles, omitiendo descuento: {error_msg[:100]}")
+                    logger.warning("⚠️ Columnas de fair use no disponibles, omitiendo descuento: %.100s", error_msg)
                 else:
-                    logger.warning(f"⚠️ Error al verificar elegibilidad de fair use: {error_msg[:100]}")
+                    logger.warning("⚠️ Error al verificar elegibilidad de fair use: %.100s", error_msg)
         
         metadata = {
             "user_id": user_id,
@@ -136,19 +268,6 @@ async def create_checkout_session(
         # Si se aplicó descuento, agregarlo a metadata para tracking
         if discounts:
             metadata["fair_use_discount_applied"] = "true"
-            try:
-                supabase_client.table("profiles").update({
-                    "fair_use_discount_used": True
-                }).eq("id", user_id).execute()
-                logger.info(f"✅ Descuento de uso justo marcado como usado para usuario {user_id}")
-            except Exception as e:
-                logger.warning(f"⚠️ No se pudo marcar descuento como usado (no crítico): {e}")
-        
-        # Asegurar que la URL de éxito apunte a la raíz (/) y no a /app
-        success_url = f"{frontend_base_url}/?checkout=success&session_id={{CHECKOUT_SESSION_ID}}"
-        cancel_url = f"{frontend_base_url}/?checkout=cancelled"
-        
-        logger.info(f"🔗 URLs de checkout configuradas - Success: {success_url}, Cancel: {cancel_url}")
         
         # Crear la sesión de checkout de Stripe
         checkout_session_params = {
@@ -159,9 +278,14 @@ async def create_checkout_session(
                     "quantity": 1,
                 }
             ],
-            "success_url": success_url,
-            "cancel_url": cancel_url,
+            "success_url": SUCCESS_URL_TEMPLATE,
+            "cancel_url": CANCEL_URL,
             "metadata": metadata,
+            # La suscripción lleva el user_id para que invoice.paid encuentre al
+            # usuario aunque llegue antes que checkout.session.completed
+            "subscription_data": {
+                "metadata": {"user_id": user_id, "plan_code": plan_code}
+            },
             "customer_email": user_email,
         }
         
@@ -169,7 +293,7 @@ async def create_checkout_session(
         if discounts:
             checkout_session_params["discounts"] = discounts
         
-        session = stripe.checkout.Session.create(**checkout_session_params)
+        session = await _stripe_call(stripe.checkout.Session.create, **checkout_session_params)
         
         return {"url": session.url}
         
@@ -188,6 +312,65 @@ async def create_checkout_session(
         )
 
 
+# Antigüedad máxima de la firma de un webhook (mismo valor por defecto que el SDK)
+WEBHOOK_TOLERANCE_SECONDS = 300
+
+
+def _parse_stripe_signature(sig_header: Optional[str]) -> Optional[Tuple[int, List[str]]]:
+    """Extrae el timestamp y las firmas v1 de la cabecera Stripe-Signature (None si no tiene timestamp)."""
+    timestamp = None
+    signatures = []
+    for item in (sig_header or "").split(","):
+        key, _, value = item.strip().partition("=")
+        if key == "t" and value.isdigit():
+            timestamp = int(value)
+        elif key == "v1" and value and value.isascii():
+            # Una firma no ASCII haría fallar compare_digest con TypeError (500)
+            signatures.append(value)
+    if timestamp is None:
+        return None
+    return timestamp, signatures
+
+
+async def _read_verified_webhook(request: Request, sig_header: Optional[str], webhook_secret: str):
+    """
+    Lee el body del webhook calculando el HMAC-SHA256 a medida que llegan los
+    chunks y devuelve el evento ya verificado.
+    
+    Si la cabecera no tiene timestamp (t=...) se usa construct_event del SDK.
+    
+    Raises:
+        stripe.error.SignatureVerificationError: si la firma no es válida o es demasiado antigua
+    """
+    parsed = _parse_stripe_signature(sig_header)
+    if parsed is None:
+        payload = await request.body()
+        return stripe.Webhook.construct_event(payload, sig_header, webhook_secret)
+    
+    timestamp, signatures = parsed
+    if not signatures:
+        raise stripe.error.SignatureVerificationError(
+            "No signatures found with expected scheme", sig_header
+        )
+    mac = hmac.new(webhook_secret.encode("utf-8"), f"{timestamp}.".encode("utf-8"), hashlib.sha256)
+    chunks = []
+    async for chunk in request.stream():
+        mac.update(chunk)
+        chunks.append(chunk)
+    payload = b"".join(chunks)
+    
+    expected = mac.hexdigest()
+    if not any(hmac.compare_digest(expected, signature) for signature in signatures):
+        raise stripe.error.SignatureVerificationError(
+            "No signatures found matching the expected signature for payload", sig_header, payload
+        )
+    if timestamp < time.time() - WEBHOOK_TOLERANCE_SECONDS:
+        raise stripe.error.SignatureVerificationError(
+            "Timestamp outside the tolerance zone", sig_header, payload
+        )
+    return stripe.Event.construct_from(json.loads(payload), stripe.api_key)
+
+
 @billing_router.post("/billing/stripe-webhook")
 async def stripe_webhook(request: Request, background_tasks: BackgroundTasks):
     """
@@ -196,7 +379,6 @@ async def stripe_webhook(request: Request, background_tasks: BackgroundTasks):
     """
     logger.info("🔔 Webhook endpoint llamado")
     try:
-        payload = await request.body()
         sig_header = request.headers.get("stripe-signature")
         
         # Verificar que el webhook secret esté configurado
@@ -210,22 +392,28 @@ async def stripe_webhook(request: Request, background_tasks: BackgroundTasks):
         
         logger.info(f"🔐 Verificando firma del webhook...")
         
-        # Verifica webhook
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, webhook_secret
-        )
+        # Verifica webhook (la firma se calcula mientras se recibe el body)
+        event = await _read_verified_webhook(request, sig_header, webhook_secret)
         
         logger.info(f"✅ Webhook recibido y verificado: {event['type']}")
         
-        # IMPORTANTE: Procesar eventos en background para responder rápidamente a Stripe
+        # Reintentos de Stripe: si el evento ya se procesó no se repite el trabajo
+        # (sumaría los tokens del plan dos veces)
+        if event["type"] in _WEBHOOK_HANDLERS:
+            if await asyncio.to_thread(_is_stripe_event_processed, event.get("id")):
+                logger.info(f"🔁 Webhook {event.get('id')} ya procesado, se ignora")
+                return {"status": "duplicate"}
+        
+        # IMPORTANTE: Solo se encola el evento para responder rápidamente a Stripe;
+        # el consumidor de webhooks hace el trabajo pesado (DB, Stripe, emails)
         if event["type"] == "checkout.session.completed":
             session = event["data"]["object"]
-            logger.info(f"🛒 Procesando checkout.session.completed para sesión: {session.get('id')} (en background)")
-            background_tasks.add_task(handle_checkout_session_completed, session)
+            logger.info(f"🛒 Encolando checkout.session.completed para sesión: {session.get('id')}")
+            _enqueue_webhook_event(event["type"], session, event.get("id"), background_tasks)
         elif event["type"] == "invoice.paid":
             invoice = event["data"]["object"]
-            logger.info(f"💰 Procesando invoice.paid para invoice: {invoice.get('id')} (en background)")
-            background_tasks.add_task(handle_invoice_paid, invoice)
+            logger.info(f"💰 Encolando invoice.paid para invoice: {invoice.get('id')}")
+            _enqueue_webhook_event(event["type"], invoice, event.get("id"), background_tasks)
         
         # Responder inmediatamente a Stripe (no esperar el procesamiento)
         return {"status": "success"}
@@ -268,6 +456,11 @@ async def handle_checkout_session_completed(session: dict):
         # Extraer información de la sesión
         customer_id = session.get("customer")
         subscription_id = session.get("subscription")
+        # Si la suscripción llega expandida en el payload no hace falta pedirla a Stripe
+        expanded_subscription = None
+        if isinstance(subscription_id, dict):
+            expanded_subscription = subscription_id
+            subscription_id = expanded_subscription.get("id")
         metadata = session.get("metadata", {})
         user_id = metadata.get("user_id")
         plan_code = metadata.get("plan_code")
@@ -275,288 +468,274 @@ async def handle_checkout_session_completed(session: dict):
         user_email_from_metadata = metadata.get("user_email")
         
         if not user_id:
-            print(f"⚠️ checkout.session.completed sin user_id en metadata: {session.get('id')}")
+            logger.warning("⚠️ checkout.session.completed sin user_id en metadata: %s", session.get("id"))
             return
         
         if not customer_id:
-            print(f"⚠️ checkout.session.completed sin customer_id: {session.get('id')}")
+            logger.warning("⚠️ checkout.session.completed sin customer_id: %s", session.get("id"))
             return
         
+        # Suscripción (Stripe) y perfil (Supabase) en paralelo
+        async def fetch_subscription():
+            if expanded_subscription is not None and expanded_subscription.get("current_period_end"):
+                return expanded_subscription
+            if not subscription_id:
+                return None
+            # La última invoice viene expandida en la misma llamada
+            return await _stripe_call(stripe.Subscription.retrieve, subscription_id, expand=["latest_invoice"])
+        
+        async def fetch_profile():
+            # Con la RPC complete_checkout no hace falta leer el perfil antes
+            if _complete_checkout_available:
+                return None
+            return await asyncio.to_thread(
+                supabase_client.table("profiles").select(_CHECKOUT_PROFILE_COLUMNS).eq("id", user_id).execute
+            )
+        
+        subscription, profile_response = await asyncio.gather(
+            fetch_subscription(), fetch_profile(), return_exceptions=True
+        )
+        if isinstance(subscription, Exception):
+            logger.warning("⚠️ Error al obtener suscripción %s: %s", subscription_id, subscription)
+            subscription = None
+        
         # Obtener información de la suscripción para current_period_end
-        current_period_end = None
-        if subscription_id:
+        current_period_end = subscription.get("current_period_end") if subscription is not None else None
+        
+        # La última invoice (monto pagado) la usan el registro del pago y los emails.
+        # Normalmente ya viene expandida en la suscripción; si solo llega su ID se
+        # pide una vez
+        async def fetch_latest_invoice():
+            latest_invoice = subscription.get("latest_invoice") if subscription is not None else None
+            if not latest_invoice:
+                return None
+            if not isinstance(latest_invoice, str):
+                return latest_invoice
             try:
-                subscription = stripe.Subscription.retrieve(subscription_id)
-                current_period_end = subscription.current_period_end
+                return await _stripe_call(stripe.Invoice.retrieve, latest_invoice)
             except Exception as e:
-                print(f"⚠️ Error al obtener suscripción {subscription_id}: {str(e)}")
+                logger.warning("⚠️ Error al obtener invoice desde subscription: %s", e)
+                return None
         
         # Obtener información del plan para establecer tokens iniciales
         tokens_per_month = None
         plan = None
         if plan_code:
-            from plans import get_plan_by_code
             plan = get_plan_by_code(plan_code)
             if plan:
                 tokens_per_month = plan.tokens_per_month
-                logger.info(f"✅ Plan encontrado: {plan_code} -> {tokens_per_month:,} tokens/mes")
+                logger.info("✅ Plan encontrado: %s -> %d tokens/mes", plan_code, tokens_per_month)
             else:
-                logger.error(f"❌ ERROR CRÍTICO: Plan '{plan_code}' no encontrado en plans.py")
-                print(f"❌ ERROR CRÍTICO: Plan '{plan_code}' no encontrado. Los tokens NO se sumarán.")
+                logger.error(
+                    "❌ ERROR CRÍTICO: Plan '%s' no encontrado en plans.py, los tokens NO se sumarán (session=%s)",
+                    plan_code, session.get("id")
+                )
         else:
-            logger.error(f"❌ ERROR CRÍTICO: plan_code no está en metadata del checkout session")
-            print(f"❌ ERROR CRÍTICO: plan_code no está en metadata. Session ID: {session.get('id')}")
-            print(f"   Metadata disponible: {metadata}")
+            logger.error(
+                "❌ ERROR CRÍTICO: plan_code no está en metadata del checkout session (session=%s, metadata=%s)",
+                session.get("id"), metadata
+            )
         
-        # Preparar datos para actualizar
-        update_data = {
-            "stripe_customer_id": customer_id,
-        }
+        period_end_iso = datetime.fromtimestamp(current_period_end).isoformat() if current_period_end else None
+        fair_use_applied = metadata.get("fair_use_discount_applied") == "true"
         
-        if plan_code:
-            update_data["current_plan"] = plan_code
-            # Obtener tokens actuales del usuario para sumar en lugar de resetear
+        # Pago inicial para stripe_payments: monto de la última invoice o, si no
+        # está disponible, el precio del plan
+        payment_data = None
+        invoice_obj = await fetch_latest_invoice()
+        amount_usd = None
+        payment_date = None
+        if invoice_obj is not None:
+            amount_usd = invoice_obj.amount_paid / 100.0 if invoice_obj.amount_paid else None
+            payment_date = datetime.fromtimestamp(invoice_obj.created).isoformat() if invoice_obj.created else None
+        if amount_usd is None and plan:
+            amount_usd = plan.price_usd
+            payment_date = datetime.utcnow().isoformat()
+        if amount_usd is not None:
+            payment_data = {
+                "invoice_id": f"checkout-{session.get('id', 'unknown')}",
+                "customer_id": customer_id,
+                "user_id": user_id,
+                "plan_code": plan_code,
+                "amount_usd": amount_usd,
+                "currency": "usd",
+                "payment_date": payment_date or datetime.utcnow().isoformat()
+            }
+        
+        # Camino rápido: la RPC complete_checkout lee, suma, actualiza y registra el
+        # pago en una sola llamada y transacción (y devuelve el email, así no hace
+        # falta otro SELECT más abajo)
+        checkout_rows = None
+        if _complete_checkout_available:
+            checkout_rows = await asyncio.to_thread(
+                _complete_checkout_rpc, user_id, plan_code, tokens_per_month,
+                customer_id, period_end_iso, fair_use_applied, payment_data
+            )
+        
+        profile_email = None
+        if checkout_rows is not None:
+            invalidate_tokens_cache(user_id)
+            profile_updated = bool(checkout_rows)
+            if profile_updated:
+                row = checkout_rows[0]
+                profile_email = row.get("email")
+                if row.get("primera_suscripcion"):
+                    token_service.reset_usage_alerts(user_id)
+                logger.info(
+                    "✅ Perfil actualizado (complete_checkout) para usuario %s: plan=%s, tokens=%s -> %s",
+                    user_id, plan_code, row.get("tokens_anteriores"), row.get("tokens_restantes")
+                )
+                if row.get("pago_registrado"):
+                    logger.info("✅ Pago inicial registrado: %s USD para usuario %s (plan: %s)", amount_usd, user_id, plan_code)
+            else:
+                logger.error("❌ ERROR: complete_checkout no encontró el perfil del usuario %s", user_id)
+        else:
+            # Una sola lectura del perfil con todo lo que usa este camino
+            # (tokens, límite mensual, elegibilidad de uso justo y email)
+            profile_row = None
             try:
-                profile_response = supabase_client.table("profiles").select("tokens_restantes").eq("id", user_id).execute()
-                current_tokens = 0
-                if profile_response.data and profile_response.data[0].get("tokens_restantes") is not None:
-                    current_tokens = profile_response.data[0]["tokens_restantes"]
+                if isinstance(profile_response, Exception):
+                    raise profile_response
+                if profile_response is None:
+                    profile_response = await asyncio.to_thread(
+                        supabase_client.table("profiles").select(_CHECKOUT_PROFILE_COLUMNS).eq("id", user_id).execute
+                    )
+                profile_row = profile_response.data[0] if profile_response.data else {}
+                profile_email = profile_row.get("email")
+            except Exception as e:
+                logger.error("Error al obtener el perfil, usando tokens del plan directamente: %s", e)
+            
+            # Preparar datos para actualizar
+            update_data = {
+                "stripe_customer_id": customer_id,
+            }
+        
+            if plan_code:
+                update_data["current_plan"] = plan_code
+                # Sumar a los tokens actuales en lugar de resetear
+                if profile_row is not None:
+                    current_tokens = profile_row.get("tokens_restantes") or 0
                 
-                # Sumar tokens del nuevo plan a los tokens existentes
-                if tokens_per_month:
-                    new_tokens = current_tokens + tokens_per_month
-                    update_data["tokens_restantes"] = new_tokens
-                    logger.info(f"💰 Tokens sumados para usuario {user_id}: {current_tokens:,} + {tokens_per_month:,} = {new_tokens:,}")
-                    print(f"💰 Tokens sumados para usuario {user_id}: {current_tokens:,} + {tokens_per_month:,} = {new_tokens:,}")
+                    # Sumar tokens del nuevo plan a los tokens existentes
+                    if tokens_per_month:
+                        new_tokens = current_tokens + tokens_per_month
+                        update_data["tokens_restantes"] = new_tokens
+                        logger.info("💰 Tokens sumados para usuario %s: %d + %d = %d", user_id, current_tokens, tokens_per_month, new_tokens)
                     
-                    # Actualizar tokens_monthly_limit con el máximo entre el límite actual y el nuevo plan
-                    try:
-                        current_limit = profile_response.data[0].get("tokens_monthly_limit", 0) if profile_response.data else 0
+                        # Actualizar tokens_monthly_limit con el máximo entre el límite actual y el nuevo plan
+                        current_limit = profile_row.get("tokens_monthly_limit") or 0
                         update_data["tokens_monthly_limit"] = max(current_limit, tokens_per_month)
-                    except Exception as e:
-                        logger.warning(f"No se pudo actualizar tokens_monthly_limit (columna puede no existir): {e}")
                     
-                    # Resetear campos de uso justo solo si es la primera suscripción
-                    if current_tokens == 0:
-                        update_data["fair_use_warning_shown"] = False
-                        update_data["fair_use_discount_eligible"] = False
-                        update_data["fair_use_discount_used"] = False
-                        update_data["fair_use_discount_eligible_at"] = None
-                        update_data["fair_use_email_sent"] = False
-                else:
-                    logger.error(f"❌ ERROR CRÍTICO: tokens_per_month es None para plan_code '{plan_code}'. Los tokens NO se sumarán.")
-                    print(f"❌ ERROR CRÍTICO: tokens_per_month es None. Los tokens NO se actualizarán.")
-            except Exception as e:
-                logger.error(f"Error al obtener tokens actuales, usando tokens del plan directamente: {e}")
-                print(f"⚠️ Error al obtener tokens actuales: {e}")
-                # Fallback: usar tokens del plan si hay error
-                if tokens_per_month:
-                    update_data["tokens_restantes"] = tokens_per_month
-                    logger.info(f"💰 Fallback: Tokens establecidos a {tokens_per_month:,} (sin sumar)")
+                        # Resetear campos de uso justo solo si es la primera suscripción
+                        if current_tokens == 0:
+                            update_data["fair_use_warning_shown"] = False
+                            update_data["fair_use_discount_eligible"] = False
+                            update_data["fair_use_discount_used"] = False
+                            update_data["fair_use_discount_eligible_at"] = None
+                            update_data["fair_use_email_sent"] = False
+                            token_service.reset_usage_alerts(user_id)
+                    else:
+                        logger.error("❌ ERROR CRÍTICO: tokens_per_month es None para plan_code '%s'. Los tokens NO se sumarán.", plan_code)
                 else:
-                    logger.error(f"❌ ERROR: No se pueden establecer tokens porque tokens_per_month es None")
-                    print(f"❌ ERROR: No se pueden establecer tokens porque tokens_per_month es None")
-        
-        # IMPORTANTE: Si el usuario usó el descuento de uso justo, marcarlo
-        if metadata.get("fair_use_discount_applied") == "true":
-            profile_check = supabase_client.table("profiles").select(
-                "fair_use_discount_eligible"
-            ).eq("id", user_id).execute()
-            
-            if profile_check.data and profile_check.data[0].get("fair_use_discount_eligible", False):
+                    # Fallback: usar tokens del plan si no se pudo leer el perfil
+                    if tokens_per_month:
+                        update_data["tokens_restantes"] = tokens_per_month
+                        logger.info("💰 Fallback: Tokens establecidos a %d (sin sumar)", tokens_per_month)
+                    else:
+                        logger.error("❌ ERROR: No se pueden establecer tokens porque tokens_per_month es None")
+        
+            # IMPORTANTE: Si el usuario usó el descuento de uso justo, marcarlo
+            if fair_use_applied and profile_row and profile_row.get("fair_use_discount_eligible"):
                 update_data["fair_use_discount_used"] = True
-                print(f"✅ Descuento de uso justo marcado como usado para usuario {user_id}")
+                logger.info("✅ Descuento de uso justo marcado como usado para usuario %s", user_id)
         
-        if current_period_end:
-            update_data["current_period_end"] = datetime.fromtimestamp(current_period_end).isoformat()
+            if period_end_iso:
+                update_data["current_period_end"] = period_end_iso
         
-        # Actualizar el perfil del usuario
-        logger.info(f"📝 Actualizando perfil con datos: {update_data}")
-        print(f"📝 Actualizando perfil con: plan={plan_code}, tokens_restantes={'sumados' if 'tokens_restantes' in update_data else 'NO incluidos'}")
+            # Actualizar el perfil del usuario
+            logger.info("📝 Actualizando perfil con datos: %s", update_data)
         
-        update_response = supabase_client.table("profiles").update(update_data).eq("id", user_id).execute()
+            update_response = supabase_client.table("profiles").update(update_data).eq("id", user_id).execute()
+            invalidate_tokens_cache(user_id)
+            profile_updated = bool(update_response.data)
         
-        if update_response.data:
-            # Verificar que tokens_restantes se actualizó correctamente
-            updated_profile = update_response.data[0]
-            updated_tokens = updated_profile.get("tokens_restantes")
+            if update_response.data:
+                # Verificar que tokens_restantes se actualizó correctamente
+                updated_profile = update_response.data[0]
+                updated_tokens = updated_profile.get("tokens_restantes")
             
-            if "tokens_restantes" in update_data:
-                expected_tokens = update_data["tokens_restantes"]
-                if updated_tokens == expected_tokens:
-                    logger.info(f"✅ Perfil actualizado correctamente para usuario {user_id}: plan={plan_code}, tokens={updated_tokens:,}")
-                    print(f"✅ Perfil actualizado: plan={plan_code}, tokens={updated_tokens:,}")
+                if "tokens_restantes" in update_data:
+                    expected_tokens = update_data["tokens_restantes"]
+                    if updated_tokens == expected_tokens:
+                        logger.info("✅ Perfil actualizado correctamente para usuario %s: plan=%s, tokens=%d", user_id, plan_code, updated_tokens)
+                    else:
+                        logger.error("❌ ERROR: Tokens no coinciden. Esperado: %d, Actual: %s", expected_tokens, updated_tokens)
                 else:
-                    logger.error(f"❌ ERROR: Tokens no coinciden. Esperado: {expected_tokens:,}, Actual: {updated_tokens}")
-                    print(f"❌ ERROR: Tokens no coinciden. Esperado: {expected_tokens:,}, Actual: {updated_tokens}")
+                    logger.warning("⚠️ ADVERTENCIA: tokens_restantes no se incluyó en la actualización")
+                    logger.info("✅ Perfil actualizado para usuario %s: plan=%s, customer=%s", user_id, plan_code, customer_id)
             else:
-                logger.warning(f"⚠️ ADVERTENCIA: tokens_restantes no se incluyó en la actualización")
-                print(f"⚠️ ADVERTENCIA: tokens_restantes no se actualizó (no estaba en update_data)")
-                print(f"✅ Perfil actualizado para usuario {user_id}: plan={plan_code}, customer={customer_id}")
-        else:
-            logger.error(f"❌ ERROR: update_response.data está vacío. La actualización puede haber fallado.")
-            print(f"❌ ERROR: update_response.data está vacío. La actualización puede haber fallado.")
-            print(f"   Verifica que el usuario {user_id} existe en la tabla profiles")
+                # Normalmente significa que el usuario no existe en profiles
+                logger.error("❌ ERROR: update_response.data está vacío para usuario %s, la actualización puede haber fallado", user_id)
         
         # IMPORTANTE: Registrar pago inicial en tabla stripe_payments para análisis de ingresos
-        if update_response.data:
+        # (con la RPC complete_checkout ya quedó registrado en la misma transacción)
+        if profile_updated and checkout_rows is None and payment_data is not None:
             try:
-                # Obtener monto desde Stripe
-                amount_usd = None
-                payment_date = None
-                
-                if subscription_id:
-                    try:
-                        subscription = stripe.Subscription.retrieve(subscription_id)
-                        if subscription.latest_invoice:
-                            invoice_obj = stripe.Invoice.retrieve(subscription.latest_invoice)
-                            amount_usd = invoice_obj.amount_paid / 100.0 if invoice_obj.amount_paid else None
-                            payment_date = datetime.fromtimestamp(invoice_obj.created).isoformat() if invoice_obj.created else None
-                    except Exception as e:
-                        print(f"⚠️ Error al obtener invoice desde subscription: {e}")
-                
-                # Si no se pudo obtener desde subscription, usar precio del plan
-                if amount_usd is None and plan_code:
-                    from plans import get_plan_by_code
-                    plan = get_plan_by_code(plan_code)
-                    if plan:
-                        amount_usd = plan.price_usd
-                        payment_date = datetime.utcnow().isoformat()
-                
-                # Insertar en tabla de pagos si tenemos los datos
-                if amount_usd is not None:
-                    payment_data = {
-                        "invoice_id": f"checkout-{session.get('id', 'unknown')}",
-                        "customer_id": customer_id,
-                        "user_id": user_id,
-                        "plan_code": plan_code,
-                        "amount_usd": amount_usd,
-                        "currency": "usd",
-                        "payment_date": payment_date or datetime.utcnow().isoformat()
-                    }
-                    
-                    try:
-                        payment_response = supabase_client.table("stripe_payments").insert(payment_data).execute()
-                        if payment_response.data:
-                            print(f"✅ Pago inicial registrado: ${amount_usd:.2f} USD para usuario {user_id} (plan: {plan_code})")
-                    except Exception as insert_error:
-                        error_msg = str(insert_error)
-                        # Si la tabla no existe, solo loguear warning (no crítico)
-                        if "PGRST205" in error_msg or "table" in error_msg.lower() and "not found" in error_msg.lower():
-                            logger.warning(f"⚠️ Tabla stripe_payments no existe. Ejecuta create_stripe_payments_table.sql para crearla.")
-                            print(f"⚠️ Tabla stripe_payments no existe. Ejecuta create_stripe_payments_table.sql para crearla.")
-                        else:
-                            print(f"⚠️ Pago ya registrado o error al insertar: {insert_error}")
-            except Exception as payment_error:
-                print(f"⚠️ Error al registrar pago inicial (no crítico): {payment_error}")
-            
+                payment_response = supabase_client.table("stripe_payments").insert(payment_data).execute()
+                if payment_response.data:
+                    logger.info("✅ Pago inicial registrado: $%.2f USD para usuario %s (plan: %s)", amount_usd, user_id, plan_code)
+            except Exception as insert_error:
+                error_msg = str(insert_error)
+                # Si la tabla no existe, solo loguear warning (no crítico)
+                if "PGRST205" in error_msg or "table" in error_msg.lower() and "not found" in error_msg.lower():
+                    logger.warning("⚠️ Tabla stripe_payments no existe. Ejecuta create_stripe_payments_table.sql para crearla.")
+                else:
+                    logger.warning("⚠️ Pago ya registrado o error al insertar: %s", insert_error)
+        
+        if profile_updated:
             # IMPORTANTE: Enviar email al admin cuando hay una primera compra
             try:
-                from lib.email import send_admin_email
-                import threading
+                from lib.email import send_admin_email, submit_email_task
                 
                 # IMPORTANTE: Obtener email del usuario - usar metadata primero, luego BD como fallback
+                # (el email de BD ya viene de complete_checkout o de la lectura del perfil)
                 user_email = user_email_from_metadata
+                if (not user_email or user_email == "N/A") and profile_email:
+                    user_email = profile_email
                 if not user_email or user_email == "N/A":
-                    try:
-                        user_info_response = supabase_client.table("profiles").select("email").eq("id", user_id).execute()
-                        if user_info_response.data:
-                            user_email = user_info_response.data[0].get("email")
-                        else:
-                            user_email = "N/A"
-                            logger.warning(f"⚠️ No se encontró email para usuario {user_id} en BD ni en metadata")
-                    except Exception as e:
-                        logger.error(f"❌ Error al obtener email del usuario desde BD: {e}")
-                        user_email = user_email_from_metadata or "N/A"
+                    user_email = "N/A"
+                    logger.warning("⚠️ No se encontró email para usuario %s en BD ni en metadata", user_id)
                 
                 # Validar que tenemos un email válido
                 if not user_email or user_email == "N/A" or "@" not in user_email:
-                    logger.error(f"❌ Email inválido para usuario {user_id}: {user_email}")
-                    print(f"❌ No se puede enviar email: email inválido ({user_email})")
+                    logger.error("❌ Email inválido para usuario %s: %s", user_id, user_email)
                     # Continuar sin enviar email al usuario, pero sí al admin
                     user_email = None
                 
-                plan_name = plan_code
-                plan_price = None
-                if plan_code:
-                    from plans import get_plan_by_code
-                    plan_info = get_plan_by_code(plan_code)
-                    if plan_info:
-                        plan_name = plan_info.name
-                        plan_price = plan_info.price_usd
-                
-                # Obtener monto desde Stripe si está disponible
-                amount_usd = plan_price
-                if subscription_id:
-                    try:
-                        subscription = stripe.Subscription.retrieve(subscription_id)
-                        if subscription.latest_invoice:
-                            invoice_obj = stripe.Invoice.retrieve(subscription.latest_invoice)
-                            if invoice_obj.amount_paid:
-                                amount_usd = invoice_obj.amount_paid / 100.0
-                    except Exception as e:
-                        logger.warning(f"No se pudo obtener monto desde Stripe, usando precio del plan: {e}")
+                plan_name = plan.name if plan else plan_code
+                plan_price = plan.price_usd if plan else None
                 
+                # Monto de Stripe (o precio del plan) ya calculado para stripe_payments
                 if amount_usd is None:
-                    amount_usd = plan_price or 0.0
+                    amount_usd = 0.0
                 
                 def send_admin_checkout_email():
                     try:
-                        admin_html = f"""
-                        <html>
-                        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
-                            <div style="background: linear-gradient(135deg, #10b981 0%, #059669 100%); padding: 20px; text-align: center; border-radius: 10px 10px 0 0;">
-                                <h2 style="color: white; margin: 0; font-size: 24px;">🎉 Nueva Compra - Checkout Completado</h2>
-                            </div>
-                            
-                            <div style="background: #ffffff; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
-                                <p style="font-size: 16px; margin-bottom: 20px;">
-                                    Un usuario ha completado el checkout y activado su suscripción en Codex Trader.
-                                </p>
-                                
-                                <div style="background: #f0fdf4; padding: 20px; border-radius: 8px; margin: 20px 0; border-left: 4px solid #10b981;">
-                                    <ul style="list-style: none; padding: 0; margin: 0;">
-                                        <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                            <strong style="color: #059669;">Email del usuario:</strong> 
-                                            <span style="color: #333;">{user_email}</span>
-                                        </li>
-                                        <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                            <strong style="color: #059669;">ID de usuario:</strong> 
-                                            <span style="color: #333; font-family: monospace; font-size: 12px;">{user_id}</span>
-                                        </li>
-                                        <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                            <strong style="color: #059669;">Plan adquirido:</strong> 
-                                            <span style="color: #333; font-weight: bold;">{plan_name} ({plan_code})</span>
-                                        </li>
-                                        <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                            <strong style="color: #059669;">Tokens asignados:</strong> 
-                                            <span style="color: #333;">{tokens_per_month:,} tokens</span>
-                                        </li>
-                                        <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                            <strong style="color: #059669;">Customer ID (Stripe):</strong> 
-                                            <span style="color: #333; font-family: monospace; font-size: 12px;">{customer_id}</span>
-                                        </li>
-                                        <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                            <strong style="color: #059669;">Subscription ID (Stripe):</strong> 
-                                            <span style="color: #333; font-family: monospace; font-size: 12px;">{subscription_id or 'N/A'}</span>
-                                        </li>
-                                        <li style="margin-bottom: 0;">
-                                            <strong style="color: #059669;">Monto pagado:</strong> 
-                                            <span style="color: #10b981; font-weight: bold; font-size: 18px;">${amount_usd:.2f} USD</span>
-                                        </li>
-                                    </ul>
-                                </div>
-                                
-                                <p style="font-size: 12px; color: #666; margin-top: 20px; text-align: center;">
-                                    Fecha: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC
-                                </p>
-                            </div>
-                        </body>
-                        </html>
-                        """
+                        admin_html = render_email(
+                            CHECKOUT_ADMIN_HTML,
+                            user_email=user_email,
+                            user_id=str(user_id),
+                            plan_name=plan_name,
+                            plan_code=plan_code,
+                            tokens_per_month=tokens_per_month,
+                            customer_id=customer_id,
+                            subscription_id=subscription_id or 'N/A',
+                            amount_usd=amount_usd,
+                            fecha=datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+                        )
                         send_admin_email("🎉 Nueva Compra - Checkout Completado - Codex Trader", admin_html)
-                    except Exception as e:
-                        print(f"⚠️ Error al enviar email al admin por checkout completado: {e}")
+                    except Exception:
+                        logger.warning("⚠️ Error al enviar email al admin por checkout completado", exc_info=True)
                 
                 # IMPORTANTE: También enviar email al usuario confirmando su compra
                 # SOLO si tenemos un email válido
@@ -564,21 +743,11 @@ async def handle_checkout_session_completed(session: dict):
                     try:
                         # Validar que tenemos email válido antes de enviar
                         if not user_email or user_email == "N/A" or "@" not in user_email:
-                            logger.warning(f"⚠️ No se enviará email al usuario: email inválido ({user_email})")
+                            logger.warning("⚠️ No se enviará email al usuario: email inválido (%s)", user_email)
                             return
                         
                         from lib.email import send_email
                         
-                        # Obtener información del plan
-                        plan_name = plan_code
-                        plan_price = None
-                        if plan_code:
-                            from plans import get_plan_by_code
-                            plan_info = get_plan_by_code(plan_code)
-                            if plan_info:
-                                plan_name = plan_info.name
-                                plan_price = plan_info.price_usd
-                        
                         # Obtener fecha de renovación
                         next_renewal_str = "N/A"
                         if current_period_end:
@@ -590,94 +759,39 @@ async def handle_checkout_session_completed(session: dict):
                         frontend_url = frontend_url.strip('"').strip("'").strip()
                         app_url = frontend_url.rstrip('/')
                         
-                        user_html = f"""
-                        <html>
-                        <body style="font-family: Arial, sans-serif; line-height: 1.8; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
-                            <div style="background: linear-gradient(135deg, #10b981 0%, #059669 100%); padding: 30px; text-align: center; border-radius: 10px 10px 0 0;">
-                                <h1 style="color: white; margin: 0; font-size: 28px;">¡Pago Exitoso! 🎉</h1>
-                            </div>
-                            
-                            <div style="background: #ffffff; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
-                                <p style="font-size: 16px; margin-bottom: 20px;">
-                                    Hola <strong>{user_email}</strong>,
-                                </p>
-                                
-                                <p style="font-size: 16px; margin-bottom: 20px;">
-                                    ¡Gracias por tu compra! Tu suscripción a <strong>{plan_name}</strong> ha sido activada exitosamente.
-                                </p>
-                                
-                                <div style="background: #f0fdf4; padding: 20px; border-radius: 8px; margin: 20px 0; border-left: 4px solid #10b981;">
-                                    <h3 style="color: #059669; margin-top: 0;">Detalles de tu suscripción:</h3>
-                                    <ul style="list-style: none; padding: 0; margin: 0;">
-                                        <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                            <strong style="color: #059669;">Plan:</strong> 
-                                            <span style="color: #333; font-weight: bold;">{plan_name}</span>
-                                        </li>
-                                        <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                            <strong style="color: #059669;">Tokens recibidos:</strong> 
-                                            <span style="color: #10b981; font-weight: bold; font-size: 18px;">{tokens_per_month:,} tokens</span>
-                                        </li>
-                                        <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                            <strong style="color: #059669;">Monto pagado:</strong> 
-                                            <span style="color: #333; font-weight: bold;">${plan_price:.2f} USD</span>
-                                        </li>
-                                        <li style="margin-bottom: 0;">
-                                            <strong style="color: #059669;">Próxima renovación:</strong> 
-                                            <span style="color: #333;">{next_renewal_str}</span>
-                                        </li>
-                                    </ul>
-                                </div>
-                                
-                                <div style="text-align: center; margin: 30px 0;">
-                                    <a href="{app_url}" style="display: inline-block; background: #10b981; color: white; padding: 15px 30px; text-decoration: none; border-radius: 8px; font-weight: bold; font-size: 16px;">
-                                        🚀 Empezar a usar Codex Trader
-                                    </a>
-                                </div>
-                                
-                                <p style="font-size: 14px; color: #666; margin-top: 30px;">
-                                    <strong>¿Qué puedes hacer ahora?</strong>
-                                </p>
-                                <ul style="color: #333; line-height: 1.8;">
-                                    <li>Hacer consultas al asistente de IA especializado en trading</li>
-                                    <li>Acceder a tu biblioteca profesional de contenido</li>
-                                    <li>Ver tu uso de tokens en el panel de cuenta</li>
-                                </ul>
-                                
-                                <p style="font-size: 12px; color: #666; margin-top: 30px; text-align: center; border-top: 1px solid #e5e7eb; padding-top: 20px;">
-                                    Si no reconoces este pago, contáctanos respondiendo a este correo.
-                                </p>
-                            </div>
-                        </body>
-                        </html>
-                        """
+                        user_html = render_email(
+                            CHECKOUT_USER_HTML,
+                            user_email=user_email,
+                            plan_name=plan_name,
+                            tokens_per_month=tokens_per_month,
+                            plan_price=plan_price,
+                            next_renewal_str=next_renewal_str,
+                            app_url=app_url
+                        )
                         send_email(
                             to=user_email,
                             subject=f"¡Pago exitoso! Tu plan {plan_name} está activo - Codex Trader",
                             html=user_html
                         )
-                        logger.info(f"✅ Email de confirmación de compra enviado a {user_email}")
-                    except Exception as e:
-                        logger.error(f"❌ Error al enviar email al usuario por checkout completado: {e}")
-                        print(f"⚠️ Error al enviar email al usuario por checkout completado: {e}")
+                        logger.info("✅ Email de confirmación de compra enviado a %s", user_email)
+                    except Exception:
+                        logger.warning("⚠️ Error al enviar email al usuario por checkout completado", exc_info=True)
                 
-                # Enviar emails en background (no bloquea)
-                admin_thread = threading.Thread(target=send_admin_checkout_email, daemon=True)
-                admin_thread.start()
+                # Enviar emails en el pool de emails (no bloquea)
+                submit_email_task(send_admin_checkout_email)
                 
                 # Solo enviar email al usuario si tenemos un email válido
                 if user_email and user_email != "N/A" and "@" in user_email:
-                    user_thread = threading.Thread(target=send_user_checkout_email, daemon=True)
-                    user_thread.start()
+                    submit_email_task(send_user_checkout_email)
                 else:
-                    logger.warning(f"⚠️ No se enviará email de confirmación al usuario {user_id}: email inválido")
+                    logger.warning("⚠️ No se enviará email de confirmación al usuario %s: email inválido", user_id)
             except Exception as email_error:
-                print(f"⚠️ Error al preparar emails por checkout completado: {email_error}")
-                logger.error(f"❌ Error al preparar emails por checkout completado: {email_error}")
+                logger.error("❌ Error al preparar emails por checkout completado: %s", email_error)
         else:
-            print(f"⚠️ No se encontró perfil para usuario {user_id}")
+            logger.warning("⚠️ No se encontró perfil para usuario %s", user_id)
             
     except Exception as e:
-        print(f"❌ Error en handle_checkout_session_completed: {str(e)}")
+        logger.error("❌ Error en handle_checkout_session_completed: %s", e)
         raise
 
 
@@ -704,15 +818,13 @@ async def handle_invoice_paid(invoice: dict):
         
         if not profile_response.data:
             # IMPORTANTE: Si no se encuentra por customer_id, puede ser que checkout.session.completed aún no se haya procesado
-            # Intentar buscar por subscription metadata o esperar a que checkout.session.completed se procese
-            logger.warning(f"⚠️ No se encontró usuario con stripe_customer_id: {customer_id}")
-            print(f"⚠️ No se encontró usuario con stripe_customer_id: {customer_id}")
-            print(f"   Esto puede pasar si invoice.paid llega antes que checkout.session.completed")
-            print(f"   El webhook checkout.session.completed debería asignar el stripe_customer_id primero")
+            # (es el que asigna el stripe_customer_id). Se busca por la metadata de la suscripción
+            # (user_id, asignado en create_checkout_session) y, si tampoco está, el evento se aplaza
+            logger.warning("⚠️ No se encontró usuario con stripe_customer_id: %s", customer_id)
             # No retornar inmediatamente, intentar obtener desde subscription metadata si está disponible
             if subscription_id:
                 try:
-                    subscription = stripe.Subscription.retrieve(subscription_id)
+                    subscription = await _stripe_call(stripe.Subscription.retrieve, subscription_id)
                     # Si la subscription tiene metadata con user_id, usarlo
                     if subscription.metadata and subscription.metadata.get("user_id"):
                         user_id_from_sub = subscription.metadata.get("user_id")
@@ -723,13 +835,14 @@ async def handle_invoice_paid(invoice: dict):
                             logger.warning(f"⚠️ Usuario {user_id_from_sub} de metadata no existe en BD")
                             return
                     else:
-                        logger.warning(f"⚠️ Subscription {subscription_id} no tiene metadata con user_id")
-                        return
+                        raise _WebhookNotReady(f"subscription {subscription_id} sin user_id en metadata")
+                except _WebhookNotReady:
+                    raise
                 except Exception as e:
                     logger.error(f"❌ Error al obtener subscription para buscar usuario: {e}")
-                    return
+                    raise _WebhookNotReady(f"no se pudo obtener subscription {subscription_id}")
             else:
-                return
+                raise _WebhookNotReady(f"sin perfil para customer {customer_id}")
         
         user_id = profile_response.data[0]["id"]
         user_email = profile_response.data[0].get("email", "")
@@ -758,7 +871,6 @@ async def handle_invoice_paid(invoice: dict):
             return
         
         # Obtener información del plan para calcular tokens
-        from plans import get_plan_by_code
         plan = get_plan_by_code(plan_code)
         if not plan:
             print(f"⚠️ No se encontró plan con código: {plan_code}")
@@ -800,6 +912,7 @@ async def handle_invoice_paid(invoice: dict):
             update_data["fair_use_discount_used"] = False
             update_data["fair_use_discount_eligible_at"] = None
             update_data["fair_use_email_sent"] = False
+            token_service.reset_usage_alerts(user_id)
         except Exception as e:
             logger.warning(f"No se pudo actualizar campos de uso justo (columnas pueden no existir): {e}")
         
@@ -810,6 +923,7 @@ async def handle_invoice_paid(invoice: dict):
         
         # Actualizar el perfil del usuario
         update_response = supabase_client.table("profiles").update(update_data).eq("id", user_id).execute()
+        invalidate_tokens_cache(user_id)
         
         if update_response.data:
             print(f"✅ Suscripción renovada para usuario {user_id}: plan={plan_code}, tokens={tokens_per_month}")
@@ -866,8 +980,7 @@ async def handle_invoice_paid(invoice: dict):
             # NOTA: Para nuevas suscripciones, el email ya se envía en handle_checkout_session_completed
             # Solo enviar email aquí para renovaciones o si checkout.session.completed no se procesó
             try:
-                from lib.email import send_admin_email, send_email
-                import threading
+                from lib.email import send_admin_email, send_email, submit_email_task
                 
                 plan_name = plan.name
                 amount_total = invoice.get("amount_paid", invoice.get("amount_due", 0))
@@ -915,8 +1028,8 @@ async def handle_invoice_paid(invoice: dict):
                         </html>
                         """
                         send_admin_email("Nuevo pago en Codex Trader", admin_html)
-                    except Exception as e:
-                        print(f"WARNING: Error al enviar email al admin: {e}")
+                    except Exception:
+                        logger.warning("⚠️ Error al enviar email al admin por pago", exc_info=True)
                 
                 def send_user_email_background():
                     try:
@@ -959,26 +1072,136 @@ async def handle_invoice_paid(invoice: dict):
                                 subject=f"Tu plan {plan_name} en Codex Trader ha sido renovado",
                                 html=user_html
                             )
-                    except Exception as e:
-                        print(f"WARNING: Error al enviar email al usuario: {e}")
+                    except Exception:
+                        logger.warning("⚠️ Error al enviar email al usuario por renovación", exc_info=True)
                 
-                admin_thread = threading.Thread(target=send_admin_email_background, daemon=True)
-                admin_thread.start()
+                submit_email_task(send_admin_email_background)
                 
                 # Solo enviar email al usuario si es renovación (no nueva suscripción)
                 if not is_new_subscription:
-                    user_thread = threading.Thread(target=send_user_email_background, daemon=True)
-                    user_thread.start()
+                    submit_email_task(send_user_email_background)
                 
             except Exception as email_error:
                 print(f"WARNING: Error al enviar emails de notificación (no crítico): {email_error}")
         else:
             print(f"⚠️ No se pudo actualizar perfil para usuario {user_id}")
             
+    except _WebhookNotReady:
+        raise
     except Exception as e:
         print(f"❌ Error en handle_invoice_paid: {str(e)}")
         raise
 
 
+# ============================================================================
+# COLA DE EVENTOS DE WEBHOOK
+# ============================================================================
+# El endpoint verifica la firma y encola el evento; un consumidor lo procesa
+# fuera de la request. Stripe no garantiza el orden de entrega: un invoice.paid
+# puede llegar antes que el checkout.session.completed que asigna el
+# stripe_customer_id, así que ese evento se aplaza y se reintenta.
+
+WEBHOOK_QUEUE_MAX_SIZE = 1000
+# Segundos que se espera al apagar para terminar los eventos ya encolados
+WEBHOOK_DRAIN_TIMEOUT_SECONDS = 10.0
+# Reintentos de un evento que depende de otro aún no procesado
+WEBHOOK_DEFER_SECONDS = 30.0
+WEBHOOK_MAX_DEFERRALS = 5
+
+
+class _WebhookNotReady(Exception):
+    """El evento depende de otro que aún no se procesó (se reintenta más tarde)."""
+
+
+_WEBHOOK_HANDLERS = {
+    "checkout.session.completed": handle_checkout_session_completed,
+    "invoice.paid": handle_invoice_paid,
+}
+
+_webhook_events: Optional[asyncio.Queue] = None
+_webhook_consumer: Optional[asyncio.Task] = None
+# Referencias a los reintentos programados (para que no los recoja el GC)
+_deferred_webhooks: set = set()
+
+
+async def _handle_webhook_event(event_type: str, obj: dict, event_id: Optional[str] = None, attempt: int = 0):
+    try:
+        # Dos entregas del mismo evento pueden estar en la cola a la vez
+        if await asyncio.to_thread(_is_stripe_event_processed, event_id):
+            logger.info("🔁 Webhook %s ya procesado, se ignora", event_id)
+            return
+        await _WEBHOOK_HANDLERS[event_type](obj)
+        await asyncio.to_thread(_mark_stripe_event_processed, event_id)
+    except _WebhookNotReady as e:
+        if attempt >= WEBHOOK_MAX_DEFERRALS:
+            logger.error("❌ Webhook %s (%s) descartado tras %d reintentos: %s", event_type, obj.get("id"), attempt, e)
+            return
+        logger.info("⏳ Webhook %s (%s) aplazado %ss: %s", event_type, obj.get("id"), WEBHOOK_DEFER_SECONDS, e)
+        task = asyncio.create_task(_retry_webhook_event(event_type, obj, event_id, attempt + 1))
+        _deferred_webhooks.add(task)
+        task.add_done_callback(_deferred_webhooks.discard)
+    except Exception:
+        logger.exception(f"❌ Error procesando webhook {event_type} ({obj.get('id')})")
+
+
+async def _retry_webhook_event(event_type: str, obj: dict, event_id: Optional[str], attempt: int):
+    await asyncio.sleep(WEBHOOK_DEFER_SECONDS)
+    if _webhook_consumer is not None and not _webhook_consumer.done():
+        try:
+            _webhook_events.put_nowait((event_type, obj, event_id, attempt))
+            return
+        except asyncio.QueueFull:
+            pass
+    await _handle_webhook_event(event_type, obj, event_id, attempt)
+
+
+async def _consume_webhook_events():
+    while True:
+        event_type, obj, event_id, attempt = await _webhook_events.get()
+        try:
+            await _handle_webhook_event(event_type, obj, event_id, attempt)
+        finally:
+            _webhook_events.task_done()
+
+
+def _enqueue_webhook_event(event_type: str, obj: dict, event_id: Optional[str], background_tasks: BackgroundTasks):
+    """
+    Encola un evento de webhook (no bloquea).
+    
+    Si el consumidor no está en marcha o la cola está llena, el evento se
+    procesa como background task de la request.
+    """
+    if _webhook_consumer is not None and not _webhook_consumer.done():
+        try:
+            _webhook_events.put_nowait((event_type, obj, event_id, 0))
+            return
+        except asyncio.QueueFull:
+            logger.warning(f"⚠️ Cola de webhooks llena, {event_type} se procesa en background task")
+    background_tasks.add_task(_handle_webhook_event, event_type, obj, event_id)
+
+
+def start_webhook_consumer():
+    """Arranca el consumidor de webhooks (una sola vez, en el startup de la app)."""
+    global _webhook_events, _webhook_consumer
+    if _webhook_consumer is not None and not _webhook_consumer.done():
+        return
+    _webhook_events = asyncio.Queue(maxsize=WEBHOOK_QUEUE_MAX_SIZE)
+    _webhook_consumer = asyncio.create_task(_consume_webhook_events())
+    logger.info("📨 Consumidor de webhooks de Stripe iniciado")
+
+
+async def stop_webhook_consumer():
+    """Termina los eventos pendientes (con límite de tiempo) y detiene el consumidor."""
+    global _webhook_consumer
+    if _webhook_consumer is None:
+        return
+    try:
+        await asyncio.wait_for(_webhook_events.join(), timeout=WEBHOOK_DRAIN_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠️ Quedaron {_webhook_events.qsize()} webhooks sin procesar al apagar")
+    _webhook_consumer.cancel()
+    _webhook_consumer = None
+
+
 
 # Sistema de referidos eliminado
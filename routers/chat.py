@@ -2,16 +2,24 @@
 Router para endpoints de chat y sesiones de conversación.
 """
 import re
+import time
+import uuid
+import asyncio
 import logging
+from collections import OrderedDict
 from typing import Optional
 from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, UploadFile, File, Form
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, JSONResponse
 
 from lib.dependencies import get_user, supabase_client
 from lib.token_service import token_service
 from lib.rag_service import rag_service
 from lib.llm_service import llm_service
+from lib.batch_service import batch_service
+from lib.admission import admit
+from lib.llm_provider import count_tokens
 from lib.vision_service import analyze_image
+from lib.business import is_deep_response_mode
 from routers.models import QueryInput, CreateChatSessionInput
 from config import TOKEN_MULTIPLIER_DEEP_MODE, TOKEN_MULTIPLIER_IMAGE_ANALYSIS
 
@@ -21,51 +29,236 @@ logger = logging.getLogger(__name__)
 chat_router = APIRouter(tags=["chat"])
 
 
+# Saludos simples (español e inglés) que no requieren búsqueda RAG
+_SIMPLE_GREETINGS: frozenset = frozenset((
+    'hola', 'hi', 'hello', 'hey',
+    'buenas', 'buen', 'día', 'day',
+    'qué', 'tal', 'what', 'up',
+    'saludos', 'greetings',
+    'buenos', 'días', 'mornings', 'afternoon', 'evening',
+    'good', 'morning',
+    'there', 'hola qué tal', 'hi there', 'hello there', 'hey there'
+))
+
+# Palabras relacionadas con trading que indican que NO es solo un saludo
+_TRADING_KEYWORDS = (
+    'trading', 'trader', 'mercado', 'market', 'operar', 'trade',
+    'estrategia', 'strategy', 'riesgo', 'risk', 'capital', 'money',
+    'análisis', 'analysis', 'gráfico', 'chart', 'indicador', 'indicator',
+    'soporte', 'support', 'resistencia', 'resistance', 'tendencia', 'trend',
+    'compra', 'venta', 'buy', 'sell', 'precio', 'price', 'acción', 'stock',
+    'forex', 'crypto', 'bitcoin', 'cripto', 'divisa', 'currency',
+    'psicología', 'psychology', 'emociones', 'emotions', 'disciplina', 'discipline',
+    'swing', 'scalping', 'intradía', 'intraday', 'day trading', 'daytrading',
+    'explicar', 'explain', 'qué es', 'what is', 'cómo', 'how', 'cuál', 'which'
+)
+
+# Búsqueda de todas las palabras de trading en una sola pasada (en lugar de un `in` por palabra)
+_TRADING_KEYWORDS_RE = re.compile('|'.join(map(re.escape, _TRADING_KEYWORDS)))
+
+# Caracteres que no son letras, números ni espacios (emojis, puntuación)
+_NON_WORD_RE = re.compile(r'[^\w\s]')
+
+# Longitud máxima de un mensaje que aún puede ser solo un saludo
+# (5 palabras de saludo de hasta 9 letras + separadores, emojis y puntuación)
+_GREETING_MAX_CHARS = 60
+
+
 def is_simple_greeting(message: str) -> bool:
     """
     Detecta si el mensaje es solo un saludo simple sin contenido de trading.
     Retorna True si es solo un saludo, False si contiene contenido de trading.
     """
+    # Salida rápida: las preguntas reales de trading son más largas que cualquier saludo
+    if not message or len(message) > _GREETING_MAX_CHARS:
+        return False
+    
     # Normalizar el mensaje: minúsculas, sin espacios extra, sin emojis
-    normalized = re.sub(r'[^\w\s]', '', message.lower().strip())
+    normalized = _NON_WORD_RE.sub('', message.lower().strip())
     words = normalized.split()
     
     # Si el mensaje es muy largo, probablemente no es solo un saludo
     if len(words) > 5:
         return False
     
-    # Lista de saludos simples (español e inglés)
-    simple_greetings = [
-        'hola', 'hi', 'hello', 'hey',
-        'buenas', 'buen', 'día', 'day',
-        'qué', 'tal', 'what', 'up',
-        'saludos', 'greetings',
-        'buenos', 'días', 'mornings', 'afternoon', 'evening',
-        'good', 'morning', 'afternoon', 'evening',
-        'there', 'hola qué tal', 'hi there', 'hello there', 'hey there'
-    ]
-    
     # Verificar si todas las palabras son saludos simples
-    all_greetings = all(word in simple_greetings for word in words if word)
-    
-    # Palabras relacionadas con trading que indican que NO es solo un saludo
-    trading_keywords = [
-        'trading', 'trader', 'mercado', 'market', 'operar', 'trade',
-        'estrategia', 'strategy', 'riesgo', 'risk', 'capital', 'money',
-        'análisis', 'analysis', 'gráfico', 'chart', 'indicador', 'indicator',
-        'soporte', 'support', 'resistencia', 'resistance', 'tendencia', 'trend',
-        'compra', 'venta', 'buy', 'sell', 'precio', 'price', 'acción', 'stock',
-        'forex', 'crypto', 'bitcoin', 'cripto', 'divisa', 'currency',
-        'psicología', 'psychology', 'emociones', 'emotions', 'disciplina', 'discipline',
-        'swing', 'scalping', 'intradía', 'intraday', 'day trading', 'daytrading',
-        'explicar', 'explain', 'qué es', 'what is', 'cómo', 'how', 'cuál', 'which'
-    ]
+    all_greetings = bool(words) and _SIMPLE_GREETINGS.issuperset(words)
+    if not all_greetings:
+        return False
     
     # Si contiene palabras de trading, NO es solo un saludo
-    has_trading_content = any(keyword in normalized for keyword in trading_keywords)
+    has_trading_content = _TRADING_KEYWORDS_RE.search(normalized) is not None
     
     # Es solo un saludo si: todas las palabras son saludos Y no hay contenido de trading
-    return all_greetings and not has_trading_content and len(words) > 0
+    return not has_trading_content
+
+
+# Se desactiva si la función SQL save_chat_turn no está creada en Supabase
+_save_chat_turn_available = True
+
+# Tamaño máximo (caracteres) de una respuesta guardada en el historial
+_MAX_STORED_MESSAGE_CHARS = 64 * 1024
+_TRUNCATED_SUFFIX = "\n…[truncado]"
+
+# Sesiones ya verificadas (user_id, conversation_id) -> instante de la verificación.
+# En una conversación activa evita repetir el SELECT de chat_sessions en cada turno.
+_SESSION_OK_TTL_SECONDS = 300
+_SESSION_OK_MAX_SIZE = 10_000
+_session_ok: "OrderedDict[tuple, float]" = OrderedDict()
+
+
+def _session_known(user_id: str, conversation_id: str) -> bool:
+    """True si la sesión se verificó (o se creó) hace menos de _SESSION_OK_TTL_SECONDS."""
+    key = (str(user_id), str(conversation_id))
+    checked_at = _session_ok.get(key)
+    if checked_at is None:
+        return False
+    if time.monotonic() - checked_at > _SESSION_OK_TTL_SECONDS:
+        _session_ok.pop(key, None)
+        return False
+    return True
+
+
+def _remember_session(user_id: str, conversation_id: str):
+    key = (str(user_id), str(conversation_id))
+    _session_ok[key] = time.monotonic()
+    _session_ok.move_to_end(key)
+    while len(_session_ok) > _SESSION_OK_MAX_SIZE:
+        _session_ok.popitem(last=False)
+
+
+def _forget_session(user_id: str, conversation_id: str):
+    _session_ok.pop((str(user_id), str(conversation_id)), None)
+
+
+# Sesión temporal que se devuelve si no se pudo crear en BD (el frontend sigue funcionando)
+_EMPTY_SESSION_TEMPLATE = {
+    "id": None,
+    "user_id": None,
+    "title": "Nueva conversación",
+    "created_at": None,
+    "updated_at": None
+}
+
+
+def _temporary_session(user_id, title: Optional[str] = None) -> dict:
+    session = _EMPTY_SESSION_TEMPLATE.copy()
+    session["id"] = str(uuid.uuid4())
+    session["user_id"] = str(user_id) if user_id is not None else None
+    if title:
+        session["title"] = title
+    return session
+
+
+# Se desactiva si la función SQL get_or_create_chat_session no está creada en Supabase
+_get_or_create_session_available = True
+
+
+def get_or_create_chat_session(user_id: str, conversation_id: Optional[str], title: str, is_new: bool = False) -> Optional[str]:
+    """
+    Devuelve el id de la sesión de chat del usuario, creándola si no existe.
+    
+    Usa la RPC get_or_create_chat_session (una sola llamada); si no existe,
+    hace el SELECT y el INSERT por separado. Si conversation_id pertenece a
+    otro usuario se crea una sesión nueva y se devuelve su id.
+    
+    Args:
+        user_id: ID del usuario
+        conversation_id: ID de la sesión (None para crear una nueva)
+        title: Título para la sesión si hay que crearla
+        is_new: La sesión se acaba de asignar en /chat (no hace falta buscarla)
+        
+    Returns:
+        ID de la sesión, o None si no se pudo crear
+    """
+    global _get_or_create_session_available
+    if _get_or_create_session_available:
+        try:
+            response = supabase_client.rpc("get_or_create_chat_session", {
+                "p_user_id": str(user_id),
+                "p_conversation_id": str(conversation_id) if conversation_id else None,
+                "p_title": title
+            }).execute()
+            return str(response.data) if response.data else None
+        except Exception as e:
+            error_msg = str(e)
+            if "PGRST202" in error_msg or ("function" in error_msg.lower() and "does not exist" in error_msg.lower()):
+                _get_or_create_session_available = False
+                logger.warning("[BG] ⚠️ La función RPC 'get_or_create_chat_session' no existe en Supabase, usando consultas separadas")
+            else:
+                raise
+    
+    if conversation_id:
+        if not is_new:
+            session_check = supabase_client.table("chat_sessions").select("id").eq("id", conversation_id).eq("user_id", user_id).execute()
+            if session_check.data:
+                return conversation_id
+        # Se conserva el id que tiene el frontend (si ya existe de otro usuario
+        # el INSERT falla y se crea una sesión con id nuevo)
+        try:
+            session_response = supabase_client.table("chat_sessions").insert({
+                "id": conversation_id,
+                "user_id": user_id,
+                "title": title
+            }).execute()
+            if session_response.data:
+                return session_response.data[0]["id"]
+        except Exception as e:
+            logger.warning(f"[BG] No se pudo crear la sesión {conversation_id}: {e}, creando nueva sesión")
+    
+    session_response = supabase_client.table("chat_sessions").insert({
+        "user_id": user_id,
+        "title": title
+    }).execute()
+    return session_response.data[0]["id"] if session_response.data else None
+
+
+def save_chat_turn(user_id: str, conversation_id: str, user_query: str, respuesta_texto: str, tokens_used: int):
+    """
+    Guarda la pregunta y la respuesta de un turno en conversations.
+    
+    Usa la RPC save_chat_turn (una sola llamada y transacción); si no existe,
+    hace los dos INSERT por separado. En ambos casos chat_sessions.updated_at
+    lo actualiza el trigger de conversations. Las respuestas de más de
+    _MAX_STORED_MESSAGE_CHARS caracteres se guardan truncadas.
+    """
+    global _save_chat_turn_available
+    if len(respuesta_texto) > _MAX_STORED_MESSAGE_CHARS:
+        respuesta_texto = respuesta_texto[:_MAX_STORED_MESSAGE_CHARS] + _TRUNCATED_SUFFIX
+    
+    if _save_chat_turn_available:
+        try:
+            supabase_client.rpc("save_chat_turn", {
+                "p_user_id": str(user_id),
+                "p_conversation_id": str(conversation_id),
+                "p_user_msg": user_query,
+                "p_assistant_msg": respuesta_texto,
+                "p_tokens": tokens_used
+            }).execute()
+            return
+        except Exception as e:
+            error_msg = str(e)
+            if "PGRST202" in error_msg or ("function" in error_msg.lower() and "does not exist" in error_msg.lower()):
+                _save_chat_turn_available = False
+                logger.warning("[BG] ⚠️ La función RPC 'save_chat_turn' no existe en Supabase, usando INSERT separados")
+            else:
+                raise
+    
+    supabase_client.table("conversations").insert({
+        "user_id": user_id,
+        "conversation_id": conversation_id,
+        "message_role": "user",
+        "message_content": user_query,
+        "tokens_used": 0
+    }).execute()
+    
+    supabase_client.table("conversations").insert({
+        "user_id": user_id,
+        "conversation_id": conversation_id,
+        "message_role": "assistant",
+        "message_content": respuesta_texto,
+        "tokens_used": tokens_used
+    }).execute()
 
 
 def persist_chat_background_task(
@@ -76,10 +269,13 @@ def persist_chat_background_task(
     chat_model: str,
     response_mode: str,
     conversation_id: Optional[str],
+    background_tasks: Optional[BackgroundTasks] = None,
 ):
     """
     Guarda los mensajes y actualiza los tokens después de finalizar el streaming.
     Se ejecuta en background para no bloquear la respuesta al usuario.
+    Los efectos no críticos (registro de uso, emails de alerta) se encolan en
+    la misma BackgroundTasks de la request y se ejecutan después de esta tarea.
     
     MULTIPLICADORES DE TOKENS:
     - Modo Estudio Profundo: 1.5x (más contexto, respuestas elaboradas)
@@ -102,8 +298,8 @@ def persist_chat_background_task(
         total_tokens_usados = stream_state.get("total_tokens") or 0
         
         if total_tokens_usados == 0:
-            input_tokens = len(prompt_text) // 4
-            output_tokens = len(respuesta_texto) // 4
+            input_tokens = count_tokens(prompt_text, chat_model)
+            output_tokens = count_tokens(respuesta_texto, chat_model)
             total_tokens_usados = max(100 if respuesta_texto else 0, input_tokens + output_tokens)
         
         # =====================================================================
@@ -113,11 +309,7 @@ def persist_chat_background_task(
         multiplicador_total = 1.0
         
         # Verificar si es modo "Estudio Profundo"
-        is_deep_mode = response_mode and (
-            response_mode.lower() == 'deep' or 
-            response_mode.lower() == 'estudio profundo' or
-            response_mode.lower() == 'profundo'
-        )
+        is_deep_mode = is_deep_response_mode(response_mode)
         
         # Verificar si incluye análisis de imagen
         has_image = query_payload.get("has_image", False)
@@ -125,19 +317,14 @@ def persist_chat_background_task(
         # Aplicar multiplicador por modo profundo
         if is_deep_mode:
             multiplicador_total *= TOKEN_MULTIPLIER_DEEP_MODE
-            logger.info(f"[BG] 📚 Modo Estudio Profundo: multiplicador {TOKEN_MULTIPLIER_DEEP_MODE}x aplicado")
         
         # Aplicar multiplicador por análisis de imagen
         if has_image:
             multiplicador_total *= TOKEN_MULTIPLIER_IMAGE_ANALYSIS
-            logger.info(f"[BG] 📸 Análisis de Imagen: multiplicador {TOKEN_MULTIPLIER_IMAGE_ANALYSIS}x aplicado")
         
         # Calcular tokens finales a descontar
         total_tokens_usados = int(tokens_base * multiplicador_total)
         
-        if multiplicador_total > 1.0:
-            logger.info(f"[BG] 💰 Tokens: {tokens_base} base × {multiplicador_total}x = {total_tokens_usados} tokens a descontar")
-        
         # Usar token_service para descontar tokens y manejar uso justo
         nuevos_tokens = token_service.deduct_tokens(
             user_id=user_id,
@@ -147,74 +334,76 @@ def persist_chat_background_task(
             input_tokens=input_tokens,
             output_tokens=output_tokens,
             query_preview=prompt_text,
-            response_mode=response_mode
+            response_mode=response_mode,
+            background_tasks=background_tasks
         )
         
         user_query = query_payload.get("query") or ""
         
         try:
-            if not conversation_id:
-                session_response = supabase_client.table("chat_sessions").insert({
-                    "user_id": user_id,
-                    "title": user_query[:50] if len(user_query) > 50 else user_query
-                }).execute()
-                
-                if session_response.data and len(session_response.data) > 0:
-                    conversation_id = session_response.data[0]["id"]
-                    print(f"[BG] Nueva sesión de chat creada: {conversation_id}")
-                else:
-                    print(f"[BG] [WARN] No se pudo crear sesión de chat, continuando sin guardar historial")
-            else:
-                try:
-                    session_check = supabase_client.table("chat_sessions").select("id").eq("id", conversation_id).eq("user_id", user_id).execute()
-                    if not session_check.data:
-                        print(f"[BG] [WARN] Sesión {conversation_id} no encontrada o no pertenece al usuario, creando nueva sesión")
-                        session_response = supabase_client.table("chat_sessions").insert({
-                            "user_id": user_id,
-                            "title": user_query[:50] if len(user_query) > 50 else user_query
-                        }).execute()
-                        if session_response.data and len(session_response.data) > 0:
-                            conversation_id = session_response.data[0]["id"]
-                except Exception as e:
-                    print(f"[BG] [WARN] Error verificando sesión: {e}, creando nueva sesión")
-                    session_response = supabase_client.table("chat_sessions").insert({
-                        "user_id": user_id,
-                        "title": user_query[:50] if len(user_query) > 50 else user_query
-                    }).execute()
-                    if session_response.data and len(session_response.data) > 0:
-                        conversation_id = session_response.data[0]["id"]
+            if not conversation_id or not _session_known(user_id, conversation_id):
+                # Solo se va a chat_sessions si la sesión no se verificó hace poco
+                session_id = get_or_create_chat_session(
+                    user_id,
+                    conversation_id,
+                    user_query[:50] if len(user_query) > 50 else user_query,
+                    is_new=bool(query_payload.get("new_session"))
+                )
+                if session_id:
+                    if conversation_id and session_id != conversation_id:
+                        logger.warning(f"[BG] Sesión {conversation_id} no pertenece al usuario, creada nueva sesión {session_id}")
+                    conversation_id = session_id
+                    _remember_session(user_id, conversation_id)
+                elif not conversation_id:
+                    logger.warning("[BG] No se pudo crear sesión de chat, continuando sin guardar historial")
         except Exception as e:
-            print(f"[BG] [WARN] No se pudo guardar historial (puede que la tabla no exista aún): {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.warning(f"[BG] No se pudo guardar historial (puede que la tabla no exista aún): {str(e)}")
+            logger.debug("[BG] Detalle del error al resolver la sesión", exc_info=True)
         
         if conversation_id:
             try:
-                supabase_client.table("conversations").insert({
-                    "user_id": user_id,
-                    "conversation_id": conversation_id,
-                    "message_role": "user",
-                    "message_content": user_query,
-                    "tokens_used": 0
-                }).execute()
-                
-                supabase_client.table("conversations").insert({
-                    "user_id": user_id,
-                    "conversation_id": conversation_id,
-                    "message_role": "assistant",
-                    "message_content": respuesta_texto,
-                    "tokens_used": total_tokens_usados
-                }).execute()
-                
-                supabase_client.table("chat_sessions").update({
-                    "updated_at": "now()"
-                }).eq("id", conversation_id).execute()
+                save_chat_turn(user_id, conversation_id, user_query, respuesta_texto, total_tokens_usados)
             except Exception as e:
-                print(f"[BG] [WARN] No se pudo guardar historial (puede que la tabla no exista aún): {str(e)}")
-                import traceback
-                traceback.print_exc()
+                logger.warning(f"[BG] No se pudo guardar historial (puede que la tabla no exista aún): {str(e)}")
+                logger.debug("[BG] Detalle del error al guardar el turno", exc_info=True)
+        
+        # Un solo registro por turno con todos los datos relevantes
+        logger.info(
+            f"[BG] 💬 Turno guardado: conversation_id={conversation_id} "
+            f"tokens={total_tokens_usados} (base {tokens_base} × {multiplicador_total}x) "
+            f"restantes={nuevos_tokens} respuesta={len(respuesta_texto)} caracteres"
+        )
     except Exception as bg_error:
-        logger.error(f"[BG] Error inesperado en tarea de guardado: {bg_error}", exc_info=True)
+        logger.exception(f"[BG] Error inesperado en tarea de guardado: {bg_error}")
+
+def complete_batch_job(job: dict, respuesta_texto: str, usage: dict):
+    """
+    Guarda la respuesta de un trabajo de la Batch API y descuenta sus tokens.
+    Lo llama el poller de batch_service cuando el batch termina.
+    """
+    user_id = job["user_id"]
+    profile_response = supabase_client.table("profiles").select("tokens_restantes").eq("id", user_id).execute()
+    tokens_restantes = profile_response.data[0]["tokens_restantes"] if profile_response.data else 0
+    
+    stream_state = {
+        "full_response": respuesta_texto,
+        "input_tokens": usage.get("input_tokens", 0),
+        "output_tokens": usage.get("output_tokens", 0),
+        "total_tokens": usage.get("total_tokens", 0),
+        "prompt_text": job["query"],
+        "error": None,
+        "conversation_id": job.get("conversation_id")
+    }
+    persist_chat_background_task(
+        str(user_id),
+        {"query": job["query"], "conversation_id": job.get("conversation_id")},
+        stream_state,
+        tokens_restantes,
+        job["model"],
+        job.get("response_mode") or "deep",
+        job.get("conversation_id")
+    )
+
 
 @chat_router.post("/chat")
 @chat_router.post("/chat-simple")
@@ -227,26 +416,41 @@ async def chat(query_input: QueryInput, background_tasks: BackgroundTasks, user
     y descuenta los tokens usados del perfil del usuario.
     """
     user_id = user.id
+    response_mode = query_input.response_mode or 'fast'
     
-    # Paso 1: Verificar saldo de tokens
-    tokens_restantes = token_service.verify_token_balance(user_id)
-    
-    # Paso 2: Detectar si es saludo simple
+    # Paso 1: Detectar si es saludo simple
     is_greeting = is_simple_greeting(query_input.query)
     
-    # Paso 3: Realizar búsqueda RAG (si no es saludo)
+    # Paso 2: Saldo de tokens + búsqueda RAG (si no es saludo)
+    # Con la RPC chat_prepare ambas cosas llegan en una sola llamada a Supabase
     context_text = ""
     citation_list = ""
     retrieved_chunks = []
     
+    prepared = None
     if not is_greeting:
-        context_text, citation_list, retrieved_chunks = await rag_service.perform_rag_search(
+        prepared = await rag_service.prepare_chat(
+            user_id=user_id,
             query=query_input.query,
             category=query_input.category,
-            response_mode=query_input.response_mode or 'fast'
+            response_mode=response_mode
         )
     
-    # Paso 4: Si no hay chunks y no es saludo, usar IA directamente (sin RAG)
+    if prepared is not None:
+        tokens_restantes, context_text, citation_list, retrieved_chunks = prepared
+        tokens_restantes = token_service.ensure_token_balance(user_id, tokens_restantes)
+    else:
+        # Flujo de varias llamadas (saludos o RPC chat_prepare no disponible)
+        tokens_restantes = token_service.verify_token_balance(user_id)
+        
+        if not is_greeting:
+            context_text, citation_list, retrieved_chunks = await rag_service.perform_rag_search(
+                query=query_input.query,
+                category=query_input.category,
+                response_mode=response_mode
+            )
+    
+    # Paso 3: Si no hay chunks y no es saludo, usar IA directamente (sin RAG)
     # Esto permite que la IA responda usando su conocimiento general cuando RAG no encuentra información
     if not retrieved_chunks and not is_greeting:
         logger.warning("⚠️ No se encontraron chunks en RAG. Usando IA directamente con conocimiento general.")
@@ -255,9 +459,29 @@ async def chat(query_input: QueryInput, background_tasks: BackgroundTasks, user
         context_text = ""
         citation_list = ""
     
+    # Paso 4: Control de admisión (429 inmediato si el modelo está saturado)
+    # Las consultas que van a la Batch API no abren stream y no ocupan capacidad
+    chat_model = llm_service.get_chat_model()
+    use_batch = (
+        query_input.background
+        and is_deep_response_mode(response_mode)
+        and batch_service.is_eligible(chat_model)
+    )
+    admission_ticket = None
+    if not use_batch:
+        admission_ticket = admit(chat_model, llm_service.estimate_request_tokens(
+            query_input.query, context_text, citation_list, is_greeting, response_mode
+        ))
+    
     # Paso 5: Crear o verificar sesión de chat
+    # Con streaming el id de la sesión nueva se asigna aquí y el INSERT se hace en
+    # background junto con el historial; la Batch API necesita la sesión ya creada
     conversation_id = query_input.conversation_id
-    if not conversation_id:
+    query_payload = query_input.dict()
+    if not conversation_id and not use_batch:
+        conversation_id = str(uuid.uuid4())
+        query_payload["new_session"] = True
+    elif not conversation_id:
         try:
             session_response = supabase_client.table("chat_sessions").insert({
                 "user_id": user_id,
@@ -269,8 +493,33 @@ async def chat(query_input: QueryInput, background_tasks: BackgroundTasks, user
         except Exception as session_error:
             logger.warning(f"[WARN] No se pudo crear sesión: {session_error}")
     
-    # Paso 6: Preparar estado del stream
-    response_mode = query_input.response_mode or 'fast'
+    # Paso 6: Consultas profundas en background -> Batch API (50% más barata)
+    # La respuesta se guarda en el historial cuando el batch termina
+    if use_batch:
+        job_id = await batch_service.submit(
+            user_id=str(user_id),
+            conversation_id=conversation_id,
+            query=query_input.query,
+            response_mode=response_mode,
+            litellm_params=llm_service.build_request_params(
+                query_input.query, context_text, citation_list, is_greeting, response_mode, stream=False
+            )
+        )
+        if job_id:
+            return JSONResponse(
+                status_code=202,
+                content={
+                    "batch_job_id": job_id,
+                    "status": "pending",
+                    "conversation_id": conversation_id
+                }
+            )
+        # No se pudo encolar: se responde por streaming
+        admission_ticket = admit(chat_model, llm_service.estimate_request_tokens(
+            query_input.query, context_text, citation_list, is_greeting, response_mode
+        ))
+    
+    # Paso 7: Preparar estado del stream
     stream_state = {
         "full_response": "",
         "input_tokens": 0,
@@ -281,31 +530,37 @@ async def chat(query_input: QueryInput, background_tasks: BackgroundTasks, user
         "conversation_id": conversation_id
     }
     
-    # Paso 7: Generar stream de respuesta
+    # Paso 8: Generar stream de respuesta (la capacidad se libera al terminar)
     async def stream_generator():
-        async for chunk in llm_service.generate_stream(
-            query=query_input.query,
-            context=context_text,
-            citation_list=citation_list,
-            is_greeting=is_greeting,
-            response_mode=response_mode,
-            stream_state=stream_state
-        ):
-            yield chunk
+        try:
+            async for chunk in llm_service.generate_stream(
+                query=query_input.query,
+                context=context_text,
+                citation_list=citation_list,
+                is_greeting=is_greeting,
+                response_mode=response_mode,
+                stream_state=stream_state
+            ):
+                yield chunk
+        finally:
+            admission_ticket.release()
     
-    # Paso 8: Programar tarea en background para guardar mensajes y descontar tokens
+    # Paso 9: Programar tarea en background para guardar mensajes y descontar tokens
+    # (release también aquí por si el cliente se desconecta antes de iniciar el stream)
+    background_tasks.add_task(admission_ticket.release)
     background_tasks.add_task(
         persist_chat_background_task,
         str(user_id),
-        query_input.dict(),
+        query_payload,
         stream_state,
         tokens_restantes,
-        llm_service.get_chat_model(),
+        chat_model,
         response_mode,
-        conversation_id
+        conversation_id,
+        background_tasks
     )
     
-    # Paso 9: Retornar respuesta streaming
+    # Paso 10: Retornar respuesta streaming
     headers = {
         "Cache-Control": "no-cache, no-transform",
         "X-Accel-Buffering": "no",
@@ -322,10 +577,12 @@ async def chat(query_input: QueryInput, background_tasks: BackgroundTasks, user
 
 
 @chat_router.get("/chat-sessions")
-async def get_chat_sessions(user = Depends(get_user), limit: int = 50):
+async def get_chat_sessions(user = Depends(get_user), limit: int = 50, offset: int = 0):
     """
     Endpoint para obtener la lista de sesiones de chat del usuario autenticado.
     Devuelve las sesiones ordenadas por fecha de actualización (más recientes primero).
+    Paginado con offset/limit: next_offset es el offset de la página siguiente, o
+    None si no hay más.
     Protegido contra llamadas duplicadas simultáneas.
     """
     # PROTECCIÓN CONTRA DUPLICADOS: Verificar si ya se está procesando una solicitud
@@ -337,7 +594,7 @@ async def get_chat_sessions(user = Depends(get_user), limit: int = 50):
         user_id = user.id
         
         # Crear una clave única para este usuario
-        cache_key = f"get_sessions_{user_id}"
+        cache_key = f"get_sessions_{user_id}_{offset}_{limit}"
         
         # Cache simple en memoria para evitar llamadas duplicadas
         if not hasattr(get_chat_sessions, '_request_cache'):
@@ -356,7 +613,8 @@ async def get_chat_sessions(user = Depends(get_user), limit: int = 50):
             time_since_request = current_time - cached_data.get('time', 0)
             if time_since_request < 0.5:  # Menos de 500ms - retornar cache
                 logger.debug(f"⚠️ Solicitud duplicada detectada para usuario {user_id} (hace {int(time_since_request * 1000)}ms). Retornando cache.")
-                return cached_data.get('response', {"sessions": [], "total": 0})
+                # (si la primera aún no terminó, response sigue en None)
+                return cached_data.get('response') or {"sessions": [], "total": 0, "next_offset": None}
         
         # Marcar solicitud en curso
         get_chat_sessions._request_cache[cache_key] = {
@@ -369,9 +627,11 @@ async def get_chat_sessions(user = Depends(get_user), limit: int = 50):
         # Usar el cliente global con SERVICE_KEY (las políticas RLS permiten service_role)
         try:
             # Obtener sesiones de chat ordenadas por fecha de actualización (más recientes primero)
-            sessions_response = supabase_client.table("chat_sessions").select(
-                "id, title, created_at, updated_at"
-            ).eq("user_id", user_id).order("updated_at", desc=True).limit(limit).execute()
+            sessions_response = await asyncio.to_thread(
+                supabase_client.table("chat_sessions").select(
+                    "id, title, created_at, updated_at"
+                ).eq("user_id", user_id).order("updated_at", desc=True).range(offset, offset + limit - 1).execute
+            )
         except Exception as db_error:
             error_msg = str(db_error)
             logger.error(f"❌ Error al consultar tabla 'chat_sessions': {error_msg}")
@@ -380,7 +640,8 @@ async def get_chat_sessions(user = Depends(get_user), limit: int = 50):
                 logger.warning("⚠️ La tabla 'chat_sessions' no existe. Retornando lista vacía.")
                 response_data = {
                     "sessions": [],
-                    "total": 0
+                    "total": 0,
+                    "next_offset": None
                 }
                 # Limpiar cache en caso de error
                 if cache_key in get_chat_sessions._request_cache:
@@ -392,7 +653,8 @@ async def get_chat_sessions(user = Depends(get_user), limit: int = 50):
             logger.info(f"ℹ️ No hay sesiones para usuario: {user_id}")
             response_data = {
                 "sessions": [],
-                "total": 0
+                "total": 0,
+                "next_offset": None
             }
             # Guardar en cache
             if cache_key in get_chat_sessions._request_cache:
@@ -401,9 +663,11 @@ async def get_chat_sessions(user = Depends(get_user), limit: int = 50):
         
         logger.info(f"✅ Sesiones obtenidas: {len(sessions_response.data)} para usuario: {user_id}")
         
+        sessions = sessions_response.data
         response_data = {
-            "sessions": sessions_response.data,
-            "total": len(sessions_response.data)
+            "sessions": sessions,
+            "total": len(sessions),
+            "next_offset": offset + len(sessions) if len(sessions) == limit else None
         }
         
         # Guardar en cache
@@ -419,7 +683,8 @@ async def get_chat_sessions(user = Depends(get_user), limit: int = 50):
         logger.warning(f"⚠️ Error HTTP {http_ex.status_code} en /chat-sessions: {http_ex.detail}")
         response_data = {
             "sessions": [],
-            "total": 0
+            "total": 0,
+            "next_offset": None
         }
         # Limpiar cache en caso de error
         if cache_key and 'get_chat_sessions' in globals() and hasattr(get_chat_sessions, '_request_cache') and cache_key in get_chat_sessions._request_cache:
@@ -427,27 +692,29 @@ async def get_chat_sessions(user = Depends(get_user), limit: int = 50):
         return response_data
     except Exception as e:
         error_msg = str(e)
-        logger.error(f"❌ Error en /chat-sessions: {error_msg}")
-        logger.error(f"❌ Traceback completo: {str(e)}", exc_info=True)
+        logger.exception("❌ Error en /chat-sessions")
         # Si es un error de conexión a Supabase, dar mensaje más claro
         if "connection" in error_msg.lower() or "timeout" in error_msg.lower():
             logger.warning("⚠️ Error de conexión con Supabase. Retornando lista vacía.")
             return {
                 "sessions": [],
-                "total": 0
+                "total": 0,
+                "next_offset": None
             }
         # Si la tabla no existe, retornar lista vacía en lugar de error
         if "relation" in error_msg.lower() and "does not exist" in error_msg.lower():
             logger.warning("⚠️ La tabla 'chat_sessions' no existe. Retornando lista vacía.")
             return {
                 "sessions": [],
-                "total": 0
+                "total": 0,
+                "next_offset": None
             }
         # En lugar de devolver error 500, retornar lista vacía
         logger.warning("⚠️ Retornando lista vacía debido a error")
         response_data = {
             "sessions": [],
-            "total": 0
+            "total": 0,
+            "next_offset": None
         }
         # Limpiar cache en caso de error
         if cache_key and cache_key in get_chat_sessions._request_cache:
@@ -455,36 +722,74 @@ async def get_chat_sessions(user = Depends(get_user), limit: int = 50):
         return response_data
 
 
+@chat_router.get("/chat/batch/{job_id}")
+async def get_batch_job(job_id: str, user = Depends(get_user)):
+    """
+    Estado de una consulta enviada en background (Batch API).
+    Cuando status es "completed" la respuesta ya está también en el historial.
+    """
+    try:
+        job = await asyncio.to_thread(batch_service.get_job, job_id, str(user.id))
+    except Exception as e:
+        logger.error(f"Error obteniendo trabajo batch: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al obtener trabajo batch: {str(e)}"
+        )
+    if not job:
+        raise HTTPException(
+            status_code=404,
+            detail="Trabajo batch no encontrado"
+        )
+    return job
+
+
 @chat_router.get("/chat-sessions/{conversation_id}/messages")
-async def get_conversation_messages(conversation_id: str, user = Depends(get_user), limit: int = 100):
+async def get_conversation_messages(
+    conversation_id: str,
+    user = Depends(get_user),
+    limit: int = 100,
+    before: Optional[str] = None
+):
     """
     Endpoint para obtener los mensajes de una conversación específica.
+    
+    Devuelve los `limit` mensajes más recientes en orden cronológico. Con `before`
+    (created_at ISO de un mensaje) devuelve los `limit` mensajes anteriores a ese
+    instante; next_before es el cursor para pedir la página previa (None si no hay más).
+    El cursor por created_at evita OFFSET profundos en PostgreSQL.
     """
     try:
         user_id = user.id
         
-        # Verificar que la conversación pertenezca al usuario
-        session_check = supabase_client.table("chat_sessions").select("id").eq("id", conversation_id).eq("user_id", user_id).execute()
-        if not session_check.data:
+        # Sesión del usuario con sus mensajes embebidos (PostgREST hace el join por
+        # conversations.conversation_id): comprobación de propiedad y mensajes en una
+        # sola llamada
+        query = supabase_client.table("chat_sessions").select(
+            "id, conversations(id, message_role, message_content, tokens_used, created_at)"
+        ).eq("id", conversation_id).eq("user_id", user_id).eq("conversations.user_id", user_id)
+        if before:
+            # Página anterior al cursor
+            query = query.lt("conversations.created_at", before)
+        # Los más recientes primero (se invierten abajo a orden cronológico)
+        session_response = await asyncio.to_thread(
+            query.order(
+                "created_at", desc=True, foreign_table="conversations"
+            ).limit(limit, foreign_table="conversations").execute
+        )
+        if not session_response.data:
             raise HTTPException(
                 status_code=404,
                 detail="Conversación no encontrada o no pertenece al usuario"
             )
         
-        # Obtener mensajes de la conversación ordenados por fecha de creación
-        messages_response = supabase_client.table("conversations").select(
-            "id, message_role, message_content, tokens_used, created_at"
-        ).eq("conversation_id", conversation_id).eq("user_id", user_id).order("created_at", desc=False).limit(limit).execute()
-        
-        if not messages_response.data:
-            return {
-                "messages": [],
-                "total": 0
-            }
-        
+        messages = session_response.data[0].get("conversations") or []
+        messages.reverse()
+        next_before = messages[0]["created_at"] if messages and len(messages) == limit else None
         return {
-            "messages": messages_response.data,
-            "total": len(messages_response.data)
+            "messages": messages,
+            "total": len(messages),
+            "next_before": next_before
         }
     except HTTPException:
         raise
@@ -584,15 +889,8 @@ async def create_chat_session(create_input: Optional[CreateChatSessionInput] = N
             if not new_session.data:
                 logger.warning("⚠️ No se recibieron datos al crear sesión")
                 # Retornar una sesión temporal en lugar de error
-                import uuid
                 return {
-                    "session": {
-                        "id": str(uuid.uuid4()),
-                        "user_id": str(user_id),
-                        "title": create_input.title if create_input and create_input.title else "Nueva conversación",
-                        "created_at": None,
-                        "updated_at": None
-                    },
+                    "session": _temporary_session(user_id, create_input.title if create_input else None),
                     "message": "Sesión creada (temporal)"
                 }
             
@@ -608,38 +906,20 @@ async def create_chat_session(create_input: Optional[CreateChatSessionInput] = N
                 "session": new_session.data[0],
                 "message": "Conversación creada exitosamente"
             }
-        except Exception as db_error:
-            error_msg = str(db_error)
-            logger.error(f"❌ Error al crear sesión en BD: {error_msg}")
-            logger.error(f"❌ Traceback completo: {str(db_error)}", exc_info=True)
+        except Exception:
+            logger.exception("❌ Error al crear sesión en BD")
             # Retornar una sesión temporal en lugar de error 500
-            import uuid
             return {
-                "session": {
-                    "id": str(uuid.uuid4()),
-                    "user_id": str(user_id),
-                    "title": create_input.title if create_input and create_input.title else "Nueva conversación",
-                    "created_at": None,
-                    "updated_at": None
-                },
+                "session": _temporary_session(user_id, create_input.title if create_input else None),
                 "message": "Sesión creada (temporal debido a error en BD)"
             }
     except HTTPException:
         raise
-    except Exception as e:
-        error_msg = str(e)
-        logger.error(f"❌ Error general al crear conversación: {error_msg}")
-        logger.error(f"❌ Traceback completo: {str(e)}", exc_info=True)
+    except Exception:
+        logger.exception("❌ Error general al crear conversación")
         # Retornar una sesión temporal en lugar de error 500
-        import uuid
         return {
-            "session": {
-                "id": str(uuid.uuid4()),
-                "user_id": str(user.id) if hasattr(user, 'id') else None,
-                "title": "Nueva conversación",
-                "created_at": None,
-                "updated_at": None
-            },
+            "session": _temporary_session(getattr(user, "id", None)),
             "message": "Sesión creada (temporal debido a error)"
         }
 
@@ -662,6 +942,7 @@ async def delete_chat_session(conversation_id: str, user = Depends(get_user)):
         
         # Eliminar la sesión (los mensajes se eliminarán automáticamente por CASCADE)
         supabase_client.table("chat_sessions").delete().eq("id", conversation_id).execute()
+        _forget_session(user_id, conversation_id)
         
         return {
             "message": "Conversación eliminada exitosamente"
@@ -691,10 +972,9 @@ async def update_chat_session(conversation_id: str, title: str, user = Depends(g
                 detail="Conversación no encontrada o no pertenece al usuario"
             )
         
-        # Actualizar el título
+        # Actualizar el título (updated_at lo pone el trigger BEFORE UPDATE)
         updated_session = supabase_client.table("chat_sessions").update({
-            "title": title,
-            "updated_at": "now()"
+            "title": title
         }).eq("id", conversation_id).execute()
         
         if not updated_session.data:
@@ -786,18 +1066,10 @@ async def chat_vision(
             logger.warning("⚠️ No se encontraron chunks en RAG. Usando solo análisis visual.")
             context_text = ""
         
-        # Paso 4: Crear o verificar sesión de chat
-        if not conversation_id:
-            try:
-                session_response = supabase_client.table("chat_sessions").insert({
-                    "user_id": user_id,
-                    "title": query[:50] if len(query) > 50 else query
-                }).execute()
-                if session_response.data and len(session_response.data) > 0:
-                    conversation_id = session_response.data[0]["id"]
-                    logger.info(f"[INFO] Nueva sesión de chat creada: {conversation_id}")
-            except Exception as session_error:
-                logger.warning(f"[WARN] No se pudo crear sesión: {session_error}")
+        # Paso 4: Asignar id a la sesión nueva (el INSERT se hace en background)
+        new_session = not conversation_id
+        if new_session:
+            conversation_id = str(uuid.uuid4())
         
         # Paso C: Construir prompt con contexto RAG + análisis visual + pregunta
         # El prompt se construye automáticamente en llm_service, pero necesitamos
@@ -838,7 +1110,8 @@ async def chat_vision(
             "response_mode": response_mode,  # Ya es "Estudio Profundo" (forzado al inicio)
             "conversation_id": conversation_id,
             "has_image": True,
-            "image_filename": file.filename
+            "image_filename": file.filename,
+            "new_session": new_session
         }
         
         background_tasks.add_task(
@@ -849,7 +1122,8 @@ async def chat_vision(
             tokens_restantes,
             llm_service.get_chat_model(),
             response_mode,  # Ya es "Estudio Profundo"
-            conversation_id
+            conversation_id,
+            background_tasks
         )
         
         # Paso 6: Retornar respuesta streaming
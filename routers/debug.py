@@ -2,10 +2,11 @@
 Router para endpoints de debug y diagnóstico.
 Solo disponible en desarrollo o para administradores.
 """
+import asyncio
 import logging
 from fastapi import APIRouter, Depends, HTTPException
 from typing import Dict, Any
-from lib.dependencies import get_user, supabase_client
+from lib.dependencies import get_user, supabase_client, is_admin_user, get_user_cache_stats
 from routers.users import get_tokens
 
 logger = logging.getLogger(__name__)
@@ -23,7 +24,7 @@ async def debug_tokens(user = Depends(get_user)) -> Dict[str, Any]:
         user_id = user.id
         user_email = user.email if hasattr(user, 'email') else "N/A"
         
-        logger.info(f"🔍 [DEBUG] Verificando tokens para usuario: {user_id}")
+        logger.debug("🔍 [DEBUG] Verificando tokens para usuario: %s", user_id)
         
         # Obtener perfil completo
         try:
@@ -72,3 +73,13 @@ async def debug_tokens(user = Depends(get_user)) -> Dict[str, Any]:
             "tokens_restantes": None
         }
 
+
+@debug_router.get("/debug/user-cache")
+async def debug_user_cache(user = Depends(get_user)) -> Dict[str, Any]:
+    """
+    Estadísticas de la cache de tokens validados de get_user (solo administradores).
+    Un hit_rate bajo indica que casi todas las requests pagan la llamada a Supabase Auth.
+    """
+    if not await asyncio.to_thread(is_admin_user, user):
+        raise HTTPException(status_code=403, detail="Solo administradores")
+    return {"status": "success", **get_user_cache_stats()}
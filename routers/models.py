@@ -1,8 +1,11 @@
 """
 Modelos Pydantic compartidos para los routers.
 """
-from pydantic import BaseModel
-from typing import Optional
+import re
+from pydantic import BaseModel, StringConstraints
+from typing import Optional, Annotated
+
+from plans import get_all_plans
 
 
 class QueryInput(BaseModel):
@@ -10,6 +13,7 @@ class QueryInput(BaseModel):
     conversation_id: Optional[str] = None
     response_mode: Optional[str] = 'fast'
     category: Optional[str] = None
+    background: Optional[bool] = False  # Modo profundo: procesar vía Batch API y responder después
 
 
 class NewConversationInput(BaseModel):
@@ -24,8 +28,21 @@ class CreateChatSessionInput(BaseModel):
     title: Optional[str] = None
 
 
+# Códigos de plan del checkout: los de plans.py más "gratis" (que no tiene plan
+# de pago). pydantic-core los valida (sin distinguir mayúsculas) y los pasa a
+# minúsculas antes de llegar al endpoint
+_CHECKOUT_PLAN_CODES = ["gratis"] + [plan.code for plan in get_all_plans()]
+CheckoutPlanCode = Annotated[
+    str,
+    StringConstraints(
+        to_lower=True,
+        pattern=r"(?i)^(" + "|".join(map(re.escape, _CHECKOUT_PLAN_CODES)) + r")$"
+    )
+]
+
+
 class CheckoutSessionInput(BaseModel):
-    planCode: str
+    planCode: CheckoutPlanCode
 
 
 class TestEmailInput(BaseModel):
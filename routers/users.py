@@ -2,15 +2,20 @@
 Router para endpoints de usuarios, tokens y uso.
 """
 import os
+import asyncio
 import logging
 import time
+import zlib
 from typing import Optional
-from fastapi import APIRouter, Depends, HTTPException, Header, Query
+from fastapi import APIRouter, Depends, HTTPException, Header, Query, BackgroundTasks, Request, Response
 from datetime import datetime
 
 from lib.dependencies import get_user
 from lib.dependencies import supabase_client
 from lib.config_shared import FRONTEND_URL
+from lib.email_templates import render_email, RELOAD_ADMIN_HTML, RELOAD_USER_HTML
+from lib.token_service import get_cached_tokens_response, cache_tokens_response, invalidate_tokens_cache
+from lib.profile_flags import mark_flag
 from routers.models import TokenReloadInput, NotifyRegistrationInput
 
 logger = logging.getLogger(__name__)
@@ -18,20 +23,53 @@ logger = logging.getLogger(__name__)
 # Crear router
 users_router = APIRouter(tags=["users"])
 
+# URL raíz del frontend para los enlaces de los emails (se resuelve una vez al importar;
+# main.py inicializa config_shared antes de importar los routers)
+_APP_URL = (FRONTEND_URL or os.getenv("FRONTEND_URL", "https://www.codextrader.tech")).strip('"').strip("'").strip().rstrip('/')
+
+
+def _tokens_etag(response_data: dict) -> str:
+    """ETag débil del saldo: cambia solo si cambian tokens_restantes o el email."""
+    email_hash = zlib.crc32((response_data.get("email") or "").encode("utf-8")) & 0xffff
+    return f'W/"{response_data.get("tokens_restantes")}-{email_hash:04x}"'
+
+
+def _tokens_conditional_response(request: Request, response: Response, response_data: dict):
+    """
+    Devuelve 304 sin cuerpo si el cliente ya tiene este saldo (If-None-Match);
+    si no, devuelve los datos con su ETag.
+    """
+    etag = _tokens_etag(response_data)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, max-age=5"
+    return response_data
+
 
 @users_router.get("/tokens")
-async def get_tokens(user = Depends(get_user)):
+async def get_tokens(request: Request, response: Response, user = Depends(get_user)):
     """
     Endpoint para consultar los tokens restantes del usuario autenticado.
+    
+    Responde con ETag: los clientes que consultan periódicamente y envían
+    If-None-Match reciben 304 sin cuerpo mientras el saldo no cambie.
     """
-    logger.debug(f"[DEBUG] Endpoint /tokens llamado (método GET)")
+    logger.debug("[DEBUG] Endpoint /tokens llamado (método GET)")
+    user_email = getattr(user, "email", "")
     try:
         user_id = user.id
+        cached = get_cached_tokens_response(str(user_id))
+        if cached is not None:
+            return _tokens_conditional_response(request, response, cached)
         logger.info(f"🔍 Obteniendo tokens para usuario: {user_id}")
         
         # Usar el cliente global con SERVICE_KEY (las políticas RLS permiten service_role)
         try:
-            profile_response = supabase_client.table("profiles").select("tokens_restantes, email").eq("id", user_id).execute()
+            # maybe_single: PostgREST devuelve el objeto (no una lista) o nada si no existe
+            profile_response = await asyncio.to_thread(
+                supabase_client.table("profiles").select("tokens_restantes, email").eq("id", user_id).maybe_single().execute
+            )
         except Exception as db_error:
             error_msg = str(db_error)
             logger.error(f"❌ Error al consultar tabla 'profiles': {error_msg}")
@@ -40,28 +78,31 @@ async def get_tokens(user = Depends(get_user)):
                 logger.warning("⚠️ La tabla 'profiles' no existe. Retornando valores por defecto.")
                 return {
                     "tokens_restantes": 0,
-                    "email": user.email if hasattr(user, 'email') else ""
+                    "email": user_email
                 }
             raise
         
-        if not profile_response.data:
+        profile = profile_response.data if profile_response else None
+        if not profile:
             logger.warning(f"⚠️ Perfil no encontrado para usuario: {user_id}")
             # En lugar de lanzar error 404, retornar valores por defecto
             # Esto permite que el frontend funcione aunque el perfil no exista aún
             logger.info(f"ℹ️ Retornando valores por defecto para usuario: {user_id}")
             return {
                 "tokens_restantes": 0,
-                "email": user.email if hasattr(user, 'email') else ""
+                "email": user_email
             }
         
-        tokens_restantes = profile_response.data[0].get("tokens_restantes", 0)
-        email = profile_response.data[0].get("email", user.email if hasattr(user, 'email') else "")
+        tokens_restantes = profile.get("tokens_restantes", 0)
+        email = profile.get("email", user_email)
         logger.info(f"✅ Tokens obtenidos: {tokens_restantes} para {email}")
         
-        return {
+        response_data = {
             "tokens_restantes": tokens_restantes,
             "email": email
         }
+        cache_tokens_response(str(user_id), response_data)
+        return _tokens_conditional_response(request, response, response_data)
     except HTTPException as http_ex:
         # Si es un error de autenticación (401), re-lanzarlo
         if http_ex.status_code == 401:
@@ -72,28 +113,120 @@ async def get_tokens(user = Depends(get_user)):
             "tokens_restantes": 0,
             "email": ""
         }
-    except Exception as e:
-        error_msg = str(e)
-        logger.error(f"❌ Error en /tokens: {error_msg}")
-        logger.error(f"❌ Traceback completo: {str(e)}", exc_info=True)
+    except Exception:
+        logger.exception("❌ Error en /tokens")
         
         # En lugar de lanzar error 500, retornar valores por defecto
         # Esto permite que el frontend funcione aunque haya problemas temporales
         logger.warning("⚠️ Retornando valores por defecto debido a error")
+        return {
+            "tokens_restantes": 0,
+            "email": user_email
+        }
+
+
+# Se desactiva si la función SQL reload_user_tokens no está creada en Supabase
+_reload_user_tokens_available = True
+
+
+def _apply_token_reload(user_id: str, cantidad: int):
+    """
+    Suma `cantidad` a tokens_restantes y resetea tokens_reload_email_sent.
+    
+    Usa la RPC reload_user_tokens (una sola llamada, incremento atómico); si no
+    existe, hace el SELECT y el UPDATE por separado.
+    
+    Returns:
+        Tuple[tokens_anteriores, tokens_nuevos], o None si el perfil no existe
+    """
+    global _reload_user_tokens_available
+    if _reload_user_tokens_available:
         try:
-            return {
-                "tokens_restantes": 0,
-                "email": user.email if hasattr(user, 'email') else ""
-            }
-        except:
-            return {
-                "tokens_restantes": 0,
-                "email": ""
-            }
+            response = supabase_client.rpc("reload_user_tokens", {
+                "p_user_id": str(user_id),
+                "p_delta": cantidad
+            }).execute()
+            if not response.data:
+                return None
+            row = response.data[0]
+            return row["tokens_anteriores"], row["tokens_nuevos"]
+        except Exception as e:
+            error_msg = str(e)
+            if "PGRST202" in error_msg or ("function" in error_msg.lower() and "does not exist" in error_msg.lower()):
+                _reload_user_tokens_available = False
+                logger.warning("⚠️ La función RPC 'reload_user_tokens' no existe en Supabase, usando SELECT + UPDATE")
+            else:
+                raise
+    
+    # Obtener tokens actuales (pueden ser negativos)
+    profile_response = supabase_client.table("profiles").select("tokens_restantes").eq("id", user_id).maybe_single().execute()
+    profile = profile_response.data if profile_response else None
+    if not profile:
+        return None
+    
+    tokens_actuales = profile["tokens_restantes"]
+    nuevos_tokens = tokens_actuales + cantidad
+    
+    supabase_client.table("profiles").update({
+        "tokens_restantes": nuevos_tokens,
+        "tokens_reload_email_sent": False  # Resetear flag para permitir nuevo email
+    }).eq("id", user_id).execute()
+    return tokens_actuales, nuevos_tokens
+
+
+def _send_reload_emails(user_email: str, user_id: str, tokens_actuales: int, cantidad: int, nuevos_tokens: int):
+    """
+    Emails de una recarga de tokens: aviso al admin y confirmación al usuario
+    (se ejecuta en background). Ambos salen juntos con send_many: un solo
+    batch de Resend o una sola conexión SMTP.
+    """
+    from lib.email import send_many, ADMIN_EMAIL
+    
+    try:
+        messages = []
+        if ADMIN_EMAIL:
+            messages.append({
+                "to": ADMIN_EMAIL,
+                "subject": "💰 Recarga de Tokens - Codex Trader",
+                "html": render_email(
+                    RELOAD_ADMIN_HTML,
+                    user_email=user_email or 'N/A',
+                    user_id=str(user_id),
+                    tokens_actuales=tokens_actuales,
+                    cantidad=cantidad,
+                    nuevos_tokens=nuevos_tokens,
+                    fecha=datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+                )
+            })
+        
+        # tokens_reload_email_sent se acaba de resetear en la misma recarga, así
+        # que no hace falta volver a consultarlo antes de enviar
+        if user_email:
+            user_name = user_email.split('@')[0] if '@' in user_email else 'usuario'
+            messages.append({
+                "to": user_email,
+                "subject": "✅ Tokens recargados exitosamente - Codex Trader",
+                "html": render_email(
+                    RELOAD_USER_HTML,
+                    user_name=user_name,
+                    tokens_actuales=tokens_actuales,
+                    cantidad=cantidad,
+                    nuevos_tokens=nuevos_tokens,
+                    app_url=_APP_URL
+                )
+            })
+        
+        results = send_many(messages)
+        
+        # Marcar flag si el email al usuario se envió exitosamente (se escribe por lotes)
+        if user_email and results and results[-1]:
+            mark_flag(user_id, "tokens_reload_email_sent")
+    except Exception:
+        logger.warning("⚠️ Error al enviar emails por recarga de tokens", exc_info=True)
 
 
 @users_router.post("/tokens/reload")
-async def reload_tokens(token_input: TokenReloadInput, user = Depends(get_user)):
+async def reload_tokens(token_input: TokenReloadInput, background_tasks: BackgroundTasks, user = Depends(get_user)):
     """
     Endpoint para recargar tokens al perfil del usuario.
     Permite recargar incluso si los tokens están en negativo.
@@ -107,177 +240,22 @@ async def reload_tokens(token_input: TokenReloadInput, user = Depends(get_user))
                 detail="La cantidad debe ser mayor a 0"
             )
         
-        # Obtener tokens actuales (pueden ser negativos)
-        profile_response = supabase_client.table("profiles").select("tokens_restantes").eq("id", user_id).execute()
-        
-        if not profile_response.data:
+        # Sumar tokens (se permite recargar con saldo negativo) y resetear el flag
+        # del email de recarga
+        reload_result = await asyncio.to_thread(_apply_token_reload, user_id, token_input.cantidad)
+        if reload_result is None:
             raise HTTPException(
                 status_code=404,
                 detail="Perfil de usuario no encontrado"
             )
-        
-        tokens_actuales = profile_response.data[0]["tokens_restantes"]
-        # Permitir recarga incluso con tokens negativos
-        nuevos_tokens = tokens_actuales + token_input.cantidad
-        
-        # Actualizar tokens y resetear flag de email de recarga (para permitir nuevo email)
-        update_response = supabase_client.table("profiles").update({
-            "tokens_restantes": nuevos_tokens,
-            "tokens_reload_email_sent": False  # Resetear flag para permitir nuevo email
-        }).eq("id", user_id).execute()
+        tokens_actuales, nuevos_tokens = reload_result
+        invalidate_tokens_cache(user_id)
         
         # Obtener email del usuario para enviar notificaciones
         user_email = user.email
         
-        # IMPORTANTE: Enviar emails de notificación (admin y usuario) en segundo plano
-        try:
-            from lib.email import send_admin_email, send_email
-            import threading
-            
-            # 1) EMAIL AL ADMIN: Notificación de recarga de tokens
-            def send_admin_email_background():
-                try:
-                    admin_html = f"""
-                    <html>
-                    <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
-                        <div style="background: linear-gradient(135deg, #2563eb 0%, #1e40af 100%); padding: 20px; text-align: center; border-radius: 10px 10px 0 0;">
-                            <h2 style="color: white; margin: 0; font-size: 24px;">💰 Recarga de Tokens</h2>
-                        </div>
-                        
-                        <div style="background: #ffffff; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
-                            <p style="font-size: 16px; margin-bottom: 20px;">
-                                Un usuario ha recargado tokens en Codex Trader.
-                            </p>
-                            
-                            <div style="background: #f9fafb; padding: 20px; border-radius: 8px; margin: 20px 0;">
-                                <ul style="list-style: none; padding: 0; margin: 0;">
-                                    <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                        <strong style="color: #2563eb;">Email del usuario:</strong> 
-                                        <span style="color: #333;">{user_email}</span>
-                                    </li>
-                                    <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                        <strong style="color: #2563eb;">ID de usuario:</strong> 
-                                        <span style="color: #333; font-family: monospace; font-size: 12px;">{user_id}</span>
-                                    </li>
-                                    <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                        <strong style="color: #2563eb;">Tokens anteriores:</strong> 
-                                        <span style="color: #333;">{tokens_actuales:,}</span>
-                                    </li>
-                                    <li style="margin-bottom: 12px; padding-bottom: 12px; border-bottom: 1px solid #e5e7eb;">
-                                        <strong style="color: #2563eb;">Tokens recargados:</strong> 
-                                        <span style="color: #10b981; font-weight: bold;">+{token_input.cantidad:,}</span>
-                                    </li>
-                                    <li style="margin-bottom: 0;">
-                                        <strong style="color: #2563eb;">Tokens totales ahora:</strong> 
-                                        <span style="color: #333; font-weight: bold; font-size: 18px;">{nuevos_tokens:,}</span>
-                                    </li>
-                                </ul>
-                            </div>
-                            
-                            <p style="font-size: 12px; color: #666; margin-top: 20px; text-align: center;">
-                                Fecha: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC
-                            </p>
-                        </div>
-                    </body>
-                    </html>
-                    """
-                    send_admin_email("💰 Recarga de Tokens - Codex Trader", admin_html)
-                except Exception as e:
-                    print(f"⚠️ Error al enviar email al admin por recarga de tokens: {e}")
-            
-            # 2) EMAIL AL USUARIO: Confirmación de recarga
-            def send_user_email_background():
-                try:
-                    if user_email:
-                        # Verificar si ya se envió el email de confirmación de recarga (flag en base de datos)
-                        try:
-                            profile_check = supabase_client.table("profiles").select("tokens_reload_email_sent").eq("id", user_id).execute()
-                            reload_email_already_sent = profile_check.data[0].get("tokens_reload_email_sent", False) if profile_check.data else False
-                            
-                            if reload_email_already_sent:
-                                print(f"⚠️ Email de confirmación de recarga ya fue enviado anteriormente para {user_email}. Saltando envío.")
-                                return
-                        except Exception as check_error:
-                            # Si falla la verificación, continuar con el envío (no crítico)
-                            print(f"⚠️ Error al verificar flag tokens_reload_email_sent: {check_error}. Continuando con envío.")
-                        
-                        user_name = user_email.split('@')[0] if '@' in user_email else 'usuario'
-                        # Construir URL del app antes del f-string
-                        frontend_url = FRONTEND_URL or os.getenv("FRONTEND_URL", "https://www.codextrader.tech")
-                        frontend_url = frontend_url.strip('"').strip("'").strip()
-                        app_url = frontend_url.rstrip('/')  # Usar la raíz del sitio, no /app
-                        
-                        user_html = f"""
-                        <html>
-                        <body style="font-family: Arial, sans-serif; line-height: 1.8; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
-                            <div style="background: linear-gradient(135deg, #10b981 0%, #059669 100%); padding: 30px; text-align: center; border-radius: 10px 10px 0 0;">
-                                <h1 style="color: white; margin: 0; font-size: 28px;">✅ Tokens Recargados Exitosamente</h1>
-                            </div>
-                            
-                            <div style="background: #ffffff; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
-                                <p style="font-size: 16px; margin-bottom: 20px;">
-                                    Hola <strong>{user_name}</strong>,
-                                </p>
-                                
-                                <p style="font-size: 16px; margin-bottom: 20px;">
-                                    Tu recarga de tokens se ha procesado correctamente.
-                                </p>
-                                
-                                <div style="background: #f0fdf4; padding: 20px; border-radius: 8px; border-left: 4px solid #10b981; margin: 20px 0;">
-                                    <ul style="list-style: none; padding: 0; margin: 0;">
-                                        <li style="margin-bottom: 10px; color: #333;">
-                                            <strong>Tokens anteriores:</strong> {tokens_actuales:,}
-                                        </li>
-                                        <li style="margin-bottom: 10px; color: #333;">
-                                            <strong>Tokens recargados:</strong> <span style="color: #10b981; font-weight: bold;">+{token_input.cantidad:,}</span>
-                                        </li>
-                                        <li style="margin-bottom: 0; color: #333;">
-                                            <strong>Tokens totales ahora:</strong> <span style="color: #059669; font-weight: bold; font-size: 20px;">{nuevos_tokens:,}</span>
-                                        </li>
-                                    </ul>
-                                </div>
-                                
-                                <div style="text-align: center; margin: 30px 0;">
-                                    <a href="{app_url}" style="display: inline-block; background: #10b981; color: white; padding: 15px 30px; text-decoration: none; border-radius: 8px; font-weight: bold; font-size: 16px;">
-                                        🚀 Continuar usando Codex Trader
-                                    </a>
-                                </div>
-                                
-                                <p style="font-size: 12px; margin-top: 30px; color: #666; text-align: center; border-top: 1px solid #e5e7eb; padding-top: 20px; line-height: 1.6;">
-                                    Si no realizaste esta recarga, por favor contáctanos respondiendo a este correo.
-                                </p>
-                            </div>
-                        </body>
-                        </html>
-                        """
-                        result = send_email(
-                            to=user_email,
-                            subject="✅ Tokens recargados exitosamente - Codex Trader",
-                            html=user_html
-                        )
-                        
-                        # Marcar flag en base de datos si el email se envió exitosamente
-                        if result:
-                            try:
-                                supabase_client.table("profiles").update({
-                                    "tokens_reload_email_sent": True
-                                }).eq("id", user_id).execute()
-                                print(f"✅ Flag tokens_reload_email_sent marcado en base de datos para {user_id}")
-                            except Exception as flag_error:
-                                print(f"⚠️ No se pudo marcar flag tokens_reload_email_sent: {flag_error} (no crítico)")
-                except Exception as e:
-                    print(f"⚠️ Error al enviar email al usuario por recarga de tokens: {e}")
-            
-            # Enviar emails en background threads
-            admin_thread = threading.Thread(target=send_admin_email_background, daemon=True)
-            admin_thread.start()
-            
-            user_thread = threading.Thread(target=send_user_email_background, daemon=True)
-            user_thread.start()
-            
-        except Exception as email_error:
-            # No es crítico si falla el email
-            print(f"⚠️ Error al preparar envío de emails por recarga de tokens: {email_error}")
+        # Enviar emails de notificación (admin y usuario) después de responder
+        background_tasks.add_task(_send_reload_emails, user_email, user_id, tokens_actuales, token_input.cantidad, nuevos_tokens)
         
         return {
             "mensaje": f"Tokens recargados exitosamente",
@@ -313,20 +291,26 @@ async def reset_tokens(
             )
         
         # Obtener perfil para verificar que existe
-        profile_response = supabase_client.table("profiles").select("tokens_restantes").eq("id", user_id).execute()
+        profile_response = await asyncio.to_thread(
+            supabase_client.table("profiles").select("tokens_restantes").eq("id", user_id).maybe_single().execute
+        )
+        profile = profile_response.data if profile_response else None
         
-        if not profile_response.data:
+        if not profile:
             raise HTTPException(
                 status_code=404,
                 detail="Perfil de usuario no encontrado"
             )
         
-        tokens_anteriores = profile_response.data[0]["tokens_restantes"]
+        tokens_anteriores = profile["tokens_restantes"]
         
         # Actualizar tokens directamente
-        update_response = supabase_client.table("profiles").update({
-            "tokens_restantes": cantidad
-        }).eq("id", user_id).execute()
+        update_response = await asyncio.to_thread(
+            supabase_client.table("profiles").update({
+                "tokens_restantes": cantidad
+            }).eq("id", user_id).execute
+        )
+        invalidate_tokens_cache(user_id)
         
         return {
             "mensaje": f"Tokens reseteados exitosamente",
@@ -348,7 +332,7 @@ async def check_is_admin(user = Depends(get_user)):
     Endpoint para verificar si el usuario autenticado es administrador.
     Retorna True si el usuario tiene is_admin=True en profiles o está en ADMIN_EMAILS.
     """
-    logger.debug(f"[DEBUG] Endpoint /me/is-admin llamado (método GET)")
+    logger.debug("[DEBUG] Endpoint /me/is-admin llamado (método GET)")
     try:
         user_id = user.id
         
@@ -502,12 +486,12 @@ async def notify_user_registration(
                 logger.debug("[DEBUG] Intentando obtener usuario desde token de autenticación...")
                 user = await get_user(authorization)
                 logger.debug(f"[OK] Usuario obtenido desde token: {user.email if user else 'None'}")
-                logger.debug(f"[DEBUG] User ID: {user.id if user else 'None'}")
+                logger.debug("[DEBUG] User ID: %s", user.id if user else 'None')
             except HTTPException as e:
                 # Error esperado si el token expiró - no es crítico, intentaremos otros métodos
                 error_detail = str(e.detail)
                 if "Session from session_id" in error_detail or "Token has expired" in error_detail:
-                    logger.debug(f"[DEBUG] Token expirado o sesión inválida (esperado): {error_detail[:80]}")
+                    logger.debug("[DEBUG] Token expirado o sesión inválida (esperado): %.80s", error_detail)
                 else:
                     logger.warning(f"[WARNING] Error al obtener usuario desde token: {e.detail}")
                     logger.warning(f"[DEBUG] Status code: {e.status_code}")
@@ -596,7 +580,7 @@ async def notify_user_registration(
             sent_time = notify_user_registration._email_cache[cache_key]
             time_since_sent = current_time - sent_time
             if time_since_sent < 300:  # 5 minutos
-                logger.debug(f"[DEBUG] Emails de bienvenida ya enviados recientemente para {user_email} (hace {int(time_since_sent)} segundos). Ignorando solicitud duplicada.")
+                logger.debug("[DEBUG] Emails de bienvenida ya enviados recientemente para %s (hace %d segundos). Ignorando solicitud duplicada.", user_email, int(time_since_sent))
                 return {
                     "success": True,
                     "message": "Emails ya fueron enviados anteriormente",
@@ -752,9 +736,8 @@ async def notify_user_registration(
         try:
             from lib.email import send_email
             
-            # Construir enlaces usando FRONTEND_URL (normalizar sin barra final)
-            base_url = (FRONTEND_URL or os.getenv("FRONTEND_URL", "https://www.codextrader.tech")).rstrip('/')
-            app_url = base_url  # Usar la raíz del sitio
+            # Enlaces a la raíz del sitio (FRONTEND_URL normalizado al importar)
+            app_url = _APP_URL
             
             # Obtener nombre del usuario desde el email (parte antes del @)
             user_name = user_email.split('@')[0] if '@' in user_email else 'usuario'
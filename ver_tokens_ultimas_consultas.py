@@ -10,7 +10,7 @@ from datetime import datetime
 if sys.platform == 'win32':
     sys.stdout.reconfigure(encoding='utf-8')
 
-log_file = "tokens_log.json"
+log_file = "tokens_log.jsonl"
 
 if not os.path.exists(log_file):
     print("=" * 60)
@@ -22,8 +22,9 @@ if not os.path.exists(log_file):
     sys.exit(0)
 
 try:
+    # Una consulta por línea (JSONL); se muestran solo las últimas 100
     with open(log_file, 'r', encoding='utf-8') as f:
-        logs = json.load(f)
+        logs = [json.loads(line) for line in f if line.strip()][-100:]
     
     if not logs:
         print("No hay logs de tokens aún.")
@@ -0,0 +1,101 @@
+"""
+Script para verificar que la validación de firma propia del webhook de Stripe
+(routers/billing.py::_read_verified_webhook) acepta lo mismo que el SDK oficial.
+
+Firma payloads con stripe.WebhookSignature y comprueba que:
+- un payload bien firmado se acepta (y el SDK también lo acepta)
+- un payload alterado, una firma antigua, otro secreto o una firma no ASCII se rechazan
+"""
+import sys
+import json
+import time
+import asyncio
+
+import stripe
+
+from routers.billing import _read_verified_webhook, WEBHOOK_TOLERANCE_SECONDS
+
+SECRET = "whsec_verificacion_local"
+PAYLOAD = json.dumps({
+    "id": "evt_verificacion",
+    "object": "event",
+    "type": "invoice.paid",
+    "data": {"object": {"id": "in_verificacion"}},
+}).encode("utf-8")
+
+
+class FakeRequest:
+    """Request mínima con el body troceado en chunks, como llega por la red"""
+
+    def __init__(self, body: bytes, chunk_size: int = 16):
+        self._body = body
+        self._chunk_size = chunk_size
+
+    async def stream(self):
+        for i in range(0, len(self._body), self._chunk_size):
+            yield self._body[i:i + self._chunk_size]
+
+    async def body(self):
+        return self._body
+
+
+def firmar(payload: bytes, timestamp: float = None, secret: str = SECRET) -> str:
+    """Construye la cabecera Stripe-Signature igual que Stripe"""
+    t = int(timestamp if timestamp is not None else time.time())
+    signature = stripe.WebhookSignature._compute_signature(f"{t}.{payload.decode('utf-8')}", secret)
+    return f"t={t},v1={signature}"
+
+
+async def comprobar(nombre: str, payload: bytes, sig_header: str, debe_aceptarse: bool) -> bool:
+    try:
+        event = await _read_verified_webhook(FakeRequest(payload), sig_header, SECRET)
+        aceptado = event["id"] == "evt_verificacion"
+    except stripe.error.SignatureVerificationError:
+        aceptado = False
+    except Exception as e:
+        print(f"ERROR: {nombre}: excepción inesperada {type(e).__name__}: {e}")
+        return False
+
+    ok = aceptado == debe_aceptarse
+    resultado = "aceptado" if aceptado else "rechazado"
+    print(f"{'OK' if ok else 'ERROR'}: {nombre} -> {resultado}")
+    return ok
+
+
+async def main() -> int:
+    print("=" * 60)
+    print("VERIFICACION DE FIRMA DE WEBHOOK STRIPE")
+    print("=" * 60)
+    print()
+
+    cabecera_valida = firmar(PAYLOAD)
+    casos = [
+        ("Payload firmado con stripe.WebhookSignature", PAYLOAD, cabecera_valida, True),
+        ("Payload alterado", PAYLOAD.replace(b"in_verificacion", b"in_alterado"), cabecera_valida, False),
+        ("Firma antigua", PAYLOAD, firmar(PAYLOAD, time.time() - WEBHOOK_TOLERANCE_SECONDS - 60), False),
+        ("Firma con otro secreto", PAYLOAD, firmar(PAYLOAD, secret="whsec_otro"), False),
+        ("Firma v1 no ASCII", PAYLOAD, f"t={int(time.time())},v1=ñññ", False),
+        ("Cabecera sin firma v1", PAYLOAD, f"t={int(time.time())}", False),
+    ]
+
+    resultados = [await comprobar(*caso) for caso in casos]
+
+    # El SDK oficial debe aceptar el mismo payload que aceptamos nosotros
+    try:
+        stripe.Webhook.construct_event(PAYLOAD, cabecera_valida, SECRET)
+        print("OK: stripe.Webhook.construct_event acepta el mismo payload")
+        resultados.append(True)
+    except stripe.error.SignatureVerificationError as e:
+        print(f"ERROR: stripe.Webhook.construct_event rechaza el payload: {e}")
+        resultados.append(False)
+
+    print()
+    if all(resultados):
+        print("OK: la verificación de firma coincide con la del SDK de Stripe")
+        return 0
+    print("ERROR: la verificación de firma no se comporta como se esperaba")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))